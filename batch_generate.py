@@ -0,0 +1,203 @@
+import random
+from contextlib import nullcontext
+from typing import Callable, Hashable, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from generation_queue import GenerationCancelled
+
+# Arguments that change how prompt2image generates an image beyond plain txt2img (or img2img).
+# Jobs using any of these always run on their own through prompt2image.
+_UNBATCHABLE_ARGS = (
+    "seamless",
+    "with_variations",
+    "variation_amount",
+    "gfpgan_strength",
+    "upscale",
+)
+
+
+def batchKey(kwargs: dict, default_sampler: str) -> Optional[Hashable]:
+    # Jobs with the same key can be denoised together as one batch, None if the job can't be batched
+    if any(kwargs.get(arg) for arg in _UNBATCHABLE_ARGS):
+        return None
+    sampler_name = kwargs.get("sampler_name") or default_sampler
+    # Ancestral samplers add fresh noise every step, so a batched image wouldn't match
+    # the same seed generated on its own
+    if sampler_name.endswith("_a"):
+        return None
+    strength = None
+    init_img = kwargs.get("init_img")
+    if init_img:
+        # img2img jobs batch with each other if their init images are exactly the requested size
+        # (as tiles are), otherwise prompt2image resizes them
+        with Image.open(init_img) as img:
+            if img.size != (kwargs["width"], kwargs["height"]) or img.width % 64 or img.height % 64:
+                return None
+        strength = kwargs["strength"]
+    return (
+        kwargs.get("model"),
+        kwargs["width"],
+        kwargs["height"],
+        kwargs["steps"],
+        kwargs["cfg_scale"],
+        sampler_name,
+        strength,
+        kwargs.get("profile"),
+    )
+
+
+def _newSeed() -> int:
+    # Same seed range as Generate
+    return random.randrange(0, np.iinfo(np.uint32).max)
+
+
+def generateBatch(
+    t2i,
+    batch_kwargs: List[dict],
+    step_callbacks: Optional[List[Optional[Callable]]] = None,
+) -> List[list]:
+    # Generate several txt2img (or img2img) jobs with the same batchKey in a single sampler call.
+    # Each job gets back a list of [image, seed] just like prompt2image would return,
+    # and every image is seeded individually so it matches the image prompt2image makes for that seed.
+    # Each job's step callback (if any) is called with just that job's slice of the batch latents
+    import torch
+    from ldm.dream.conditioning import get_uc_and_c
+
+    first = batch_kwargs[0]
+    width, height = first["width"], first["height"]
+    steps, cfg_scale = first["steps"], first["cfg_scale"]
+    sampler_name = first.get("sampler_name")
+
+    t2i.load_model()
+    if sampler_name and sampler_name != t2i.sampler_name:
+        t2i.sampler_name = sampler_name
+        t2i._set_sampler()
+
+    # Work out the prompt and seed for every image in the batch.
+    # Like prompt2image, the requested seed is used for the first image of a job and the rest are random
+    prompts, seeds, counts = [], [], []
+    for kwargs in batch_kwargs:
+        n = kwargs.get("iterations") or 1
+        seed = kwargs.get("seed")
+        for j in range(n):
+            prompts.append(kwargs["prompt"])
+            seeds.append(seed if (j == 0 and seed is not None) else _newSeed())
+        counts.append(n)
+
+    device = t2i.device
+    # Noise generators aren't supported on mps, so make the noise on the cpu there
+    noise_device = "cpu" if device.type == "mps" else device
+    if device.type == "cuda" and not t2i.full_precision:
+        precision_scope = torch.autocast(device.type)
+    else:
+        precision_scope = nullcontext()
+    shape = [4, height // 8, width // 8]
+
+    # A job's step callback can raise GenerationCancelled to drop out of the batch,
+    # and the whole batch stops once every job has dropped out
+    cancelled = set()
+
+    def img_callback(samples, step):
+        start = 0
+        for j, (n, step_callback) in enumerate(zip(counts, step_callbacks or [])):
+            if step_callback is not None and j not in cancelled:
+                try:
+                    step_callback(samples[start : start + n], step)
+                except GenerationCancelled:
+                    cancelled.add(j)
+            start += n
+        if len(cancelled) == len(counts):
+            raise GenerationCancelled()
+
+    with torch.no_grad(), precision_scope, t2i.model.ema_scope():
+        # Only encode each distinct prompt once
+        conditioning = {}
+        for prompt in set(prompts):
+            conditioning[prompt] = get_uc_and_c(prompt, model=t2i.model, skip_normalize=False)
+        uc = torch.cat([conditioning[prompt][0] for prompt in prompts])
+        c = torch.cat([conditioning[prompt][1] for prompt in prompts])
+
+        x_T = torch.cat(
+            [
+                torch.randn(
+                    [1, *shape],
+                    generator=torch.Generator(device=noise_device).manual_seed(seed),
+                    device=noise_device,
+                )
+                for seed in seeds
+            ]
+        ).to(device)
+
+        if first.get("init_img"):
+            samples = _img2imgSamples(
+                t2i,
+                [kwargs["init_img"] for kwargs, n in zip(batch_kwargs, counts) for _ in range(n)],
+                first["strength"],
+                steps,
+                cfg_scale,
+                c,
+                uc,
+                x_T,
+                img_callback if any(step_callbacks or []) else None,
+            )
+        else:
+            samples, _ = t2i.sampler.sample(
+                S=steps,
+                conditioning=c,
+                batch_size=len(seeds),
+                shape=shape,
+                verbose=False,
+                unconditional_guidance_scale=cfg_scale,
+                unconditional_conditioning=uc,
+                eta=t2i.ddim_eta,
+                x_T=x_T,
+                img_callback=img_callback if any(step_callbacks or []) else None,
+            )
+        x_samples = t2i.model.decode_first_stage(samples)
+        x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
+        x_samples = (255.0 * x_samples.permute(0, 2, 3, 1)).cpu().numpy().astype(np.uint8)
+
+    images = [Image.fromarray(x) for x in x_samples]
+
+    # Split the images back up into each job's results
+    results = []
+    start = 0
+    for n in counts:
+        job_images = images[start : start + n]
+        job_seeds = seeds[start : start + n]
+        results.append([[img, seed] for img, seed in zip(job_images, job_seeds)])
+        start += n
+    return results
+
+
+def _img2imgSamples(t2i, init_imgs, strength, steps, cfg_scale, c, uc, x_T, img_callback):
+    # img2img the way Generate does it, for a whole batch: each init image is encoded, noised (with its
+    # image's seeded noise) to strength of the way through a DDIM schedule of steps, and denoised from there
+    import torch
+    from ldm.models.diffusion.ddim import DDIMSampler
+
+    sampler = t2i.sampler
+    if not isinstance(sampler, DDIMSampler):
+        # Like Generate, img2img only supports DDIM
+        sampler = DDIMSampler(t2i.model, device=t2i.device)
+    sampler.make_schedule(ddim_num_steps=steps, ddim_eta=t2i.ddim_eta, verbose=False)
+
+    images = np.stack(
+        [np.array(Image.open(path).convert("RGB"), dtype=np.float32) / 255.0 for path in init_imgs]
+    )
+    init_image = 2.0 * torch.from_numpy(images).permute(0, 3, 1, 2).to(t2i.device) - 1.0
+    init_latent = t2i.model.get_first_stage_encoding(t2i.model.encode_first_stage(init_image))
+    t_enc = int(strength * steps)
+    z_enc = sampler.stochastic_encode(
+        init_latent, torch.tensor([t_enc] * len(init_imgs)).to(t2i.device), noise=x_T
+    )
+    return sampler.decode(
+        z_enc,
+        c,
+        t_enc,
+        img_callback=img_callback,
+        unconditional_guidance_scale=cfg_scale,
+        unconditional_conditioning=uc,
+    )
@@ -0,0 +1,63 @@
+# Benchmark for image encoding time per megapixel
+# Run from the repository root with:
+#   python -m benchmarks.encoding
+import argparse
+import asyncio
+import time
+
+from PIL import Image
+
+from image_encoding import DISCORD_SIZE_LIMIT, encodeImage, encodeImages
+
+
+def makeImage(size: int) -> Image.Image:
+    # Noisy gradient, roughly as hard to compress as a detailed generated image
+    gradient = Image.linear_gradient("L").resize((size, size)).convert("RGB")
+    noise = Image.effect_noise((size, size), 40).convert("RGB")
+    return Image.blend(gradient, noise, 0.5)
+
+
+def benchmarkSerial(img: Image.Image, size_limit: int, repeats: int):
+    tic = time.perf_counter()
+    for _ in range(repeats):
+        encoded = encodeImage(img, size_limit)
+    return (time.perf_counter() - tic) / repeats, encoded
+
+
+async def benchmarkParallel(img: Image.Image, size_limit: int, n: int):
+    # Warm up the process pool first
+    await encodeImages([img], size_limit)
+    tic = time.perf_counter()
+    await encodeImages([img] * n, size_limit)
+    return time.perf_counter() - tic
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark image encoding time per megapixel")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 768, 1024, 1280])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--n", type=int, default=4, help="Images encoded at once in parallel")
+    parser.add_argument(
+        "--size-limit",
+        type=int,
+        default=DISCORD_SIZE_LIMIT,
+        help="Byte limit, lower it to benchmark the JPEG fallback",
+    )
+    args = parser.parse_args()
+
+    print(f"{'size':>10} {'format':>8} {'bytes':>10} {'s/image':>9} {'s/MP':>8} {'parallel s/MP':>14}")
+    for size in args.sizes:
+        img = makeImage(size)
+        megapixels = size * size / 1e6
+        per_image, encoded = benchmarkSerial(img, args.size_limit, args.repeats)
+        parallel = asyncio.run(benchmarkParallel(img, args.size_limit, args.n))
+        fmt = "none" if not encoded.sendable else f"{encoded.format}{encoded.quality or ''}"
+        num_bytes = len(encoded)
+        print(
+            f"{size}x{size:<5} {fmt:>8} {num_bytes:>10} {per_image:>9.3f} "
+            f"{per_image / megapixels:>8.3f} {parallel / (args.n * megapixels):>14.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import asyncio
+import random
+import time
+import types
+from typing import List, Optional
+
+import discord
+
+
+def fakeHttpError(status: int, reason: str, retry_after: Optional[float] = None) -> discord.HTTPException:
+    headers = {} if retry_after is None else {"Retry-After": str(retry_after)}
+    response = types.SimpleNamespace(status=status, reason=reason, headers=headers)
+    return discord.HTTPException(response, reason)
+
+
+class FakeUser:
+    def __init__(self, name: str, discriminator: str = "0001"):
+        self.name = name
+        self.discriminator = discriminator
+        self.id = hash(name)
+
+
+class FakeMessage:
+    def __init__(self, content: Optional[str] = None):
+        self.content = content
+
+    async def edit(self, content: Optional[str] = None, **kwargs):
+        if content is not None:
+            self.content = content
+
+    async def delete(self):
+        pass
+
+
+class FakeNetwork:
+    # Simulated discord API: each message costs latency seconds plus its attachments at bandwidth bytes/s,
+    # and messages with more than size_limit bytes of attachments are rejected like discord would.
+    # A fraction error_rate of messages fail with a rate limit or server error
+    def __init__(
+        self,
+        latency: float = 0.1,
+        bandwidth: float = 10_000_000,
+        size_limit: int = 8_000_000,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.size_limit = size_limit
+        self.error_rate = error_rate
+        self.errors = 0
+        self._rng = random.Random(seed)
+
+    async def send(self, files: List[discord.File]) -> int:
+        num_bytes = sum(len(f.fp.getbuffer()) for f in files)
+        await asyncio.sleep(self.latency + num_bytes / self.bandwidth)
+        if num_bytes > self.size_limit:
+            raise fakeHttpError(413, "Request Entity Too Large")
+        if self._rng.random() < self.error_rate:
+            self.errors += 1
+            if self._rng.random() < 0.5:
+                raise fakeHttpError(429, "Too Many Requests", retry_after=self.latency)
+            raise fakeHttpError(503, "Service Unavailable")
+        return num_bytes
+
+
+class FakeFollowup:
+    def __init__(self, ctx: "FakeContext"):
+        self.ctx = ctx
+
+    async def send(
+        self,
+        content: Optional[str] = None,
+        *,
+        embed: Optional[discord.Embed] = None,
+        file: Optional[discord.File] = None,
+        files: Optional[List[discord.File]] = None,
+        **kwargs,
+    ) -> FakeMessage:
+        return await self.ctx._send(content, embed, file, files)
+
+
+class FakeContext:
+    # Records what a command sends back, standing in for discord.ApplicationContext
+    def __init__(self, author: str, network: FakeNetwork):
+        self.author = FakeUser(author)
+        self.channel_id = 0
+        self.network = network
+        self.followup = FakeFollowup(self)
+        self.start_time = time.perf_counter()
+        self.end_time: Optional[float] = None
+        self.images_sent = 0
+        self.bytes_sent = 0
+        self.errors: List[str] = []
+
+    async def defer(self, **kwargs):
+        pass
+
+    async def send(self, content: Optional[str] = None, *, embed=None, file=None, files=None, **kwargs):
+        return await self._send(content, embed, file, files)
+
+    async def _send(self, content, embed, file, files) -> FakeMessage:
+        files = list(files or []) + ([file] if file is not None else [])
+        if files:
+            self.bytes_sent += await self.network.send(files)
+            self.images_sent += len(files)
+            self.end_time = time.perf_counter()
+        elif embed is not None and embed.colour == discord.Colour.red():
+            self.errors.append(embed.footer.text if embed.footer else "error")
+            self.end_time = time.perf_counter()
+        return FakeMessage(content)
+
+    @property
+    def latency(self) -> Optional[float]:
+        return None if self.end_time is None else self.end_time - self.start_time
@@ -0,0 +1,398 @@
+# Offline load test of the txt2img pipeline, without a GPU or a discord server.
+# StableDiffusionCog.txt2img is driven with fake discord contexts, and the model is replaced by a stub
+# that sleeps for a configurable time per step and per pixel. Requests come from a synthetic trace,
+# or are replayed from a recorded trace (e.g. the metrics.log the bot writes).
+# Run from the repository root with:
+#   python -m benchmarks.load_test --requests 50 --rate 2
+#   python -m benchmarks.load_test --trace metrics.log --speedup 10
+#   python -m benchmarks.load_test --workers 2   (a pool of stub model processes)
+#   python -m benchmarks.load_test --remote-nodes 2   (stub generator nodes over HTTP)
+#   python -m benchmarks.load_test --models 3 --load-seconds 5   (requests spread over several models)
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+from benchmarks.fake_discord import FakeContext, FakeNetwork
+from benchmarks.stub_generate import createStubRegistry, stubArgvOptions
+
+PROMPTS = [
+    "a photograph of an astronaut riding a horse",
+    "an oil painting of a lighthouse in a storm",
+    "a cat wearing a wizard hat, digital art",
+    "a futuristic city at night, 4k, highly detailed",
+    "a bowl of ramen, studio lighting",
+]
+
+
+class Request:
+    def __init__(
+        self, t: float, author: str, prompt: str, n=1, width=512, height=512, steps=50, seed=None, model=None
+    ):
+        self.t = t
+        self.author = author
+        self.prompt = prompt
+        self.n = n
+        self.width = width
+        self.height = height
+        self.steps = steps
+        self.seed = seed
+        self.model = model
+
+
+def modelNames(num_models: int) -> List[str]:
+    return [f"model{k}" for k in range(num_models)]
+
+
+def syntheticTrace(
+    num_requests: int, rate: float, num_users: int, seed: int = 0, num_models: int = 1
+) -> List[Request]:
+    # Poisson arrivals, with a few heavy users making bigger requests than everyone else.
+    # With several models, the first is the most popular (Zipf distributed)
+    rng = random.Random(seed)
+    names = modelNames(num_models)
+    popularity = [1 / (k + 1) for k in range(num_models)]
+    trace = []
+    t = 0.0
+    for _ in range(num_requests):
+        t += rng.expovariate(rate)
+        user = rng.randrange(num_users)
+        heavy = user < max(1, num_users // 5)
+        trace.append(
+            Request(
+                t,
+                author=f"user{user}",
+                prompt=rng.choice(PROMPTS),
+                n=rng.choice([2, 4, 4] if heavy else [1, 1, 1, 2]),
+                width=rng.choice([512, 512, 768]),
+                height=rng.choice([512, 512, 768]),
+                steps=rng.choice([50, 100] if heavy else [20, 30, 50]),
+                seed=rng.choice([None, None, None, rng.randrange(10)]),
+                model=rng.choices(names, popularity)[0] if num_models > 1 else None,
+            )
+        )
+    return trace
+
+
+def loadTrace(path: str) -> List[Request]:
+    # JSON lines of requests with a time "t" in seconds, or txt2img events from the bot's metrics.log
+    # (which have the same fields, with the seed asked for as "seed" and the seeds generated as "seeds")
+    trace = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "event" in record and record["event"] != "txt2img":
+                continue
+            trace.append(
+                Request(
+                    record.get("t", record.get("time", 0.0)),
+                    author=record.get("author", "user"),
+                    prompt=record.get("prompt", PROMPTS[0]),
+                    n=record.get("n", 1),
+                    width=record.get("width", 512),
+                    height=record.get("height", 512),
+                    steps=record.get("steps", 50),
+                    seed=record.get("seed"),
+                    model=record.get("model"),
+                )
+            )
+    start = min((request.t for request in trace), default=0.0)
+    for request in trace:
+        request.t -= start
+    return sorted(trace, key=lambda request: request.t)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class EventCollector(logging.Handler):
+    # Collects the structured events the cog writes to the "metrics" logger
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def emit(self, record):
+        self.events.append(json.loads(record.getMessage()))
+
+
+def makeBenchmarkCog(stub_options: dict, outdir: str):
+    from sd_cog import StableDiffusionCog
+
+    class BenchmarkCog(StableDiffusionCog):
+        # The real cog, with the models swapped for stubs
+        def _parse_argv(self):
+            return stubArgvOptions(outdir)
+
+        def _backend_factory(self):
+            return functools.partial(
+                createStubRegistry,
+                stub_options,
+                self.model_specs,
+                default=self.default_model,
+                max_resident=self.resident_models,
+                max_parked=self.parked_models,
+            )
+
+        @contextmanager
+        def _track_vram(self, jobs):
+            yield
+
+        def _free_vram(self):
+            pass
+
+    return BenchmarkCog
+
+
+def startRemoteNodes(
+    num_nodes: int, port: int, stub_options: dict, repo_dir: str, models: List[str]
+) -> list:
+    # Local stand-ins for generator nodes on other machines
+    model_args = [arg for name in models for arg in ("--model", f"{name}=stub.ckpt")]
+    return [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "generator_node.py",
+                "--server",
+                f"http://127.0.0.1:{port}",
+                "--name",
+                f"node{j}",
+                "--stub",
+                json.dumps(stub_options),
+                *model_args,
+            ],
+            cwd=repo_dir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        for j in range(num_nodes)
+    ]
+
+
+def freePort() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class FakeBot:
+    def __init__(self, loop):
+        self.loop = loop
+
+
+async def runTrace(trace: List[Request], cog, network: FakeNetwork, speedup: float):
+    from sd_cog import StableDiffusionCog
+
+    async def runRequest(request: Request) -> FakeContext:
+        await asyncio.sleep(request.t / speedup)
+        ctx = FakeContext(request.author, network)
+        await StableDiffusionCog.txt2img.callback(
+            cog,
+            ctx,
+            prompt=request.prompt,
+            n=request.n,
+            width=request.width,
+            height=request.height,
+            cfg_scale=7.5,
+            seed=request.seed,
+            steps=request.steps,
+            url=None,
+            strength=0.7,
+            preview=False,
+            model=request.model,
+        )
+        return ctx
+
+    # Wait for the (stub) model to be loaded first
+    while cog.model_state not in ("ready", "failed"):
+        await asyncio.sleep(0.01)
+    tic = time.perf_counter()
+    contexts = await asyncio.gather(*[runRequest(request) for request in trace])
+    return contexts, time.perf_counter() - tic
+
+
+def report(
+    contexts: List[FakeContext], events: List[dict], elapsed: float, conditioning_cache: dict
+) -> dict:
+    completed = [ctx for ctx in contexts if ctx.images_sent > 0]
+    latencies = [ctx.latency for ctx in completed]
+    # Images generated, rather than files sent (a grid preview is one file for several images)
+    images = sum(event.get("n", 0) for event in events if event.get("event") == "txt2img")
+
+    def stats(values):
+        return {f"p{q}": percentile(values, q) for q in (50, 95, 99)}
+
+    phase_times = {}
+    for event in events:
+        for phase, t in event.get("timings", {}).items():
+            phase_times.setdefault(phase, []).append(t)
+    return {
+        "requests": len(contexts),
+        "completed": len(completed),
+        "rejected": sum(1 for ctx in contexts if ctx.errors and ctx.images_sent == 0),
+        "elapsed_seconds": elapsed,
+        "images_per_second": images / elapsed if elapsed > 0 else 0.0,
+        "requests_per_second": len(completed) / elapsed if elapsed > 0 else 0.0,
+        "upload_megabytes": sum(ctx.bytes_sent for ctx in contexts) / 1e6,
+        "latency": stats(latencies),
+        "phases": {phase: stats(times) for phase, times in sorted(phase_times.items())},
+        "conditioning_cache": conditioning_cache,
+    }
+
+
+def printReport(result: dict):
+    def fmt(value):
+        return "-" if value is None else f"{value:.2f}"
+
+    print(
+        f"{result['completed']}/{result['requests']} requests completed "
+        f"({result['rejected']} rejected) in {result['elapsed_seconds']:.1f}s"
+    )
+    print(
+        f"throughput: {result['images_per_second']:.2f} images/s, "
+        f"{result['requests_per_second']:.2f} requests/s, {result['upload_megabytes']:.1f}MB uploaded"
+    )
+    print(f"{'':>12} {'p50':>8} {'p95':>8} {'p99':>8}")
+    rows = [("latency", result["latency"])] + list(result["phases"].items())
+    for name, stats in rows:
+        print(f"{name:>12} {fmt(stats['p50']):>8} {fmt(stats['p95']):>8} {fmt(stats['p99']):>8}")
+    cache = result["conditioning_cache"]
+    lookups = cache["hits"] + cache["misses"]
+    print(
+        f"prompt encoding cache: {cache['hits']} hits, {cache['misses']} misses "
+        f"({100 * cache['hits'] / max(1, lookups):.0f}% hit rate)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the txt2img pipeline")
+    parser.add_argument("--trace", help="JSON lines trace to replay (e.g. metrics.log)")
+    parser.add_argument("--requests", type=int, default=30, help="Synthetic trace length")
+    parser.add_argument("--rate", type=float, default=2.0, help="Synthetic requests per second")
+    parser.add_argument("--users", type=int, default=10, help="Synthetic trace users")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--speedup", type=float, default=1.0, help="Replay the trace this many times faster")
+    parser.add_argument("--seconds-per-step", type=float, default=0.005)
+    parser.add_argument("--seconds-per-megapixel-step", type=float, default=0.02)
+    parser.add_argument("--batch-efficiency", type=float, default=0.6)
+    parser.add_argument("--seconds-per-prompt", type=float, default=0.01, help="Stub text encoder time")
+    parser.add_argument("--models", type=int, default=1, help="Spread requests over this many stub models")
+    parser.add_argument("--load-seconds", type=float, default=2.0, help="Stub model load time from disk")
+    parser.add_argument("--swap-seconds", type=float, default=0.2, help="Stub model CPU <-> GPU move time")
+    parser.add_argument(
+        "--workers", type=int, default=0, help="Run the stub in a pool of this many worker processes"
+    )
+    parser.add_argument(
+        "--remote-nodes", type=int, default=0, help="Run the stub on this many generator nodes over HTTP"
+    )
+    parser.add_argument("--upload-latency", type=float, default=0.05)
+    parser.add_argument("--upload-bandwidth", type=float, default=20e6, help="Bytes per second")
+    parser.add_argument(
+        "--upload-error-rate", type=float, default=0.0, help="Fraction of uploads hitting a 429 or 503"
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Override a [generation] config.ini setting, e.g. --set max_batch_images=8",
+    )
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    trace = (
+        loadTrace(args.trace)
+        if args.trace
+        else syntheticTrace(args.requests, args.rate, args.users, args.seed, args.models)
+    )
+    stub_options = dict(
+        seconds_per_step=args.seconds_per_step,
+        seconds_per_megapixel_step=args.seconds_per_megapixel_step,
+        batch_efficiency=args.batch_efficiency,
+        seconds_per_prompt=args.seconds_per_prompt,
+        load_seconds=args.load_seconds,
+        swap_seconds=args.swap_seconds,
+    )
+    network = FakeNetwork(
+        latency=args.upload_latency,
+        bandwidth=args.upload_bandwidth,
+        error_rate=args.upload_error_rate,
+        seed=args.seed,
+    )
+
+    repo_dir = os.getcwd()
+    collector = EventCollector()
+    logging.getLogger("metrics").addHandler(collector)
+    logging.getLogger("metrics").setLevel(logging.INFO)
+
+    # Run in a scratch directory, with its own config.ini and outputs
+    with tempfile.TemporaryDirectory() as work_dir:
+        settings = {
+            "metrics_port": "0",
+            "warmup_steps": "0",
+            "max_queue_size": "1000",
+            "rate_limit_burst": "1000000",
+            "worker_devices": ",".join(["cpu"] * args.workers),
+        }
+        nodes = []
+        if args.remote_nodes > 0:
+            port = freePort()
+            settings.update(remote_port=str(port), remote_slots=str(args.remote_nodes))
+            models = modelNames(args.models) if args.models > 1 else []
+            nodes = startRemoteNodes(args.remote_nodes, port, stub_options, repo_dir, models)
+        settings.update(dict(setting.split("=", 1) for setting in args.set))
+        with open(os.path.join(work_dir, "config.ini"), "w") as f:
+            f.write("[generation]\n")
+            f.writelines(f"{key}={value}\n" for key, value in settings.items())
+            if args.models > 1:
+                f.write("[models]\n")
+                f.writelines(f"{name}=stub.ckpt\n" for name in modelNames(args.models))
+        os.chdir(work_dir)
+        try:
+
+            async def run():
+                bot = FakeBot(asyncio.get_running_loop())
+                cog = makeBenchmarkCog(stub_options, os.path.join(work_dir, "outputs"))(bot)
+                try:
+                    contexts, elapsed = await runTrace(trace, cog, network, args.speedup)
+                    return contexts, elapsed, cog._conditioning_cache_stats()
+                finally:
+                    if cog.worker_pool is not None:
+                        cog.worker_pool.close()
+                    if cog.remote_workers is not None:
+                        await cog.remote_workers.close()
+                    cog.image_store.close()
+                    cog.journal.close()
+
+            contexts, elapsed, conditioning_cache = asyncio.run(run())
+        finally:
+            os.chdir(repo_dir)
+            for node in nodes:
+                node.kill()
+
+    result = report(contexts, collector.events, elapsed, conditioning_cache)
+    printReport(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
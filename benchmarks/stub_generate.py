@@ -0,0 +1,204 @@
+import argparse
+import random
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+from PIL import Image
+
+
+class _StubModel:
+    # Text encoder of the stub, taking seconds_per_prompt for each text encoded
+    def __init__(self, seconds_per_prompt: float):
+        self.seconds_per_prompt = seconds_per_prompt
+
+    def get_learned_conditioning(self, c):
+        texts = [c] if isinstance(c, str) else c
+        time.sleep(self.seconds_per_prompt * len(texts))
+        return np.zeros((len(texts), 77, 768), dtype=np.float16)
+
+
+class StubGenerate:
+    # Stands in for ldm.generate.Generate without a GPU or model weights.
+    # Sampling just sleeps, for seconds_per_step plus seconds_per_megapixel_step for every megapixel
+    # being denoised, and the images are noise seeded by the image seed. img2img runs strength of the steps
+    # and returns the init image with a little of that noise mixed in.
+    # Batches of images are denoised in one go, costing batch_efficiency of the time of running them one by one.
+    # Prompts are "encoded" like Generate does, once for each call plus the empty unconditional prompt.
+    # Loading takes load_seconds from disk, or swap_seconds if the model is already in CPU RAM.
+    def __init__(
+        self,
+        seconds_per_step: float = 0.01,
+        seconds_per_megapixel_step: float = 0.1,
+        batch_efficiency: float = 0.6,
+        load_seconds: float = 0.0,
+        swap_seconds: float = 0.0,
+        seconds_per_prompt: float = 0.0,
+        sampler_name: str = "k_lms",
+    ):
+        self.seconds_per_step = seconds_per_step
+        self.seconds_per_megapixel_step = seconds_per_megapixel_step
+        self.batch_efficiency = batch_efficiency
+        self.load_seconds = load_seconds
+        self.swap_seconds = swap_seconds
+        self.seconds_per_prompt = seconds_per_prompt
+        self.sampler_name = sampler_name
+        self.model = None
+        self.prebuilt_model = None
+
+    def load_model(self):
+        if self.prebuilt_model is None:
+            StubLoader().build(self)
+        self.model, self.prebuilt_model = self.prebuilt_model, None
+        time.sleep(self.swap_seconds)
+
+    def _encode(self, prompt: str):
+        return self.model.get_learned_conditioning([""]), self.model.get_learned_conditioning([prompt])
+
+    def _sample(self, num_pixels: int, steps: int, step_callback: Optional[Callable]):
+        step_time = self.seconds_per_step + self.seconds_per_megapixel_step * num_pixels / 1e6
+        for step in range(steps):
+            time.sleep(step_time)
+            if step_callback is not None:
+                step_callback(None, step)
+
+    @staticmethod
+    def _newSeed() -> int:
+        return random.randrange(0, np.iinfo(np.uint32).max)
+
+    @staticmethod
+    def _image(width: int, height: int, seed: int, init_img: Optional[str] = None) -> Image.Image:
+        rng = np.random.default_rng(seed)
+        noise = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+        if init_img is None:
+            return noise
+        with Image.open(init_img) as init:
+            return Image.blend(init.convert("RGB").resize((width, height)), noise, 0.05)
+
+    @staticmethod
+    def _steps(steps: int, kwargs: dict) -> int:
+        if kwargs.get("init_img"):
+            return int(steps * kwargs.get("strength", 0.75))
+        return steps
+
+    def prompt2image(
+        self,
+        prompt: str,
+        iterations: int = 1,
+        steps: int = 50,
+        seed: Optional[int] = None,
+        width: int = 512,
+        height: int = 512,
+        step_callback: Optional[Callable] = None,
+        image_callback: Optional[Callable] = None,
+        **kwargs,
+    ) -> list:
+        if self.model is None:
+            self.load_model()
+        self._encode(prompt)
+        results = []
+        for j in range(iterations or 1):
+            image_seed = seed if (j == 0 and seed is not None) else self._newSeed()
+            self._sample(width * height, self._steps(steps, kwargs), step_callback)
+            image = self._image(width, height, image_seed, kwargs.get("init_img"))
+            if image_callback is not None:
+                image_callback(image, image_seed)
+            results.append([image, image_seed])
+        return results
+
+    def generate_batch(
+        self,
+        batch_kwargs: List[dict],
+        step_callbacks: Optional[List[Optional[Callable]]] = None,
+    ) -> List[list]:
+        # Same interface as batch_generate.generateBatch
+        from generation_queue import GenerationCancelled
+
+        first = batch_kwargs[0]
+        counts = [kwargs.get("iterations") or 1 for kwargs in batch_kwargs]
+        num_pixels = first["width"] * first["height"] * sum(counts)
+        cancelled = set()
+        for prompt in set(kwargs["prompt"] for kwargs in batch_kwargs):
+            self._encode(prompt)
+
+        def callback(samples, step):
+            for j, step_callback in enumerate(step_callbacks or []):
+                if step_callback is not None and j not in cancelled:
+                    try:
+                        step_callback(None, step)
+                    except GenerationCancelled:
+                        cancelled.add(j)
+            if len(cancelled) == len(counts):
+                raise GenerationCancelled()
+
+        self._sample(int(num_pixels * self.batch_efficiency), self._steps(first["steps"], first), callback)
+
+        results = []
+        for kwargs, n in zip(batch_kwargs, counts):
+            seed = kwargs.get("seed")
+            job_results = []
+            for j in range(n):
+                image_seed = seed if (j == 0 and seed is not None) else self._newSeed()
+                job_results.append(
+                    [
+                        self._image(kwargs["width"], kwargs["height"], image_seed, kwargs.get("init_img")),
+                        image_seed,
+                    ]
+                )
+            results.append(job_results)
+        return results
+
+
+class StubLoader:
+    # Same interface as model_loader.GenerateLoader
+    def build(self, t2i: StubGenerate):
+        time.sleep(t2i.load_seconds)
+        t2i.prebuilt_model = _StubModel(t2i.seconds_per_prompt)
+
+    def park(self, t2i: StubGenerate):
+        time.sleep(t2i.swap_seconds)
+
+    def unpark(self, t2i: StubGenerate):
+        time.sleep(t2i.swap_seconds)
+
+    def drop(self, t2i: StubGenerate):
+        t2i.model = None
+        t2i.prebuilt_model = None
+
+
+def createStubRegistry(
+    options: dict,
+    specs: list,
+    device_type: Optional[str] = None,
+    default: Optional[str] = None,
+    max_resident: int = 1,
+    max_parked: int = 1,
+    profiles: Optional[dict] = None,
+):
+    # Same interface as model_registry.createModelRegistry, with a stub for every model
+    from model_registry import ModelRegistry
+
+    return ModelRegistry(
+        specs,
+        lambda spec: StubGenerate(**options),
+        default=default,
+        max_resident=max_resident,
+        max_parked=max_parked,
+        loader=StubLoader(),
+        profiles=profiles,
+    )
+
+
+def stubArgvOptions(outdir: str) -> argparse.Namespace:
+    # The parts of the dream.py command line options the cog uses
+    return argparse.Namespace(
+        outdir=outdir,
+        sampler_name="k_lms",
+        full_precision=False,
+        grid=False,
+        seamless=False,
+        embedding_path=None,
+        device="cpu",
+        infile=None,
+    )
+
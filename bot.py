@@ -9,12 +9,21 @@ from discord_bot import StableDiffusionBot
 
 logger = logging.getLogger(__name__)
 logging_format = "[%(asctime)s] %(name)s:%(levelname)s %(message)s"
-logging.basicConfig(
-    filename="bot.log", filemode="w", format=logging_format, level=logging.INFO
-)
 
 
 def main():
+    # Logging is set up here rather than on import, so worker processes
+    # (which re-import this module on Windows) don't truncate the log
+    logging.basicConfig(
+        filename="bot.log", filemode="w", format=logging_format, level=logging.INFO
+    )
+    # Structured per-request events go to their own file, one JSON object per line
+    metrics_handler = logging.FileHandler("metrics.log")
+    metrics_handler.setFormatter(logging.Formatter("%(message)s"))
+    metrics_logger = logging.getLogger("metrics")
+    metrics_logger.addHandler(metrics_handler)
+    metrics_logger.propagate = False
+
     # Load ini
     config = ConfigParser()
     config.read("config.ini")
@@ -32,6 +41,8 @@ def main():
         description="Bot hosted on Hayden's PC (and GPU) \n[https://github.com/Haydeni0/discord-stable-diffusion]",
         intents=intents,
     )
+    # Prefix commands (just txt2img, makeBotCommands(bot, debug=True) adds the debug commands)
+    makeBotCommands(bot)
 
     bot.run(DISCORD_TOKEN)
 
@@ -0,0 +1,125 @@
+import logging as lg
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+
+def normalizePrompt(text: str) -> str:
+    # The CLIP tokenizer collapses whitespace and lowercases, so texts differing only in those encode the same
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def _valueBytes(value) -> int:
+    if hasattr(value, "element_size"):
+        # torch.Tensor
+        return value.element_size() * value.nelement()
+    return getattr(value, "nbytes", 0)
+
+
+def modelId(t2i) -> str:
+    # Identifies the weights (and textual inversion embeddings) a text encoding came from
+    weights = getattr(t2i, "weights", None) or ""
+    try:
+        stat = os.stat(weights)
+        weights = f"{os.path.abspath(weights)}:{stat.st_size}:{stat.st_mtime_ns}"
+    except OSError:
+        pass
+    return (
+        f"{weights}|{getattr(t2i, 'embedding_path', None)}|"
+        f"full_precision={getattr(t2i, 'full_precision', None)}"
+    )
+
+
+class ConditioningCache:
+    # LRU cache of CLIP text encoder outputs, keyed by the model and the normalised text,
+    # so repeated prompts (seed variations, every job of a popular prompt, the empty unconditional prompt)
+    # skip the text encoder. Weighted prompts ("a cat:0.7 a dog:0.3") are encoded one subprompt at a time,
+    # so each subprompt is cached on its own and only the cheap weighted sum is redone.
+    # Entries stay on the model's device, capped at max_bytes in total. One cache can serve several models.
+    def __init__(self, max_bytes: int):
+        self.logger = lg.getLogger(__name__)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self), "bytes": self.bytes}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def get(self, model_id: str, text: str, encode: Callable):
+        # encode(text) unless text has been encoded before by the same model
+        key = (model_id, normalizePrompt(text))
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = encode(text)
+        size = _valueBytes(value)
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = value
+                self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= _valueBytes(evicted)
+        return value
+
+    def wrap(self, get_learned_conditioning: Callable, model_id: str) -> Callable:
+        # Cached version of a model's get_learned_conditioning. Only single texts are cached
+        # (which is how they are encoded for sampling), anything else is passed straight through.
+        # Callers get the cached tensor itself, which the samplers only ever read
+        def cached(c):
+            if isinstance(c, str):
+                return self.get(model_id, c, get_learned_conditioning)
+            if isinstance(c, (list, tuple)) and len(c) == 1 and isinstance(c[0], str):
+                return self.get(model_id, c[0], lambda text: get_learned_conditioning([text]))
+            return get_learned_conditioning(c)
+
+        cached.__wrapped__ = get_learned_conditioning
+        return cached
+
+    def install(self, t2i) -> bool:
+        # Put the cache in front of a loaded model's text encoder, False if it has none
+        model = getattr(t2i, "model", None)
+        get_learned_conditioning = getattr(model, "get_learned_conditioning", None)
+        if get_learned_conditioning is None:
+            return False
+        # Installing again replaces the old wrapper rather than stacking another on top
+        get_learned_conditioning = getattr(get_learned_conditioning, "__wrapped__", get_learned_conditioning)
+        model.get_learned_conditioning = self.wrap(get_learned_conditioning, modelId(t2i))
+        return True
+
+
+def installConditioningCache(t2i, max_bytes: int) -> Optional[ConditioningCache]:
+    # Put a conditioning cache in front of a loaded model (or every model of a ModelRegistry), returning it
+    # (or None if turned off, or there is no text encoder to cache)
+    if max_bytes <= 0:
+        return None
+    cache = ConditioningCache(max_bytes)
+    set_conditioning_cache = getattr(t2i, "set_conditioning_cache", None)
+    if set_conditioning_cache is not None:
+        set_conditioning_cache(cache)
+        return cache
+    return cache if cache.install(t2i) else None
@@ -0,0 +1,465 @@
+import asyncio
+import functools
+import logging as lg
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List, Optional, Set
+
+from metrics import (
+    BATCH_SIZE,
+    IMAGES_PER_SECOND,
+    IMAGES_TOTAL,
+    JOBS_TOTAL,
+    QUEUE_WAIT_SECONDS,
+    STEPS_PER_SECOND,
+    STEPS_TOTAL,
+)
+from rate_limit import UserRateLimiter
+from vram_model import isOutOfMemory
+
+# Cost of a job, in units of one 512x512 image with 50 steps
+STANDARD_JOB_COST = 50 * 512 * 512
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class GenerationCancelled(Exception):
+    # Raised from the sampler step callback to stop a cancelled job, and set on the cancelled job's future
+    pass
+
+
+class GenerationJob:
+    # A single txt2img request waiting for (or running on) the GPU worker
+    def __init__(
+        self,
+        kwargs: dict,
+        author: str,
+        batch_key: Optional[Hashable] = None,
+        step_callback: Optional[Callable] = None,
+        affinity: Optional[Hashable] = None,
+        journal_id: Optional[str] = None,
+    ):
+        self.kwargs = kwargs
+        self.author = author
+        # The job's id in the queue's journal, if it's being journaled
+        self.journal_id = journal_id
+        # Called from the worker thread with (latents, step) as sampling progresses
+        self.step_callback = step_callback
+        self.cancelled = False
+        # Jobs with equal (non-None) batch keys can be generated together in one batch
+        self.batch_key = batch_key
+        # What the job needs loaded (e.g. its model), jobs needing what's already loaded can go first
+        self.affinity = affinity
+        # Weighted fair queueing finish tag, set by the queue on submission
+        self.finish_tag = 0.0
+        self.future: Optional[asyncio.Future] = None
+        self.submit_time = time.time()
+        self.start_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        # Peak GPU memory while this job was generating, if known
+        self.peak_vram: Optional[int] = None
+
+    def on_step(self, samples, step: int):
+        # Sampler step callback (called from the worker thread), stops the sampler at the next step if cancelled
+        if self.cancelled:
+            raise GenerationCancelled()
+        if self.step_callback is not None:
+            self.step_callback(samples, step)
+
+    @property
+    def num_images(self) -> int:
+        return self.kwargs.get("iterations") or 1
+
+    @property
+    def num_pixels(self) -> int:
+        return self.kwargs["width"] * self.kwargs["height"] * self.num_images
+
+    @property
+    def cost(self) -> float:
+        # Rough amount of GPU time needed, relative to a standard 512x512 50 step image
+        steps = self.kwargs["steps"]
+        if self.kwargs.get("init_img"):
+            # img2img only runs the last strength of the steps
+            steps *= self.kwargs.get("strength") or 1.0
+        return self.num_pixels * steps / STANDARD_JOB_COST
+
+    @property
+    def outcome(self) -> str:
+        if self.cancelled:
+            return "cancelled"
+        if self.future is None or not self.future.done() or self.future.exception() is not None:
+            return "failed"
+        return "done"
+
+    @property
+    def wait_time(self) -> float:
+        start = self.start_time if self.start_time is not None else time.time()
+        return start - self.submit_time
+
+    @property
+    def run_time(self) -> float:
+        if self.start_time is None:
+            return 0.0
+        end = self.end_time if self.end_time is not None else time.time()
+        return end - self.start_time
+
+
+class GenerationQueue:
+    # A bounded queue of generation jobs, drained by one dedicated worker thread
+    # that owns the model. Only one batch runs at a time so the GPU is never working on two at once,
+    # and the event loop stays free to handle discord traffic while sampling.
+    # With a pool of model processes (see worker_pool.py), concurrency batches run at once instead,
+    # each from its own worker thread.
+    #
+    # generate_fn(job) runs a single job and returns a list of (image, seed).
+    # batch_fn(jobs) runs several compatible jobs at once and returns one such list per job.
+    # batch_fits(jobs), if given, says whether jobs would fit in GPU memory as one batch.
+    #
+    # Jobs aren't run first come first served, but by weighted fair queueing on the job author,
+    # so one user submitting lots of expensive jobs can't hold up everyone else.
+    # To avoid needless model switches, a job with the same affinity as the last batch can jump ahead of
+    # jobs due up to affinity_slack (in standard job cost) before it.
+    #
+    # With a journal (job_journal.JobJournal), jobs with a journal_id have their progress recorded in it
+    # (started, then generated, failed or cancelled).
+    #
+    # With a speculator (speculation.Speculator), whenever there's nothing else to do the worker runs
+    # speculator.next_job() and hands its results (None if it didn't finish) to speculator.done(job, results).
+    # A job submitted meanwhile preempts the speculative job at its next sampling step.
+    def __init__(
+        self,
+        generate_fn: Callable[[GenerationJob], list],
+        batch_fn: Optional[Callable[[List[GenerationJob]], List[list]]] = None,
+        maxsize: int = 20,
+        max_batch_images: int = 4,
+        max_batch_pixels: int = 4 * 512 * 512,
+        rate_limiter: Optional[UserRateLimiter] = None,
+        user_weights: Optional[Dict[str, float]] = None,
+        ready: bool = True,
+        concurrency: int = 1,
+        batch_fits: Optional[Callable[[List[GenerationJob]], bool]] = None,
+        affinity_slack: float = 0.0,
+        journal=None,
+        speculator=None,
+    ):
+        self.logger = lg.getLogger(__name__)
+        self.generate_fn = generate_fn
+        self.batch_fn = batch_fn
+        self.maxsize = maxsize
+        self.max_batch_images = max_batch_images
+        self.max_batch_pixels = max_batch_pixels
+        self.rate_limiter = rate_limiter
+        self.user_weights = user_weights or {}
+        self.concurrency = concurrency
+        self.batch_fits = batch_fits
+        self.affinity_slack = affinity_slack
+        self.journal = journal
+        self.speculator = speculator
+        self._speculative: Optional[GenerationJob] = None
+        self._last_affinity: Optional[Hashable] = None
+        # Running average of how long a unit of job cost takes to generate, for wait time estimates
+        self.seconds_per_cost = 5.0
+        self.current_jobs: List[GenerationJob] = []
+        self._virtual_time = 0.0
+        self._last_finish_tag: Dict[str, float] = {}
+        self._pending: List[GenerationJob] = []
+        self._not_empty = asyncio.Event()
+        # Jobs can be queued before the model is ready, but none start until it is
+        self._ready = asyncio.Event()
+        if ready:
+            self._ready.set()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="sd-worker")
+        self._worker_task: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+
+    @property
+    def in_progress(self) -> bool:
+        return len(self.current_jobs) > 0
+
+    def __len__(self):
+        # Number of jobs waiting, not including the ones currently running
+        return len(self._pending)
+
+    def estimated_wait(self, job: Optional[GenerationJob] = None) -> float:
+        # Estimated seconds until the given queued job starts (or until the whole queue is done)
+        pending_cost = sum(
+            other.cost
+            for other in self._pending
+            if job is None or (other.finish_tag <= job.finish_tag and other is not job)
+        )
+        running_cost = sum(other.cost for other in self.current_jobs)
+        running_time = max((other.run_time for other in self.current_jobs), default=0.0)
+        remaining = max(0.0, running_cost * self.seconds_per_cost - running_time)
+        # seconds_per_cost is measured per batch, and concurrency batches run side by side
+        return (remaining + pending_cost * self.seconds_per_cost) / self.concurrency
+
+    def submit(self, job: GenerationJob) -> int:
+        # Add a job to the queue, returning the number of jobs ahead of it.
+        # The result (list of (image, seed) tuples) is delivered through job.future.
+        # Raises QueueFullError or RateLimitError if the job is rejected
+        if len(self._pending) >= self.maxsize:
+            raise QueueFullError(
+                f"queue is full ({self.maxsize} jobs waiting, "
+                f"estimated wait {self.estimated_wait():.0f}s)"
+            )
+        if self.rate_limiter is not None:
+            self.rate_limiter.take(job.author, job.cost)
+
+        # Each user's jobs are spaced out in virtual time by their cost (divided by the user's weight),
+        # and the job with the earliest finish tag runs next
+        weight = self.user_weights.get(job.author, 1.0)
+        start_tag = max(self._virtual_time, self._last_finish_tag.get(job.author, 0.0))
+        job.finish_tag = start_tag + job.cost / weight
+        self._last_finish_tag[job.author] = job.finish_tag
+
+        self._ensure_worker()
+        job.future = asyncio.get_running_loop().create_future()
+        self._pending.append(job)
+        self._not_empty.set()
+        if self._speculative is not None:
+            self._speculative.cancelled = True
+        return self.jobs_ahead(job)
+
+    def set_ready(self):
+        self._ready.set()
+
+    def cancel(self, job: GenerationJob) -> bool:
+        # Cancel a queued or running job, returning False if it had already finished.
+        # A queued job is just removed, a running job stops at its next sampling step
+        if job.future is None or job.future.done():
+            return False
+        job.cancelled = True
+        if job in self._pending:
+            self._pending.remove(job)
+        job.future.set_exception(GenerationCancelled())
+        self._journal(job, "cancelled")
+        self.logger.info(f"Cancelled job from {job.author}")
+        return True
+
+    def jobs_for(self, author: str) -> List[GenerationJob]:
+        # Queued and running jobs from a user, oldest first
+        jobs = [job for job in self.current_jobs + self._pending if job.author == author]
+        return [job for job in jobs if not job.future.done()]
+
+    def jobs_ahead(self, job: GenerationJob) -> int:
+        # Number of jobs that will start before this one (including any currently running)
+        ahead = sum(
+            1 for other in self._pending if other.finish_tag <= job.finish_tag and other is not job
+        )
+        return ahead + int(len(self._running) >= self.concurrency)
+
+    async def run_on_worker(self, fn: Callable, *args, **kwargs):
+        # Run an arbitrary function on the worker thread (e.g. anything touching the model)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    def _ensure_worker(self):
+        if self._worker_task is None or self._worker_task.done():
+            self._worker_task = asyncio.get_running_loop().create_task(self._worker())
+
+    async def _worker(self):
+        await self._ready.wait()
+        while True:
+            while not self._pending:
+                self._not_empty.clear()
+                self._speculate()
+                await self._not_empty.wait()
+            if len(self._running) >= self.concurrency:
+                await asyncio.wait(set(self._running), return_when=asyncio.FIRST_COMPLETED)
+                continue
+            # Skip anything cancelled while waiting in the queue
+            batch = [job for job in self._next_batch() if not job.future.done()]
+            if batch:
+                task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+                if self.speculator is not None:
+                    # Wake the worker up to speculate once the batch is done, if nothing else comes in
+                    task.add_done_callback(lambda _: self._not_empty.set())
+
+    def _speculate(self):
+        # Start a speculative job if the GPU would otherwise be idle
+        if self.speculator is None or self._speculative is not None or self._running:
+            return
+        job = self.speculator.next_job()
+        if job is not None:
+            self._speculative = job
+            asyncio.get_running_loop().create_task(self._run_speculative(job))
+
+    async def _run_speculative(self, job: GenerationJob):
+        job.start_time = time.time()
+        results = None
+        try:
+            results = await self.run_on_worker(self.generate_fn, job)
+        except GenerationCancelled:
+            self.logger.info("Preempted speculative job")
+        except Exception:
+            self.logger.exception("Speculative generation failed")
+        finally:
+            job.end_time = time.time()
+            self._speculative = None
+            self.speculator.done(job, results)
+            # Back to the worker, for the job that preempted this one or the next speculative job
+            self._not_empty.set()
+
+    def _next_batch(self) -> List[GenerationJob]:
+        # Take the job with the earliest finish tag, along with any other jobs that can share its batch,
+        # as long as the batch stays within the image count and pixel budget, and fits in VRAM
+        first = min(self._pending, key=lambda job: job.finish_tag)
+        if self.affinity_slack > 0 and first.affinity != self._last_affinity:
+            same = [
+                job
+                for job in self._pending
+                if job.affinity == self._last_affinity
+                and job.finish_tag <= first.finish_tag + self.affinity_slack
+            ]
+            if same:
+                first = min(same, key=lambda job: job.finish_tag)
+        self._last_affinity = first.affinity
+        self._pending.remove(first)
+        self._advance_virtual_time(first.finish_tag)
+        batch = [first]
+        if first.batch_key is None or self.batch_fn is None:
+            return batch
+
+        num_images = first.num_images
+        num_pixels = first.num_pixels
+        for job in sorted(self._pending, key=lambda job: job.finish_tag):
+            if job.batch_key != first.batch_key:
+                continue
+            if num_images + job.num_images > self.max_batch_images:
+                continue
+            if num_pixels + job.num_pixels > self.max_batch_pixels:
+                continue
+            if self.batch_fits is not None and not self.batch_fits(batch + [job]):
+                continue
+            num_images += job.num_images
+            num_pixels += job.num_pixels
+            batch.append(job)
+            self._pending.remove(job)
+        return batch
+
+    def _journal(self, job: GenerationJob, state: str):
+        if self.journal is not None:
+            self.journal.record(job.journal_id, state)
+
+    def _advance_virtual_time(self, finish_tag: float):
+        # Self-clocked: virtual time is the finish tag of the job most recently started
+        self._virtual_time = max(self._virtual_time, finish_tag)
+        # Users with no jobs finishing after this point start afresh from the virtual time anyway
+        idle_users = [
+            user for user, tag in self._last_finish_tag.items() if tag <= self._virtual_time
+        ]
+        for user in idle_users:
+            del self._last_finish_tag[user]
+
+    async def _run_batch(self, batch: List[GenerationJob]):
+        self.current_jobs.extend(batch)
+        authors = ", ".join(job.author for job in batch)
+        self.logger.info(
+            f"Starting batch of {len(batch)} job(s) from {authors} "
+            f"(waited {batch[0].wait_time:.1f}s, {len(self)} in queue)"
+        )
+        BATCH_SIZE.observe(len(batch))
+        for job in batch:
+            QUEUE_WAIT_SECONDS.observe(job.wait_time)
+            self._journal(job, "started")
+        tic = time.time()
+        try:
+            await self._run_jobs(batch)
+        finally:
+            for job in batch:
+                self.current_jobs.remove(job)
+                if job.outcome != "cancelled":
+                    self._journal(job, "generated" if job.outcome == "done" else "failed")
+
+        elapsed = time.time() - tic
+        done = [job for job in batch if job.outcome == "done"]
+        for job in batch:
+            JOBS_TOTAL.inc(outcome=job.outcome)
+        num_images = sum(job.num_images for job in done)
+        num_steps = sum(job.num_images * job.kwargs["steps"] for job in done)
+        IMAGES_TOTAL.inc(num_images)
+        STEPS_TOTAL.inc(num_steps)
+        if done and elapsed > 0:
+            IMAGES_PER_SECOND.set(num_images / elapsed)
+            STEPS_PER_SECOND.set(num_steps / elapsed)
+
+        # Update the running average generation speed
+        batch_cost = sum(job.cost for job in done)
+        if batch_cost > 0:
+            observed = elapsed / batch_cost
+            self.seconds_per_cost = 0.8 * self.seconds_per_cost + 0.2 * observed
+
+    async def _run_jobs(self, batch: List[GenerationJob]):
+        # Run the jobs as one batch (as is a lone job of several images, when it can be). If that runs out
+        # of VRAM, retry in two smaller batches (down to one job at a time), and after any other error
+        # fall back to running the jobs one at a time
+        batch = [job for job in batch if not job.future.done()]
+        if not batch:
+            return
+        if len(batch) == 1 and not self._samples_together(batch[0]):
+            await self._run_single(batch[0])
+            return
+        error = await self._run_batched(batch)
+        if error is None:
+            return
+        if isOutOfMemory(error) and len(batch) > 1:
+            self.logger.warning(f"Out of VRAM with a batch of {len(batch)} jobs, splitting it")
+            half = len(batch) // 2
+            await self._run_jobs(batch[:half])
+            await self._run_jobs(batch[half:])
+        else:
+            self.logger.error("Batched generation failed, running jobs individually")
+            for job in batch:
+                await self._run_single(job)
+
+    def _samples_together(self, job: GenerationJob) -> bool:
+        # Whether a job of several images on its own goes through batch_fn, sampling all of its images at once
+        # (prompt2image would sample them one after another), within the same limits as any other batch
+        return (
+            self.batch_fn is not None
+            and job.batch_key is not None
+            and 1 < job.num_images <= self.max_batch_images
+            and job.num_pixels <= self.max_batch_pixels
+            and (self.batch_fits is None or self.batch_fits([job]))
+        )
+
+    async def _run_batched(self, batch: List[GenerationJob]) -> Optional[Exception]:
+        # Returns the error if the batch failed
+        for job in batch:
+            job.start_time = time.time()
+        try:
+            results = await self.run_on_worker(self.batch_fn, batch)
+        except GenerationCancelled:
+            # Every job in the batch was cancelled
+            self.logger.info("Stopped cancelled batch")
+            return None
+        except Exception as e:
+            self.logger.exception("Batched generation failed")
+            return e
+        for job, result in zip(batch, results):
+            job.end_time = time.time()
+            if not job.future.done():
+                job.future.set_result(result)
+        return None
+
+    async def _run_single(self, job: GenerationJob):
+        job.start_time = time.time()
+        try:
+            result = await self.run_on_worker(self.generate_fn, job)
+        except GenerationCancelled:
+            self.logger.info(f"Stopped cancelled job from {job.author}")
+        except Exception as e:
+            self.logger.exception(f"Generation failed for job from {job.author}")
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            job.end_time = time.time()
@@ -0,0 +1,200 @@
+import shlex
+from typing import Optional
+
+# Most images in one request
+MAX_IMAGES = 10
+
+
+class RequestError(ValueError):
+    # A request that can't be generated, with a message for the user
+    pass
+
+
+class GenerationRequest:
+    # One generation request, built straight from a slash command's options, a prefix command's text
+    # (see parseRequest) or a button, rather than writing out dream.py command line options and parsing
+    # them again for every request. Values are checked and normalised once, on construction: whitespace in
+    # the prompt collapsed, sizes rounded down to multiples of 64 (as Generate would), numbers of the right type.
+    # Requests are immutable (replace() makes a changed copy), compare and hash by value,
+    # and to_kwargs() gives the arguments for prompt2image.
+    __slots__ = (
+        "prompt",
+        "iterations",
+        "width",
+        "height",
+        "cfg_scale",
+        "seed",
+        "steps",
+        "init_img",
+        "strength",
+        "sampler_name",
+        "model",
+        "profile",
+    )
+
+    def __init__(
+        self,
+        prompt: str,
+        iterations: int = 1,
+        width: int = 512,
+        height: int = 512,
+        cfg_scale: float = 7.5,
+        seed: Optional[int] = None,
+        steps: int = 50,
+        init_img: Optional[str] = None,
+        strength: float = 0.75,
+        sampler_name: Optional[str] = None,
+        model: Optional[str] = None,
+        profile: Optional[str] = None,
+    ):
+        try:
+            prompt = " ".join(str(prompt).split())
+            iterations = int(iterations)
+            width, height = int(width), int(height)
+            cfg_scale = float(cfg_scale)
+            seed = None if seed is None else int(seed)
+            steps = int(steps)
+            strength = float(strength)
+        except (TypeError, ValueError) as e:
+            raise RequestError(f"invalid value ({e})") from e
+        if not prompt:
+            raise RequestError("the prompt is empty")
+        if not (1 <= iterations <= MAX_IMAGES):
+            raise RequestError(f"n = {iterations} (n must be between 1 and {MAX_IMAGES}, inclusive)")
+        if width < 64 or height < 64:
+            raise RequestError(f"{width}x{height} is too small (width and height must be at least 64)")
+        if cfg_scale <= 0:
+            raise RequestError(f"cfg_scale = {cfg_scale} (cfg_scale must be positive)")
+        if seed is not None and not (0 <= seed < 2**32):
+            raise RequestError(f"seed = {seed} (seed must be between 0 and {2**32 - 1})")
+        if steps < 1:
+            raise RequestError(f"steps = {steps} (steps must be at least 1)")
+        if not (0 < strength < 1):
+            raise RequestError(f"strength = {strength} (strength must be between 0 and 1)")
+        values = (
+            prompt,
+            iterations,
+            width - width % 64,
+            height - height % 64,
+            cfg_scale,
+            seed,
+            steps,
+            init_img or None,
+            strength,
+            sampler_name or None,
+            model or None,
+            profile or None,
+        )
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_kwargs(cls, kwargs: dict) -> "GenerationRequest":
+        # The request behind a job's prompt2image arguments (anything else in kwargs is ignored)
+        return cls(**{name: kwargs[name] for name in cls.__slots__ if name in kwargs})
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable, use replace()")
+
+    def _values(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, GenerationRequest):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __hash__(self) -> int:
+        return hash(self._values())
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+    def __getstate__(self) -> dict:
+        return self.to_kwargs()
+
+    def __setstate__(self, state: dict):
+        for name in self.__slots__:
+            object.__setattr__(self, name, state.get(name))
+
+    def replace(self, **changes) -> "GenerationRequest":
+        return type(self)(**dict(self.to_kwargs(), **changes))
+
+    def key(self) -> tuple:
+        # Canonical key for what the request generates for a given seed: everything but the seed and
+        # number of images (and the strength, which only matters for img2img)
+        return (
+            self.prompt,
+            self.width,
+            self.height,
+            self.cfg_scale,
+            self.steps,
+            self.sampler_name,
+            self.model,
+            self.profile,
+            self.init_img,
+            self.strength if self.init_img is not None else None,
+        )
+
+    @property
+    def num_pixels(self) -> int:
+        return self.width * self.height
+
+    def to_kwargs(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+# The dream.py prompt options parseRequest understands, and the request fields they set.
+# Init images (-I) can only be given by url, through the slash command
+_FLAGS = {
+    "-n": "iterations",
+    "--iterations": "iterations",
+    "-W": "width",
+    "--width": "width",
+    "-H": "height",
+    "--height": "height",
+    "-C": "cfg_scale",
+    "--cfg_scale": "cfg_scale",
+    "-S": "seed",
+    "--seed": "seed",
+    "-s": "steps",
+    "--steps": "steps",
+    "-A": "sampler_name",
+    "--sampler": "sampler_name",
+    "-m": "model",
+    "--model": "model",
+    "--profile": "profile",
+}
+
+
+def parseRequest(text: str, **defaults) -> GenerationRequest:
+    # A request from dream.py style text, e.g. "a castle on a hill -n2 -W 768 --seed=42".
+    # defaults are used for anything the text doesn't set. Raises RequestError if it can't be parsed
+    try:
+        tokens = shlex.split(text)
+    except ValueError:
+        # Unbalanced quotes, most likely an apostrophe in the prompt
+        tokens = text.split()
+    fields = dict(defaults)
+    words = []
+    k = 0
+    while k < len(tokens):
+        token = tokens[k]
+        k += 1
+        if not token.startswith("-") or len(token) < 2 or token[1].isdigit():
+            words.append(token)
+            continue
+        if token.startswith("--"):
+            flag, _, value = token.partition("=")
+        else:
+            flag, value = token[:2], token[2:]
+        if flag not in _FLAGS:
+            raise RequestError(f"unknown option {flag}")
+        if not value:
+            if k == len(tokens):
+                raise RequestError(f"option {flag} needs a value")
+            value = tokens[k]
+            k += 1
+        fields[_FLAGS[flag]] = value
+    return GenerationRequest(" ".join(words), **fields)
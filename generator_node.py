@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# A remote generator node: loads the model on this machine and takes txt2img jobs from the bot
+# over HTTP (see remote_workers.py), so more GPUs can be added without running more bots. Run with
+#   python generator_node.py --server http://<bot host>:9130 --token <remote_token> --device cuda:0
+# with a --model name=weights[,config] for each model it should serve (the names as in the bot's config.ini).
+# Any other arguments are passed on to the stable diffusion (dream.py) argument parser.
+import argparse
+import base64
+import json
+import logging as lg
+import os
+import platform
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import requests
+from PIL import Image
+
+from conditioning_cache import installConditioningCache
+from generation_queue import GenerationCancelled
+from model_loader import WEIGHTS, peakVram, resetPeakVram
+from model_registry import DEFAULT_MODEL, createModelRegistry, parseModelSpec
+
+
+def localPayload(payload: list, directory: str) -> list:
+    # A lease's arguments, with any init images sent along with it written to files in directory
+    local = []
+    for index, kwargs in enumerate(payload):
+        kwargs = dict(kwargs)
+        data = kwargs.pop("init_img_data", None)
+        if data is not None:
+            path = os.path.join(directory, f"init_{index}.png")
+            with open(path, "wb") as f:
+                f.write(base64.b64decode(data))
+            kwargs["init_img"] = path
+        local.append(kwargs)
+    return local
+
+
+class GeneratorNode:
+    def __init__(
+        self,
+        server: str,
+        t2i,
+        capabilities: dict,
+        name: str,
+        token: str = "",
+        conditioning_cache=None,
+    ):
+        self.logger = lg.getLogger(__name__)
+        self.server = server.rstrip("/")
+        self.t2i = t2i
+        self.conditioning_cache = conditioning_cache
+        self.capabilities = capabilities
+        self.name = name
+        self.headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self.node_id = None
+        self.heartbeat_interval = 2.0
+        # Leases the server has asked us to stop, and whether the server has forgotten this node
+        self._cancelled = set()
+        self._forgotten = False
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        # Images are encoded and uploaded on their own thread while sampling carries on
+        self._uploads = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload")
+
+    def _post(self, path: str, session=None, timeout: float = 30, **kwargs) -> requests.Response:
+        return (session or self._session).post(
+            self.server + path, headers=self.headers, timeout=timeout, **kwargs
+        )
+
+    def register(self):
+        while True:
+            try:
+                response = self._post(
+                    "/nodes", json={"name": self.name, "capabilities": self.capabilities}
+                )
+                response.raise_for_status()
+                break
+            except requests.RequestException as e:
+                self.logger.warning(f"Could not register with {self.server} ({e}), retrying")
+                time.sleep(5)
+        data = response.json()
+        with self._lock:
+            self.node_id = data["node"]
+            self._forgotten = False
+        self.heartbeat_interval = data["heartbeat_interval"]
+        self.logger.info(f"Registered with {self.server} as {self.node_id}")
+
+    def run(self):
+        self.register()
+        threading.Thread(target=self._heartbeat, name="heartbeat", daemon=True).start()
+        while True:
+            if self._forgotten:
+                self.register()
+            try:
+                response = self._post(f"/nodes/{self.node_id}/lease", timeout=60)
+            except requests.RequestException as e:
+                self.logger.warning(f"Could not get a job ({e}), retrying")
+                time.sleep(5)
+                continue
+            if response.status_code == 404:
+                self._forgotten = True
+            elif response.status_code == 200:
+                self._runLease(response.json())
+
+    def _heartbeat(self):
+        session = requests.Session()
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                response = self._post(f"/nodes/{self.node_id}/heartbeat", session=session, timeout=10)
+            except requests.RequestException as e:
+                self.logger.warning(f"Heartbeat failed ({e})")
+                continue
+            with self._lock:
+                if response.status_code == 404:
+                    self._forgotten = True
+                elif response.ok:
+                    self._cancelled.update(response.json()["cancel"])
+
+    def _uploadImage(self, lease: str, index: int, image: Image.Image, seed: int):
+        buffer = BytesIO()
+        image.save(buffer, "PNG", compress_level=1)
+        response = self._post(
+            f"/leases/{lease}/images",
+            params={"index": index, "seed": seed},
+            data=buffer.getvalue(),
+        )
+        response.raise_for_status()
+
+    def _runLease(self, data: dict):
+        # Init images sent with the lease only need to last as long as the job
+        with tempfile.TemporaryDirectory(prefix="lease-") as directory:
+            try:
+                payload = localPayload(data["payload"], directory)
+            except (OSError, ValueError):
+                self.logger.exception(f"Could not write the init images of job {data['lease']}")
+                self._reportFailure(data["lease"], error=traceback.format_exc())
+                return
+            self._runJob(data["lease"], data["kind"], payload)
+
+    def _runJob(self, lease: str, kind: str, payload: list):
+        uploads = [[] for _ in payload]
+
+        def upload(index, image, seed):
+            uploads[index].append(self._uploads.submit(self._uploadImage, lease, index, image, seed))
+
+        def on_step(samples, step):
+            with self._lock:
+                stopped = lease in self._cancelled or self._forgotten
+            if stopped:
+                raise GenerationCancelled()
+
+        self.logger.info(f"Running {kind} job {lease} ({len(payload)} request(s))")
+        resetPeakVram()
+        try:
+            if kind == "single":
+                # Stream each image back as soon as it's made
+                results = self.t2i.prompt2image(
+                    image_callback=lambda image, seed, *args, **kwargs: upload(0, image, seed),
+                    step_callback=on_step,
+                    **payload[0],
+                )
+                # Any images the model didn't pass to image_callback are sent at the end
+                results = [[] if uploads[0] else results]
+            else:
+                generate_batch = getattr(self.t2i, "generate_batch", None)
+                if generate_batch is None:
+                    from batch_generate import generateBatch
+
+                    results = generateBatch(self.t2i, payload, [on_step] * len(payload))
+                else:
+                    results = generate_batch(payload, [on_step] * len(payload))
+            for index, job_results in enumerate(results):
+                for image, seed in job_results:
+                    upload(index, image, seed)
+            for job_uploads in uploads:
+                for future in job_uploads:
+                    future.result()
+            cache = self.conditioning_cache
+            self._post(
+                f"/leases/{lease}/complete",
+                json={
+                    "counts": [len(job_uploads) for job_uploads in uploads],
+                    "peak_vram": peakVram(),
+                    "conditioning_cache": None if cache is None else cache.stats(),
+                },
+            )
+        except GenerationCancelled:
+            peakVram(stopped=True)
+            self.logger.info(f"Stopped job {lease}")
+            self._reportFailure(lease, cancelled=True)
+        except Exception:
+            peakVram(stopped=True)
+            self.logger.exception(f"Job {lease} failed")
+            self._reportFailure(lease, error=traceback.format_exc())
+        finally:
+            with self._lock:
+                self._cancelled.discard(lease)
+
+    def _reportFailure(self, lease: str, cancelled: bool = False, error: str = ""):
+        try:
+            self._post(f"/leases/{lease}/fail", json={"cancelled": cancelled, "error": error})
+        except requests.RequestException:
+            # The lease will expire and the job will be given to another node
+            self.logger.warning(f"Could not report the failure of job {lease}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Remote generator node for the discord bot")
+    parser.add_argument("--server", required=True, help="URL of the bot's remote worker endpoint")
+    parser.add_argument("--token", default="", help="remote_token from the bot's config.ini")
+    parser.add_argument("--device", default=None, help="Device to run the model on, e.g. cuda:1")
+    parser.add_argument("--name", default=platform.node())
+    parser.add_argument("--max-pixels", type=int, default=1280**2, help="Largest image (width*height)")
+    parser.add_argument(
+        "--max-batch-pixels", type=int, default=4 * 512 * 512, help="Largest batch (width*height*n)"
+    )
+    parser.add_argument("--no-batch", action="store_true", help="Only take single jobs")
+    parser.add_argument(
+        "--model",
+        action="append",
+        default=[],
+        metavar="NAME=WEIGHTS[,CONFIG]",
+        help=f"A model to serve, can be repeated [default: {DEFAULT_MODEL}={WEIGHTS}]",
+    )
+    parser.add_argument("--resident-models", type=int, default=1, help="Models kept on the GPU")
+    parser.add_argument("--parked-models", type=int, default=1, help="More models kept in CPU RAM")
+    parser.add_argument(
+        "--conditioning-cache-mb", type=int, default=64, help="Memory for cached prompt encodings (0 for none)"
+    )
+    parser.add_argument(
+        "--stub", default=None, metavar="JSON", help="Run a stub model with these options, for testing"
+    )
+    args, dream_argv = parser.parse_known_args()
+    lg.basicConfig(format="[%(asctime)s] %(name)s:%(levelname)s %(message)s", level=lg.INFO)
+
+    specs = [parseModelSpec(*model.split("=", 1)) for model in args.model]
+    if not specs:
+        specs = [parseModelSpec(DEFAULT_MODEL, WEIGHTS)]
+    if args.stub is not None:
+        from benchmarks.stub_generate import createStubRegistry
+
+        t2i = createStubRegistry(
+            json.loads(args.stub),
+            specs,
+            max_resident=args.resident_models,
+            max_parked=args.parked_models,
+        )
+    else:
+        from lstein_stable_diffusion.scripts.dream import create_argv_parser
+
+        opt = create_argv_parser().parse_args(dream_argv)
+        t2i = createModelRegistry(
+            vars(opt),
+            specs,
+            args.device,
+            max_resident=args.resident_models,
+            max_parked=args.parked_models,
+        )
+    t2i.load_model()
+    conditioning_cache = installConditioningCache(t2i, args.conditioning_cache_mb * 2**20)
+
+    capabilities = {
+        "max_pixels": args.max_pixels,
+        "max_batch_pixels": args.max_batch_pixels,
+        "batch": not args.no_batch,
+        "models": t2i.names,
+    }
+    try:
+        import torch
+
+        if torch.cuda.is_available():
+            device = torch.device(args.device or "cuda")
+            capabilities["vram"] = torch.cuda.get_device_properties(device).total_memory
+    except ImportError:
+        pass
+
+    GeneratorNode(
+        args.server, t2i, capabilities, args.name, token=args.token, conditioning_cache=conditioning_cache
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
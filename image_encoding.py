@@ -0,0 +1,134 @@
+import asyncio
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import List, Optional, Union
+
+from PIL import Image, ImageDraw, features
+
+# Discord upload limit (8MB, to be safe use 8 million bytes rather than 8MiB)
+DISCORD_SIZE_LIMIT = 8_000_000
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+class EncodedImage:
+    # Encoded image bytes ready to be uploaded (None if the image can't be made small enough),
+    # along with the lossless PNG to keep on disk
+    def __init__(
+        self, data: Optional[bytes], format: str, quality: Optional[int] = None, png: Optional[bytes] = None
+    ):
+        self.data = data
+        self.format = format
+        # JPEG quality if the image had to be reduced to fit under the size limit
+        self.quality = quality
+        self.png = data if png is None else png
+
+    @property
+    def extension(self) -> str:
+        return {"JPEG": "jpeg", "WEBP": "webp"}.get(self.format, "png")
+
+    @property
+    def reduced(self) -> bool:
+        return self.format != "PNG"
+
+    @property
+    def sendable(self) -> bool:
+        return self.data is not None
+
+    def __len__(self):
+        return 0 if self.data is None else len(self.data)
+
+
+def _encode(img: Image.Image, format: str, **kwargs) -> bytes:
+    buffer = BytesIO()
+    img.save(buffer, format=format, **kwargs)
+    return buffer.getvalue()
+
+
+def encodeImage(
+    source: Union[Image.Image, str],
+    size_limit: int = DISCORD_SIZE_LIMIT,
+) -> EncodedImage:
+    # Encode an image as PNG once, keeping those bytes for saving to disk and reusing them for the upload.
+    # The source can also be the path of an existing PNG, which is only decoded if it's too large to upload.
+    # If the PNG is over size_limit, binary search for the highest JPEG quality under the limit,
+    # with nothing to upload if even the lowest quality doesn't fit.
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            png = f.read()
+        img = None
+    else:
+        img = source
+        png = _encode(img, "PNG")
+
+    if len(png) <= size_limit:
+        return EncodedImage(png, "PNG")
+
+    if img is None:
+        img = Image.open(BytesIO(png))
+    img = img.convert("RGB")
+    best = EncodedImage(None, "JPEG", png=png)
+    lo, hi = 1, 95
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        jpeg = _encode(img, "JPEG", quality=quality)
+        if len(jpeg) <= size_limit:
+            best = EncodedImage(jpeg, "JPEG", quality, png=png)
+            lo = quality + 1
+        else:
+            hi = quality - 1
+    return best
+
+
+def encodeGridImage(pngs: List[bytes], cell_size: int = 384, quality: int = 80) -> EncodedImage:
+    # One compact preview of several images: each shrunk to fit a cell_size square and numbered
+    # (matching the buttons that send it at full size), in a grid as close to square as possible,
+    # encoded lossily as WebP (or JPEG if Pillow was built without WebP)
+    images = [Image.open(BytesIO(png)).convert("RGB") for png in pngs]
+    for img in images:
+        img.thumbnail((cell_size, cell_size), Image.LANCZOS)
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    cell_width = max(img.width for img in images)
+    cell_height = max(img.height for img in images)
+    grid = Image.new("RGB", (columns * cell_width, rows * cell_height))
+    draw = ImageDraw.Draw(grid)
+    for k, img in enumerate(images):
+        x, y = (k % columns) * cell_width, (k // columns) * cell_height
+        grid.paste(img, (x, y))
+        draw.rectangle((x, y, x + 20, y + 16), fill=(0, 0, 0))
+        draw.text((x + 6, y + 2), str(k + 1), fill=(255, 255, 255))
+    format = "WEBP" if features.check("webp") else "JPEG"
+    return EncodedImage(_encode(grid, format, quality=quality), format, quality)
+
+
+def _getPool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Spawned rather than forked: forking the bot would copy its event loop, threads and locks
+        # (and with them the model's CUDA state) into every encoder process
+        _pool = ProcessPoolExecutor(
+            max_workers=min(4, os.cpu_count() or 1), mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+
+async def encodeImages(
+    sources: List[Union[Image.Image, str]],
+    size_limit: int = DISCORD_SIZE_LIMIT,
+) -> List[EncodedImage]:
+    # Encode several images in parallel in a process pool, off the event loop
+    loop = asyncio.get_running_loop()
+    pool = _getPool()
+    return await asyncio.gather(
+        *[loop.run_in_executor(pool, encodeImage, source, size_limit) for source in sources]
+    )
+
+
+async def encodeGrid(pngs: List[bytes], cell_size: int = 384, quality: int = 80) -> EncodedImage:
+    # encodeGridImage in the process pool, off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_getPool(), encodeGridImage, pngs, cell_size, quality)
@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import logging as lg
+import os
+import time
+from collections import OrderedDict
+from io import BytesIO
+from typing import Optional
+
+import aiohttp
+from PIL import Image
+
+from utils import resizeImage, run_in_executor
+
+
+class ImageFetchError(Exception):
+    pass
+
+
+@run_in_executor
+def _decodeResizeSave(data: bytes, resize_num_pixels: Optional[int], save_path: str):
+    img = Image.open(BytesIO(data))
+    img.load()
+    if resize_num_pixels is not None:
+        img = resizeImage(img, resize_num_pixels)
+    img.save(save_path, "PNG")
+
+
+@run_in_executor
+def _readFile(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class ImageFetcher:
+    # Downloads init images for img2img through one pooled HTTP session, with timeouts and a size cap.
+    # Decoding and resizing happen in an executor, and results are cached on disk:
+    # by url (so the same discord attachment isn't downloaded twice) and by content hash and size
+    # (so the same image from a different url isn't resized twice), evicting the least recently used.
+    def __init__(
+        self,
+        download_path: str,
+        max_bytes: int = 20_000_000,
+        timeout: float = 30.0,
+        max_entries: int = 200,
+        url_ttl: float = 3600.0,
+    ):
+        self.logger = lg.getLogger(__name__)
+        self.download_path = download_path
+        self.max_bytes = max_bytes
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=10)
+        self.max_entries = max_entries
+        self.url_ttl = url_ttl
+        self.hits = 0
+        self.misses = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+        # url -> (content hash, time fetched)
+        self._url_hashes: OrderedDict = OrderedDict()
+        # (content hash, resize_num_pixels) -> saved file path
+        self._files: OrderedDict = OrderedDict()
+        # Requests for the same url already in flight
+        self._in_flight = {}
+
+    def _getSession(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit=8, ttl_dns_cache=300),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def fetch(self, url: str, resize_num_pixels: Optional[int] = None) -> str:
+        # Download (or get from the cache) the image at url, resized to resize_num_pixels,
+        # returning the path to the saved PNG. Raises ImageFetchError on failure
+        entry = self._url_hashes.get(url)
+        if entry is not None and time.time() - entry[1] < self.url_ttl:
+            self._url_hashes.move_to_end(url)
+            file_path = self._cachedFile(entry[0], resize_num_pixels)
+            if file_path is not None:
+                self.hits += 1
+                return file_path
+        self.misses += 1
+
+        # Share one download between simultaneous requests for the same url
+        key = (url, resize_num_pixels)
+        if key not in self._in_flight:
+            future = asyncio.ensure_future(self._fetch(url, resize_num_pixels))
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            self._in_flight[key] = future
+        return await asyncio.shield(self._in_flight[key])
+
+    async def load(self, path: str, resize_num_pixels: Optional[int] = None) -> str:
+        # Like fetch, for an image that's already on disk (e.g. a draft being refined)
+        try:
+            data = await _readFile(path)
+        except OSError as e:
+            raise ImageFetchError(f"could not read {path}") from e
+        return await self._store(data, hashlib.sha256(data).hexdigest(), resize_num_pixels, path)
+
+    async def _fetch(self, url: str, resize_num_pixels: Optional[int]) -> str:
+        data = await self._download(url)
+        content_hash = hashlib.sha256(data).hexdigest()
+        self._url_hashes[url] = (content_hash, time.time())
+        self._url_hashes.move_to_end(url)
+        while len(self._url_hashes) > self.max_entries:
+            self._url_hashes.popitem(last=False)
+        return await self._store(data, content_hash, resize_num_pixels, url)
+
+    async def _store(self, data: bytes, content_hash: str, resize_num_pixels: Optional[int], source: str) -> str:
+        file_path = self._cachedFile(content_hash, resize_num_pixels)
+        if file_path is not None:
+            return file_path
+
+        os.makedirs(self.download_path, exist_ok=True)
+        file_path = os.path.join(
+            self.download_path, f"{content_hash[:32]}_{resize_num_pixels or 'full'}.png"
+        )
+        try:
+            await _decodeResizeSave(data, resize_num_pixels, file_path)
+        except Exception as e:
+            raise ImageFetchError(f"could not read image from {source}") from e
+        self._addFile((content_hash, resize_num_pixels), file_path)
+        return file_path
+
+    async def _download(self, url: str) -> bytes:
+        # Stream the response, giving up as soon as it goes over max_bytes
+        try:
+            async with self._getSession().get(url) as response:
+                if response.status != 200:
+                    raise ImageFetchError(f"got HTTP {response.status} from {url}")
+                if (response.content_length or 0) > self.max_bytes:
+                    raise ImageFetchError(f"image at {url} is larger than {self.max_bytes} bytes")
+                buffer = bytearray()
+                async for chunk in response.content.iter_chunked(1 << 16):
+                    buffer.extend(chunk)
+                    if len(buffer) > self.max_bytes:
+                        raise ImageFetchError(
+                            f"image at {url} is larger than {self.max_bytes} bytes"
+                        )
+                return bytes(buffer)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise ImageFetchError(f"could not download {url}") from e
+
+    def _cachedFile(self, content_hash: str, resize_num_pixels: Optional[int]) -> Optional[str]:
+        key = (content_hash, resize_num_pixels)
+        file_path = self._files.get(key)
+        if file_path is None:
+            return None
+        if not os.path.isfile(file_path):
+            del self._files[key]
+            return None
+        self._files.move_to_end(key)
+        return file_path
+
+    def _addFile(self, key: tuple, file_path: str):
+        self._files[key] = file_path
+        self._files.move_to_end(key)
+        while len(self._files) > self.max_entries:
+            _, old_path = self._files.popitem(last=False)
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
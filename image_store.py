@@ -0,0 +1,249 @@
+import json
+import logging as lg
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Callable, List, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    created REAL NOT NULL,
+    author TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    seed INTEGER,
+    width INTEGER,
+    height INTEGER,
+    steps INTEGER,
+    cfg_scale REAL,
+    sampler TEXT,
+    params TEXT,
+    timings TEXT
+);
+CREATE INDEX IF NOT EXISTS images_seed ON images (seed);
+CREATE INDEX IF NOT EXISTS images_author ON images (author, created);
+CREATE INDEX IF NOT EXISTS images_created ON images (created);
+"""
+
+# Full text index of the prompts, kept in step with the images table by triggers
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(prompt, content='images', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS images_fts_insert AFTER INSERT ON images BEGIN
+    INSERT INTO images_fts (rowid, prompt) VALUES (new.id, new.prompt);
+END;
+CREATE TRIGGER IF NOT EXISTS images_fts_delete AFTER DELETE ON images BEGIN
+    INSERT INTO images_fts (images_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+END;
+"""
+
+_COLUMNS = ("path", "created", "author", "prompt", "seed", "width", "height", "steps", "cfg_scale", "sampler")
+
+
+def safeFilename(text: str, max_length: int = 60) -> str:
+    # Shortened version of text (e.g. a prompt) that is safe to use in a file name on any OS
+    text = re.sub(r"[^\w\-]+", "_", text, flags=re.UNICODE).strip("_.")
+    return text[:max_length].rstrip("_") or "image"
+
+
+class ImageStore:
+    # Archive of generated images, laid out by date (root/YYYY/MM/DD/) with a SQLite index of each
+    # image's prompt, seed, parameters, author and timings, so they can be looked up by seed, author
+    # or prompt text without scanning the folders.
+    # save() only queues the image: a writer thread writes the files and adds them to the index in batches
+    # (one transaction per batch), so saving never holds up generation or uploads.
+    def __init__(
+        self, root: str, index_name: str = "index.sqlite3", batch_size: int = 64, flush_interval: float = 1.0
+    ):
+        self.logger = lg.getLogger(__name__)
+        self.root = root
+        self.index_path = os.path.join(root, index_name)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.saved = 0
+        self.failed = 0
+        os.makedirs(root, exist_ok=True)
+
+        connection = self._connect()
+        with connection:
+            connection.executescript(_SCHEMA)
+            try:
+                connection.executescript(_FTS_SCHEMA)
+                self.full_text = True
+            except sqlite3.OperationalError:
+                # SQLite built without FTS5, prompt searches fall back to LIKE (a full scan)
+                self.logger.warning("SQLite has no FTS5, prompt searches will be slow")
+                self.full_text = False
+        connection.close()
+        # Queries are made from executor threads, one at a time
+        self._reader = self._connect()
+        self._reader_lock = threading.Lock()
+
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._writeLoop, name="image-store", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.index_path, timeout=30, check_same_thread=False)
+        # Write ahead logging lets lookups go on while a batch is being written
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def path_for(self, prompt: str, seed: int, author: str, created: Optional[float] = None) -> str:
+        # Where an image will be saved, known before it's written so it can be referenced straight away
+        when = datetime.fromtimestamp(time.time() if created is None else created)
+        file_name = (
+            f"{when.strftime('%H%M%S-%f')[:-3]}_{safeFilename(prompt)}_{seed}_{safeFilename(author, 40)}.png"
+        )
+        return os.path.join(self.root, when.strftime("%Y"), when.strftime("%m"), when.strftime("%d"), file_name)
+
+    def save(self, path: str, png: bytes, metadata: dict, on_saved: Optional[Callable[[], None]] = None):
+        # Queue a PNG to be written to path (from path_for) and indexed with its metadata:
+        # prompt, seed and author, plus optionally created, width, height, steps, cfg_scale, sampler,
+        # params (the full query arguments) and timings.
+        # on_saved is called from the writer thread once the file is on disk (not if it couldn't be written)
+        self._queue.put((path, png, metadata, on_saved))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        # Wait until everything saved so far is on disk and in the index
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 30):
+        self._queue.put(None)
+        self._writer.join(timeout)
+        with self._reader_lock:
+            self._reader.close()
+
+    def _writeLoop(self):
+        connection = self._connect()
+        stopping = False
+        while not stopping:
+            batch = []
+            events = []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            # Gather up a batch, until it's full, flush_interval has passed or someone is waiting on it
+            while True:
+                if item is None:
+                    stopping = True
+                    break
+                if isinstance(item, threading.Event):
+                    events.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self._writeBatch(connection, batch)
+            for event in events:
+                event.set()
+        connection.close()
+
+    def _writeBatch(self, connection: sqlite3.Connection, batch: list):
+        rows = []
+        saved = []
+        for path, png, metadata, on_saved in batch:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Written under a temporary name first so a crash can't leave a truncated image
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(png)
+                os.replace(tmp_path, path)
+            except OSError:
+                self.logger.exception(f"Could not save {path}")
+                self.failed += 1
+                continue
+            if on_saved is not None:
+                saved.append(on_saved)
+            rows.append(
+                (
+                    path,
+                    metadata.get("created", time.time()),
+                    metadata["author"],
+                    metadata["prompt"],
+                    metadata.get("seed"),
+                    metadata.get("width"),
+                    metadata.get("height"),
+                    metadata.get("steps"),
+                    metadata.get("cfg_scale"),
+                    metadata.get("sampler"),
+                    json.dumps(metadata.get("params", {}), default=str),
+                    json.dumps(metadata.get("timings", {})),
+                )
+            )
+        try:
+            with connection:
+                connection.executemany(
+                    f"INSERT INTO images ({', '.join(_COLUMNS)}, params, timings) "
+                    f"VALUES ({', '.join('?' * (len(_COLUMNS) + 2))})",
+                    rows,
+                )
+            self.saved += len(rows)
+        except sqlite3.Error:
+            self.logger.exception(f"Could not index {len(rows)} image(s)")
+            self.failed += len(rows)
+        for on_saved in saved:
+            try:
+                on_saved()
+            except Exception:
+                self.logger.exception("Error in image saved callback")
+
+    def find(
+        self,
+        text: Optional[str] = None,
+        seed: Optional[int] = None,
+        author: Optional[str] = None,
+        limit: int = 10,
+    ) -> List[dict]:
+        # Most recent images matching all of the given filters: words in the prompt, seed and author.
+        # Blocks on SQLite, so run it in an executor
+        conditions = []
+        args = []
+        source = "images"
+        if text is not None and text.strip():
+            if self.full_text:
+                # Each word quoted, so the search text is never read as FTS query syntax
+                words = re.findall(r"\w+", text, flags=re.UNICODE)
+                if not words:
+                    return []
+                source = "images JOIN images_fts ON images_fts.rowid = images.id"
+                conditions.append("images_fts MATCH ?")
+                args.append(" ".join(f'"{word}"' for word in words))
+            else:
+                conditions.append("images.prompt LIKE ?")
+                args.append(f"%{text.strip()}%")
+        if seed is not None:
+            conditions.append("images.seed = ?")
+            args.append(seed)
+        if author is not None:
+            conditions.append("images.author = ?")
+            args.append(author)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = (
+            f"SELECT {', '.join(f'images.{column}' for column in _COLUMNS)} FROM {source} "
+            f"{where} ORDER BY images.created DESC LIMIT ?"
+        )
+        with self._reader_lock:
+            rows = self._reader.execute(query, args + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def __len__(self):
+        with self._reader_lock:
+            return self._reader.execute("SELECT COUNT(*) FROM images").fetchone()[0]
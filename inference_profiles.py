@@ -0,0 +1,160 @@
+import types
+from configparser import ConfigParser
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from generation_request import GenerationRequest
+
+# Rows of the (batch * heads) attention computed at once with attention slicing
+ATTENTION_SLICE_SIZE = 4
+
+
+class InferenceProfile:
+    # A named trade of quality for speed and memory, chosen with the txt2img profile option or by the cog
+    # when the queue backs up. Switching profiles never reloads the model:
+    # max_steps and sampler_name change the request itself (a sampler the user asked for wins),
+    # half_precision runs sampling under autocast (None leaves the precision the model was started with;
+    # weights loaded at half precision can't run at full precision without being reloaded, so they stay half),
+    # and attention_slicing computes attention a few rows at a time, which lowers peak memory for a little speed
+    def __init__(
+        self,
+        name: str,
+        max_steps: Optional[int] = None,
+        sampler_name: Optional[str] = None,
+        half_precision: Optional[bool] = None,
+        attention_slicing: bool = False,
+        description: str = "",
+    ):
+        self.name = name
+        self.max_steps = max_steps
+        self.sampler_name = sampler_name
+        self.half_precision = half_precision
+        self.attention_slicing = attention_slicing
+        self.description = description
+
+    def adjust(self, request: GenerationRequest) -> GenerationRequest:
+        # The request as generated with this profile
+        steps = request.steps if self.max_steps is None else min(request.steps, self.max_steps)
+        return request.replace(
+            steps=steps,
+            sampler_name=request.sampler_name or self.sampler_name,
+            profile=self.name,
+        )
+
+    def full_precision(self, loaded_full_precision: bool) -> bool:
+        # Whether sampling runs at full precision with this profile, given how the weights were loaded
+        if self.half_precision is None:
+            return loaded_full_precision
+        return loaded_full_precision and not self.half_precision
+
+    def summary(self) -> str:
+        parts = [
+            "all steps" if self.max_steps is None else f"up to {self.max_steps} steps",
+            "default sampler" if self.sampler_name is None else self.sampler_name,
+            {None: "loaded precision", True: "half precision", False: "full precision"}[self.half_precision],
+        ]
+        if self.attention_slicing:
+            parts.append("attention slicing")
+        return ", ".join(parts)
+
+
+BUILTIN_PROFILES = {
+    "quality": InferenceProfile(
+        "quality", half_precision=False, description="Every step, at full precision if loaded that way"
+    ),
+    "fast": InferenceProfile(
+        "fast",
+        max_steps=25,
+        sampler_name="k_euler",
+        half_precision=True,
+        attention_slicing=True,
+        description="Fewer steps of a cheaper sampler at half precision",
+    ),
+}
+
+
+def readProfiles(config: ConfigParser) -> Dict[str, InferenceProfile]:
+    # The built in profiles, changed or added to by [profile.<name>] sections of config.ini, e.g.
+    #   [profile.fast]
+    #   max_steps = 20
+    profiles = dict(BUILTIN_PROFILES)
+    for section in config.sections():
+        if not section.startswith("profile."):
+            continue
+        name = section[len("profile."):]
+        base = profiles.get(name, InferenceProfile(name))
+        max_steps = config.getint(section, "max_steps", fallback=base.max_steps or 0)
+        half_precision = config.get(section, "half_precision", fallback="")
+        profiles[name] = InferenceProfile(
+            name,
+            max_steps=max_steps or None,
+            sampler_name=config.get(section, "sampler", fallback=base.sampler_name or "") or None,
+            half_precision=(
+                base.half_precision if not half_precision else config.getboolean(section, "half_precision")
+            ),
+            attention_slicing=config.getboolean(section, "attention_slicing", fallback=base.attention_slicing),
+            description=config.get(section, "description", fallback=base.description),
+        )
+    return profiles
+
+
+def _slicedAttention(self, x, context=None, mask=None):
+    # ldm's CrossAttention.forward, with the attention matrix computed attention_slice_size rows
+    # (of batch * heads) at a time rather than all at once
+    slice_size = getattr(self, "attention_slice_size", None)
+    if not slice_size or mask is not None:
+        return self.full_forward(x, context, mask)
+    import torch
+    from einops import rearrange
+
+    h = self.heads
+    context = x if context is None else context
+    q, k, v = (
+        rearrange(t, "b n (h d) -> (b h) n d", h=h)
+        for t in (self.to_q(x), self.to_k(context), self.to_v(context))
+    )
+    out = torch.empty(q.shape[0], q.shape[1], v.shape[2], dtype=q.dtype, device=q.device)
+    for start in range(0, q.shape[0], slice_size):
+        end = start + slice_size
+        sim = torch.einsum("b i d, b j d -> b i j", q[start:end], k[start:end]) * self.scale
+        out[start:end] = torch.einsum("b i j, b j d -> b i d", sim.softmax(dim=-1), v[start:end])
+    return self.to_out(rearrange(out, "(b h) n d -> b n (h d)", h=h))
+
+
+def setAttentionSlicing(model, slice_size: Optional[int]):
+    # Turn attention slicing on (slice_size rows at a time) or off (None) for every attention layer of a model
+    if model is None or not hasattr(model, "modules"):
+        return
+    for module in model.modules():
+        if type(module).__name__ != "CrossAttention":
+            continue
+        if not hasattr(module, "full_forward"):
+            module.full_forward = module.forward
+            module.forward = types.MethodType(_slicedAttention, module)
+        module.attention_slice_size = slice_size
+
+
+@contextmanager
+def profileApplied(t2i, profile: Optional[InferenceProfile]):
+    # Generate with profile's precision and attention slicing, putting t2i back as it was afterwards,
+    # including its sampler (which a job's sampler_name switches), so jobs without one get the default.
+    # The model's weights aren't touched, so the next job can use another profile straight away
+    sampler_name = getattr(t2i, "sampler_name", None)
+    loaded_full_precision = getattr(t2i, "full_precision", None)
+    slicing = profile is not None and profile.attention_slicing
+    model = getattr(t2i, "model", None)
+    if profile is not None and loaded_full_precision is not None:
+        t2i.full_precision = profile.full_precision(loaded_full_precision)
+    if slicing:
+        setAttentionSlicing(model, ATTENTION_SLICE_SIZE)
+    try:
+        yield
+    finally:
+        if loaded_full_precision is not None:
+            t2i.full_precision = loaded_full_precision
+        if slicing:
+            setAttentionSlicing(model, None)
+        if sampler_name is not None and t2i.sampler_name != sampler_name:
+            t2i.sampler_name = sampler_name
+            if hasattr(t2i, "_set_sampler"):
+                t2i._set_sampler()
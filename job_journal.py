@@ -0,0 +1,67 @@
+import json
+import logging as lg
+import os
+import secrets
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+# States after which there's nothing left to do for a job
+TERMINAL_STATES = ("delivered", "failed", "cancelled", "rejected", "replayed")
+
+
+class JobJournal:
+    # Append-only journal of generation jobs, one JSON object per line: {"id", "state", "t", ...}.
+    # A job is submitted (with everything needed to run the request again), started, generated,
+    # saved (with the paths of its images), and then delivered, unless it failed, was cancelled or
+    # rejected, or was replayed as a new job after a restart.
+    #
+    # Each record is a single small append to a file kept open, without an fsync. That costs microseconds
+    # and survives the bot crashing or being restarted, since the OS still has the data, though not
+    # the machine losing power.
+    # On startup the journal left by the last run is read back (unfinished holds the jobs that never
+    # finished, fields merged) and compacted down to just those jobs.
+    def __init__(self, path: str):
+        self.logger = lg.getLogger(__name__)
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.unfinished = self._recover()
+        self._file = open(path, "a", encoding="utf-8")
+
+    @staticmethod
+    def new_id() -> str:
+        return secrets.token_hex(8)
+
+    def record(self, job_id: Optional[str], state: str, **fields):
+        if job_id is None or self._file is None:
+            return
+        record = {"id": job_id, "state": state, "t": time.time(), **fields}
+        self._file.write(json.dumps(record, default=str) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _recover(self) -> List[dict]:
+        if not os.path.isfile(self.path):
+            return []
+        jobs: OrderedDict = OrderedDict()
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                jobs.setdefault(record["id"], {}).update(record)
+        unfinished = [job for job in jobs.values() if job["state"] not in TERMINAL_STATES]
+        # Written to a temporary file first so a crash can't lose the unfinished jobs
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(job, default=str) + "\n" for job in unfinished)
+        os.replace(tmp_path, self.path)
+        if unfinished:
+            self.logger.info(f"Found {len(unfinished)} unfinished job(s) in {self.path}")
+        return unfinished
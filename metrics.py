@@ -0,0 +1,225 @@
+import json
+import logging as lg
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+# Structured (one JSON object per line) log of per-request events, see logEvent
+event_logger = lg.getLogger("metrics")
+
+
+def _formatLabels(label_names: Sequence[str], label_values: Tuple) -> str:
+    if not label_names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(label_names, label_values))
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        # Metrics are updated from the worker thread as well as the event loop
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_formatLabels(self.label_names, key)} {value}")
+        return lines
+
+
+class Gauge(_Metric):
+    # A value that is either set directly, or read from fn whenever the metrics are collected
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, help)
+        self.fn = fn
+        self._value = 0.0
+
+    def set(self, value: float):
+        self._value = value
+
+    def value(self) -> float:
+        return self.fn() if self.fn is not None else self._value
+
+    def render(self) -> List[str]:
+        return super().render() + [f"{self.name} {self.value()}"]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: Sequence[float],
+        labels: Sequence[str] = (),
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # label values -> [bucket counts, sum, count]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for j, upper in enumerate(self.buckets):
+                if value <= upper:
+                    entry[0][j] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - tic, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                for upper, bucket_count in zip(self.buckets, counts):
+                    le = "+Inf" if upper == float("inf") else f"{upper}"
+                    labels = _formatLabels(self.label_names + ("le",), key + (le,))
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _formatLabels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+QUEUE_WAIT_SECONDS = REGISTRY.register(
+    Histogram("sd_queue_wait_seconds", "Time jobs spend waiting in the queue", _SECONDS_BUCKETS)
+)
+PHASE_SECONDS = REGISTRY.register(
+    Histogram(
+        "sd_phase_seconds",
+        "Time spent in each phase of a txt2img request",
+        _SECONDS_BUCKETS,
+        labels=("phase",),
+    )
+)
+BATCH_SIZE = REGISTRY.register(
+    Histogram("sd_batch_jobs", "Number of jobs generated together in a batch", (1, 2, 3, 4, 6, 8, 12, 16))
+)
+IMAGES_TOTAL = REGISTRY.register(Counter("sd_images_generated_total", "Images generated"))
+STEPS_TOTAL = REGISTRY.register(
+    Counter("sd_sampling_steps_total", "Sampling steps run, summed over every image")
+)
+IMAGES_PER_SECOND = REGISTRY.register(
+    Gauge("sd_images_per_second", "Images per second of the most recent batch")
+)
+STEPS_PER_SECOND = REGISTRY.register(
+    Gauge("sd_steps_per_second", "Image sampling steps per second of the most recent batch")
+)
+JOBS_TOTAL = REGISTRY.register(
+    Counter("sd_jobs_total", "Jobs finished, by outcome", labels=("outcome",))
+)
+PEAK_VRAM_BYTES = REGISTRY.register(
+    Histogram(
+        "sd_peak_vram_bytes",
+        "Peak GPU memory allocated while generating a batch",
+        [2**30 * gb for gb in (1, 2, 3, 4, 6, 8, 10, 12, 16, 24)],
+    )
+)
+UPLOAD_RETRIES_TOTAL = REGISTRY.register(
+    Counter("sd_upload_retries_total", "Discord upload attempts that had to be retried")
+)
+UPLOAD_FALLBACKS_TOTAL = REGISTRY.register(
+    Counter(
+        "sd_upload_fallbacks_total",
+        "Uploads that fell back to a slower or reduced path",
+        labels=("kind",),
+    )
+)
+SPECULATIVE_IMAGES_TOTAL = REGISTRY.register(
+    Counter(
+        "sd_speculative_images_total",
+        "Images generated ahead of time while the GPU was idle, by outcome (generated, served, preempted)",
+        labels=("outcome",),
+    )
+)
+WORKER_RESTARTS_TOTAL = REGISTRY.register(
+    Counter("sd_worker_restarts_total", "Generation worker processes restarted after crashing")
+)
+REMOTE_LEASES_EXPIRED_TOTAL = REGISTRY.register(
+    Counter("sd_remote_leases_expired_total", "Jobs taken back from remote generator nodes that went quiet")
+)
+
+
+def logEvent(event: str, **fields):
+    # Write one structured log line, for offline analysis and capacity planning
+    event_logger.info(json.dumps({"event": event, "time": time.time(), **fields}, default=str))
+
+
+async def startMetricsServer(host: str, port: int) -> web.AppRunner:
+    # Serve the metrics registry on http://host:port/metrics
+    async def handle(request):
+        return web.Response(
+            text=REGISTRY.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
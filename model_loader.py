@@ -0,0 +1,156 @@
+import functools
+import gc
+from typing import Optional
+
+CONFIG = "lstein_stable_diffusion/configs/stable-diffusion/v1-inference.yaml"
+WEIGHTS = "./model.ckpt"
+
+
+def createGenerate(
+    options: dict, device_type: Optional[str] = None, weights: str = WEIGHTS, config: str = CONFIG
+):
+    # Build (but don't load) a Generate object from the dream.py command line options.
+    # This is a plain module level function so worker processes can be given it to build their own model
+    from pytorch_lightning import logging
+    from ldm.generate import Generate
+
+    # these two lines prevent a horrible warning message from appearing
+    # when the frozen CLIP tokenizer is imported
+    import transformers
+
+    transformers.logging.set_verbosity_error()
+
+    # gets rid of annoying messages about random seed
+    logging.getLogger("pytorch_lightning").setLevel(logging.ERROR)
+
+    # creating a simple text2image object with a handful of
+    # defaults passed on the command line.
+    # additional parameters will be added (or overriden) during
+    # the user input loop
+    t2i = Generate(
+        width=512,
+        height=512,
+        sampler_name=options["sampler_name"],
+        weights=weights,
+        full_precision=options["full_precision"],
+        config=config,
+        grid=options["grid"],
+        # this is solely for recreating the prompt
+        seamless=options["seamless"],
+        embedding_path=options["embedding_path"],
+        device_type=device_type or options["device"],
+        ignore_ctrl_c=options["infile"] is None,
+    )
+    # Load the checkpoint with loadStateDict, or take a model already built in CPU RAM by buildModel
+    t2i.prebuilt_model = None
+    t2i._load_model_from_config = functools.partial(_loadModelFromConfig, t2i)
+    return t2i
+
+
+def loadStateDict(weights: str) -> dict:
+    # Read a checkpoint's weights with as little copying as possible: .safetensors files are memory mapped
+    # straight into tensors, and so are .ckpt files on torch versions that can (2.1 and later),
+    # rather than unpickling every tensor into freshly allocated memory
+    if weights.endswith(".safetensors"):
+        from safetensors.torch import load_file
+
+        return load_file(weights, device="cpu")
+    import torch
+
+    try:
+        checkpoint = torch.load(weights, map_location="cpu", mmap=True)
+    except TypeError:
+        checkpoint = torch.load(weights, map_location="cpu")
+    return checkpoint.get("state_dict", checkpoint)
+
+
+def buildModel(t2i):
+    # Build t2i's model in CPU RAM (half precision unless full_precision), ready for load_model to move
+    # onto its device. Can run on a background thread while another model is generating
+    from omegaconf import OmegaConf
+    from ldm.util import instantiate_from_config
+
+    config = OmegaConf.load(t2i.config)
+    state_dict = loadStateDict(t2i.weights)
+    model = instantiate_from_config(config.model)
+    model.load_state_dict(state_dict, strict=False)
+    del state_dict
+    if not t2i.full_precision:
+        model.half()
+    model.eval()
+    t2i.prebuilt_model = model
+
+
+def _loadModelFromConfig(t2i, config, weights: str):
+    # Stands in for Generate._load_model_from_config
+    if t2i.prebuilt_model is None:
+        buildModel(t2i)
+    model, t2i.prebuilt_model = t2i.prebuilt_model, None
+    return model.to(t2i.device)
+
+
+def _moveModel(t2i, device):
+    t2i.model.to(device)
+    # The text encoder moves its tokens to the device it was told about, not the one it's on
+    cond_stage_model = getattr(t2i.model, "cond_stage_model", None)
+    if cond_stage_model is not None and hasattr(cond_stage_model, "device"):
+        cond_stage_model.device = device
+
+
+def _emptyCache():
+    try:
+        import torch
+    except ImportError:
+        return
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class GenerateLoader:
+    # How a ModelRegistry moves Generate models between disk, CPU RAM and the GPU
+    def build(self, t2i):
+        # Disk -> CPU RAM, without touching the GPU
+        buildModel(t2i)
+
+    def park(self, t2i):
+        # GPU -> CPU RAM, freeing its VRAM
+        _moveModel(t2i, "cpu")
+        _emptyCache()
+
+    def unpark(self, t2i):
+        # CPU RAM -> GPU
+        _moveModel(t2i, t2i.device)
+
+    def drop(self, t2i):
+        # Forget the model entirely, it will be read from disk again if needed.
+        # The sampler holds on to the model too
+        t2i.model = None
+        t2i.sampler = None
+        t2i.prebuilt_model = None
+        gc.collect()
+        _emptyCache()
+
+
+def resetPeakVram():
+    # Start measuring peak GPU memory afresh (a no-op without CUDA)
+    try:
+        import torch
+    except ImportError:
+        return
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peakVram(stopped: bool = False) -> Optional[int]:
+    # Peak GPU memory allocated since resetPeakVram, or None without CUDA
+    try:
+        import torch
+    except ImportError:
+        return None
+    if not torch.cuda.is_available():
+        return None
+    peak_vram = torch.cuda.max_memory_allocated()
+    if stopped:
+        # Release the memory held by a stopped generation so the next job has all of it
+        torch.cuda.empty_cache()
+    return peak_vram
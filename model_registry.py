@@ -0,0 +1,279 @@
+import logging as lg
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from configparser import ConfigParser
+from typing import Callable, Dict, List, Optional
+
+from inference_profiles import BUILTIN_PROFILES, InferenceProfile, profileApplied
+from model_loader import CONFIG, WEIGHTS, GenerateLoader, createGenerate
+
+DEFAULT_MODEL = "default"
+
+
+class ModelSpec:
+    # A checkpoint that can be chosen with the txt2img model option
+    def __init__(self, name: str, weights: str, config: str = CONFIG):
+        self.name = name
+        self.weights = weights
+        self.config = config
+
+
+def parseModelSpec(name: str, value: str) -> ModelSpec:
+    # "weights[, config]", as in config.ini's [models] section or generator_node.py --model name=...
+    parts = [part.strip() for part in value.split(",")]
+    return ModelSpec(name, parts[0], parts[1] if len(parts) > 1 and parts[1] else CONFIG)
+
+
+def readModelSpecs(config: ConfigParser) -> List[ModelSpec]:
+    # The checkpoints listed in config.ini's [models] section, or just model.ckpt if there are none
+    if not config.has_section("models") or not config.options("models"):
+        return [ModelSpec(DEFAULT_MODEL, WEIGHTS)]
+    return [parseModelSpec(name, config.get("models", name)) for name in config.options("models")]
+
+
+class _Entry:
+    def __init__(self, spec: ModelSpec, t2i):
+        self.spec = spec
+        self.t2i = t2i
+        # unloaded (on disk), building (being read into CPU RAM), parked (in CPU RAM), resident (on the GPU),
+        # or moving between them
+        self.state = "unloaded"
+        self.building: Optional[Future] = None
+        self.last_used = 0.0
+        self.loads = 0
+
+
+class ModelRegistry:
+    # Several checkpoints behind the same interface as a single Generate (load_model, prompt2image,
+    # generate_batch), picking the model for each job from its "model" argument.
+    # The max_resident most recently used models stay on the GPU; models pushed off it are parked in
+    # CPU RAM (up to max_parked of them) so they can come back in seconds, and the rest are dropped
+    # and read from disk again when needed. prefetch() reads a model into CPU RAM in the background
+    # while the GPU carries on with other jobs.
+    # Jobs with a "profile" argument are generated with that inference profile's precision and attention slicing.
+    #
+    # Models are only switched from one generation thread at a time (the queue's worker thread,
+    # or a worker process's main thread).
+    def __init__(
+        self,
+        specs: List[ModelSpec],
+        factory: Callable[[ModelSpec], object],
+        default: Optional[str] = None,
+        max_resident: int = 1,
+        max_parked: int = 1,
+        loader=None,
+        profiles: Optional[Dict[str, InferenceProfile]] = None,
+    ):
+        self.logger = lg.getLogger(__name__)
+        self._entries: Dict[str, _Entry] = OrderedDict(
+            (spec.name, _Entry(spec, factory(spec))) for spec in specs
+        )
+        self.default = default or specs[0].name
+        if self.default not in self._entries:
+            raise ValueError(f"Default model {self.default} isn't one of the configured models")
+        self.max_resident = max(1, max_resident)
+        self.max_parked = max(0, max_parked)
+        self.loader = loader or GenerateLoader()
+        self.profiles = BUILTIN_PROFILES if profiles is None else profiles
+        self.conditioning_cache = None
+        self.swaps = 0
+        self._current = self.default
+        self._lock = threading.RLock()
+        self._builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-prefetch")
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._entries)
+
+    @property
+    def sampler_name(self) -> str:
+        return self._entries[self._current].t2i.sampler_name
+
+    def resolve(self, name: Optional[str]) -> str:
+        # The model to use for a job asking for name (None for the default)
+        name = name or self.default
+        if name not in self._entries:
+            raise ValueError(f"Unknown model {name} (models: {', '.join(self._entries)})")
+        return name
+
+    def is_resident(self, name: Optional[str]) -> bool:
+        return self._entries[self.resolve(name)].state == "resident"
+
+    def status(self) -> List[dict]:
+        return [
+            {"name": name, "state": entry.state, "loads": entry.loads}
+            for name, entry in self._entries.items()
+        ]
+
+    def set_conditioning_cache(self, cache):
+        # Share one conditioning cache between every model (its keys include the model)
+        with self._lock:
+            self.conditioning_cache = cache
+            for entry in self._entries.values():
+                if entry.state == "resident":
+                    cache.install(entry.t2i)
+
+    def load_model(self):
+        self.get(self.default)
+
+    def prefetch(self, name: Optional[str], blocking: bool = True):
+        # Start reading a model that's only on disk into CPU RAM, without waiting for it.
+        # Without blocking (e.g. from the event loop), it's only a hint, skipped if the registry is busy
+        entry = self._entries[self.resolve(name)]
+        if not self._lock.acquire(blocking=blocking):
+            return
+        try:
+            if entry.state != "unloaded":
+                return
+            entry.state = "building"
+            entry.building = self._builder.submit(self._build, entry)
+        finally:
+            self._lock.release()
+
+    def _build(self, entry: _Entry):
+        tic = time.perf_counter()
+        try:
+            self.loader.build(entry.t2i)
+        except Exception:
+            with self._lock:
+                entry.state = "unloaded"
+                entry.building = None
+            raise
+        with self._lock:
+            entry.state = "parked"
+            entry.building = None
+            dropped = self._take_parked(keep=entry, limit=self.max_parked - 1)
+        self._drop(dropped)
+        self.logger.info(f"Read model {entry.spec.name} into memory in {time.perf_counter() - tic:.1f}s")
+
+    def get(self, name: Optional[str] = None):
+        # The Generate object for a model, moving it onto the GPU (and others off it) if need be.
+        # The lock only covers the bookkeeping, never the moves themselves, so prefetch() and status()
+        # don't wait on seconds of GPU transfers: models being moved are in the "moving" state,
+        # which nothing else touches
+        entry = self._entries[self.resolve(name)]
+        with self._lock:
+            entry.last_used = time.monotonic()
+            self._current = entry.spec.name
+            if entry.state == "resident":
+                return entry.t2i
+        self.prefetch(entry.spec.name)
+        building = entry.building
+        if building is not None:
+            building.result()
+
+        tic = time.perf_counter()
+        with self._lock:
+            evicted = self._take_resident(keep=entry)
+            entry.state = "moving"
+        self._park(evicted)
+        try:
+            if entry.t2i.model is not None:
+                # Parked after being on the GPU before
+                self.loader.unpark(entry.t2i)
+            else:
+                # Built in CPU RAM (or just dropped again, in which case it's read from disk now)
+                entry.t2i.load_model()
+        except Exception:
+            with self._lock:
+                entry.state = "parked" if entry.t2i.model is not None else "unloaded"
+            raise
+        with self._lock:
+            entry.state = "resident"
+            entry.loads += 1
+            self.swaps += 1
+            if self.conditioning_cache is not None:
+                self.conditioning_cache.install(entry.t2i)
+            dropped = self._take_parked(keep=entry, limit=self.max_parked)
+        self._drop(dropped)
+        self.logger.info(f"Moved model {entry.spec.name} onto the GPU in {time.perf_counter() - tic:.1f}s")
+        return entry.t2i
+
+    def _take_resident(self, keep: _Entry) -> List[_Entry]:
+        # The least recently used models to move off the GPU to make room for keep, marked as moving.
+        # Called with the lock held
+        resident = sorted(
+            (e for e in self._entries.values() if e.state == "resident" and e is not keep),
+            key=lambda e: e.last_used,
+        )
+        evicted = resident[: max(0, len(resident) - self.max_resident + 1)]
+        for entry in evicted:
+            entry.state = "moving"
+        return evicted
+
+    def _take_parked(self, keep: _Entry, limit: int) -> List[_Entry]:
+        # The least recently used parked models (other than keep) to drop so there are no more than limit,
+        # marked as moving. Called with the lock held
+        parked = sorted(
+            (e for e in self._entries.values() if e.state == "parked" and e is not keep),
+            key=lambda e: e.last_used,
+        )
+        dropped = parked[: max(0, len(parked) - max(0, limit))]
+        for entry in dropped:
+            entry.state = "moving"
+        return dropped
+
+    def _park(self, entries: List[_Entry]):
+        # GPU -> CPU RAM (or dropped altogether, with no room to park), without the lock
+        if self.max_parked == 0:
+            self._drop(entries)
+            return
+        for entry in entries:
+            self.loader.park(entry.t2i)
+            with self._lock:
+                entry.state = "parked"
+            self.logger.info(f"Parked model {entry.spec.name} in CPU RAM")
+
+    def _drop(self, entries: List[_Entry]):
+        for entry in entries:
+            self.loader.drop(entry.t2i)
+            with self._lock:
+                entry.state = "unloaded"
+            self.logger.info(f"Dropped model {entry.spec.name} from memory")
+
+    def prompt2image(self, model: Optional[str] = None, profile: Optional[str] = None, **kwargs) -> list:
+        t2i = self.get(model)
+        with profileApplied(t2i, self.profiles.get(profile)):
+            return t2i.prompt2image(**kwargs)
+
+    def generate_batch(self, batch_kwargs: List[dict], step_callbacks: Optional[list] = None) -> List[list]:
+        # Same interface as batch_generate.generateBatch, the batch all uses one model and profile (see batchKey)
+        t2i = self.get(batch_kwargs[0].get("model"))
+        profile = self.profiles.get(batch_kwargs[0].get("profile"))
+        batch_kwargs = [
+            {k: v for k, v in kwargs.items() if k not in ("model", "profile")} for kwargs in batch_kwargs
+        ]
+        with profileApplied(t2i, profile):
+            # Models can bring their own batched generation (e.g. the benchmark stub)
+            generate_batch = getattr(t2i, "generate_batch", None)
+            if generate_batch is None:
+                from batch_generate import generateBatch
+
+                return generateBatch(t2i, batch_kwargs, step_callbacks)
+            return generate_batch(batch_kwargs, step_callbacks)
+
+    def close(self):
+        self._builder.shutdown(wait=False)
+
+
+def createModelRegistry(
+    options: dict,
+    specs: List[ModelSpec],
+    device_type: Optional[str] = None,
+    default: Optional[str] = None,
+    max_resident: int = 1,
+    max_parked: int = 1,
+    profiles: Optional[Dict[str, InferenceProfile]] = None,
+) -> ModelRegistry:
+    # A registry of Generate models, built the same way as createGenerate (and likewise picklable
+    # as a functools.partial, for worker processes)
+    return ModelRegistry(
+        specs,
+        lambda spec: createGenerate(options, device_type, weights=spec.weights, config=spec.config),
+        default=default,
+        max_resident=max_resident,
+        max_parked=max_parked,
+        profiles=profiles,
+    )
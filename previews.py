@@ -0,0 +1,106 @@
+import asyncio
+import logging as lg
+import time
+from io import BytesIO
+from typing import Optional
+
+import discord
+from PIL import Image
+
+# Approximate linear projection from the 4 stable diffusion latent channels to RGB,
+# which is good enough for a preview and far cheaper than running the VAE decoder
+LATENT_RGB_FACTORS = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+]
+
+
+def latentToImage(latent) -> Image.Image:
+    # Convert a single (4, h, w) latent tensor into a (w, h) RGB preview image
+    import torch
+
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=latent.dtype, device=latent.device)
+    rgb = torch.einsum("chw,cr->hwr", latent, factors)
+    rgb = ((rgb + 1.0) / 2.0).clamp(0.0, 1.0).mul(255).to(torch.uint8)
+    return Image.fromarray(rgb.cpu().numpy())
+
+
+class PreviewReporter:
+    # Shows sampling progress by editing a discord message in place with a low resolution preview.
+    # step_callback runs on the worker thread and only does the cheap latent projection every few steps,
+    # everything else (encoding, uploading) happens on the event loop, and edits are throttled
+    # to stay well within discord's rate limits.
+    # The message can be set after the reporter is made, previews are skipped until then.
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        message: Optional[discord.WebhookMessage],
+        header: str,
+        steps: int,
+        preview_every: int = 5,
+        min_interval: float = 2.0,
+        preview_size: int = 256,
+    ):
+        self.logger = lg.getLogger(__name__)
+        self.loop = loop
+        self.message = message
+        self.header = header
+        self.steps = steps
+        self.preview_every = preview_every
+        self.min_interval = min_interval
+        self.preview_size = preview_size
+        self._latest: Optional[tuple] = None
+        self._last_edit = 0.0
+        self._edit_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def step_callback(self, samples, step: int):
+        # Called from the worker thread with the batch of latents for this job
+        if self._closed or (step + 1) % self.preview_every != 0:
+            return
+        img = latentToImage(samples[0])
+        self.loop.call_soon_threadsafe(self._update, img, step)
+
+    def _update(self, img: Image.Image, step: int):
+        if self._closed or self.message is None:
+            return
+        self._latest = (img, step)
+        if self._edit_task is None or self._edit_task.done():
+            self._edit_task = self.loop.create_task(self._edit())
+
+    async def _edit(self):
+        while self._latest is not None and not self._closed:
+            wait = self.min_interval - (time.monotonic() - self._last_edit)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            img, step = self._latest
+            self._latest = None
+
+            scale = self.preview_size / max(img.size)
+            img = img.resize(
+                tuple(round(sz * scale) for sz in img.size), resample=Image.BILINEAR
+            )
+            buffer = BytesIO()
+            img.save(buffer, format="PNG")
+            buffer.seek(0)
+            try:
+                await self.message.edit(
+                    content=f"{self.header}\n> Generating... step {step + 1}/{self.steps}",
+                    file=discord.File(buffer, filename="preview.png"),
+                    attachments=[],
+                )
+            except discord.HTTPException:
+                self.logger.warning("Could not update preview message", exc_info=True)
+            self._last_edit = time.monotonic()
+
+    async def close(self):
+        # Stop sending previews
+        self._closed = True
+        if self._edit_task is not None and not self._edit_task.done():
+            self._edit_task.cancel()
+            try:
+                await self._edit_task
+            except asyncio.CancelledError:
+                pass
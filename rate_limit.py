@@ -0,0 +1,61 @@
+import time
+from typing import Dict
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"rate limited, try again in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    # Holds up to `capacity` tokens, refilled at `rate` tokens per second.
+    # A request is let through once the bucket holds enough tokens for it (or is full, for requests
+    # bigger than the bucket), and the bucket can go into debt so big requests take longer to recover from
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.last_update = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def take(self, cost: float) -> float:
+        # Take tokens for a request, returning 0 if it's allowed,
+        # or otherwise the number of seconds until it would be allowed
+        self._refill()
+        needed = min(cost, self.capacity)
+        if self.tokens < needed:
+            return (needed - self.tokens) / self.rate
+        self.tokens -= cost
+        return 0.0
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class UserRateLimiter:
+    # A token bucket per user
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def take(self, user: str, cost: float):
+        # Raises RateLimitError if the user has run out of tokens
+        bucket = self._buckets.get(user)
+        if bucket is None:
+            bucket = self._buckets[user] = TokenBucket(self.capacity, self.rate)
+        retry_after = bucket.take(cost)
+        if retry_after > 0:
+            raise RateLimitError(retry_after)
+
+        # Forget about users whose buckets have filled back up
+        idle_users = [u for u, b in self._buckets.items() if b.full]
+        for idle_user in idle_users:
+            del self._buckets[idle_user]
@@ -0,0 +1,362 @@
+import asyncio
+import base64
+import concurrent.futures
+import logging as lg
+import secrets
+import time
+from io import BytesIO
+from typing import Dict, List, Optional
+
+from aiohttp import web
+from PIL import Image
+
+from generation_queue import GenerationCancelled, GenerationJob
+from metrics import PEAK_VRAM_BYTES, REMOTE_LEASES_EXPIRED_TOTAL
+
+
+class _RemoteTask:
+    # One generate or generate_batch call, leased to one node at a time
+    def __init__(self, kind: str, jobs: List[GenerationJob], payload: List[dict]):
+        self.kind = kind
+        self.jobs = jobs
+        self.payload = payload
+        # The payload as sent to nodes, with the init images in it (see _wirePayload)
+        self.wire_payload: Optional[List[dict]] = None
+        # Resolved (from the event loop) with a list of (image, seed) per job
+        self.future = concurrent.futures.Future()
+        self.cancelled = False
+        self.attempts = 0
+        self.lease_id: Optional[str] = None
+        self.lease_expiry = 0.0
+        self.node: Optional["_Node"] = None
+        # Images streamed back so far, per job
+        self.results: List[list] = [[] for _ in jobs]
+
+    @property
+    def max_image_pixels(self) -> int:
+        return max(kwargs["width"] * kwargs["height"] for kwargs in self.payload)
+
+    @property
+    def num_pixels(self) -> int:
+        return sum(job.num_pixels for job in self.jobs)
+
+
+class _Node:
+    def __init__(self, name: str, capabilities: dict):
+        self.id = secrets.token_hex(8)
+        self.name = name
+        # e.g. {"vram": bytes, "max_pixels": per image, "max_batch_pixels": per batch, "batch": bool,
+        #       "models": names of the models it has}
+        self.capabilities = capabilities
+        self.last_seen = time.time()
+        self.leases: Dict[str, _RemoteTask] = {}
+        self.jobs_done = 0
+        # Latest conditioning cache counters reported by the node
+        self.cache_stats: Optional[dict] = None
+
+    def fits(self, task: _RemoteTask) -> bool:
+        capabilities = self.capabilities
+        if task.max_image_pixels > capabilities.get("max_pixels", 1280**2):
+            return False
+        models = capabilities.get("models")
+        if models is not None and any(kwargs.get("model") not in models for kwargs in task.payload):
+            return False
+        if task.kind == "batch":
+            if not capabilities.get("batch", True):
+                return False
+            if task.num_pixels > capabilities.get("max_batch_pixels", 4 * 512 * 512):
+                return False
+        return True
+
+
+class RemoteWorkers:
+    # Hands generation jobs out to remote generator nodes (generator_node.py) over HTTP, so GPUs on
+    # other machines can serve the same bot. Nodes pull work rather than having it pushed to them:
+    #   POST /nodes                       register, advertising capabilities (VRAM, largest image, batching)
+    #   POST /nodes/{node}/heartbeat      keeps the node and its leases alive, returns leases to cancel
+    #   POST /nodes/{node}/lease          long poll for a job that fits the node
+    #   POST /leases/{lease}/images       stream back each image (PNG) as soon as it's made
+    #   POST /leases/{lease}/complete     or /fail
+    # A job's init image (img2img, refining a draft, or a tile) is a file on this machine, so it's sent
+    # with the lease as init_img_data (base64) for the node to write to a file of its own.
+    # A lease that isn't renewed by heartbeats (the node died or lost its connection) expires,
+    # and the job goes back to the front of the queue, up to max_attempts times.
+    #
+    # generate(job) and generate_batch(jobs) block until a node has finished the job, so like the
+    # worker pool they are run from the generation queue's worker threads.
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        token: str = "",
+        lease_seconds: float = 20.0,
+        heartbeat_interval: float = 2.0,
+        max_attempts: int = 3,
+        poll_timeout: float = 20.0,
+    ):
+        self.logger = lg.getLogger(__name__)
+        self.loop = loop
+        self.token = token
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.max_attempts = max_attempts
+        self.poll_timeout = poll_timeout
+        # Everything below is only touched from the event loop
+        self._pending: List[_RemoteTask] = []
+        self._leases: Dict[str, _RemoteTask] = {}
+        self._nodes: Dict[str, _Node] = {}
+        self._task_added = asyncio.Event()
+        self._runner: Optional[web.AppRunner] = None
+        self._sweeper: Optional[asyncio.Task] = None
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self._nodes)
+
+    def status(self) -> List[dict]:
+        now = time.time()
+        return [
+            {
+                "name": node.name,
+                "state": "busy" if node.leases else "idle",
+                "jobs": node.jobs_done,
+                "last_seen": now - node.last_seen,
+                "capabilities": node.capabilities,
+                "conditioning_cache": node.cache_stats,
+            }
+            for node in self._nodes.values()
+        ]
+
+    async def start(self, host: str, port: int):
+        app = web.Application(middlewares=[self._authenticate], client_max_size=64 * 2**20)
+        app.router.add_post("/nodes", self._handleRegister)
+        app.router.add_post("/nodes/{node}/heartbeat", self._handleHeartbeat)
+        app.router.add_post("/nodes/{node}/lease", self._handleLease)
+        app.router.add_post("/leases/{lease}/images", self._handleImage)
+        app.router.add_post("/leases/{lease}/complete", self._handleComplete)
+        app.router.add_post("/leases/{lease}/fail", self._handleFail)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self._sweeper = self.loop.create_task(self._sweep())
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+        for task in self._pending + list(self._leases.values()):
+            self._fail(task, RuntimeError("Remote workers shut down"))
+
+    def generate(self, job: GenerationJob, kwargs: Optional[dict] = None) -> list:
+        # Same interface as prompt2image: returns a list of (image, seed).
+        # kwargs overrides the job's own arguments (e.g. to generate just some of its images)
+        return self._run("single", [job], [kwargs or job.kwargs])[0]
+
+    def generate_batch(self, jobs: List[GenerationJob]) -> List[list]:
+        # Same interface as batch_generate.generateBatch: returns a list of (image, seed) per job
+        return self._run("batch", jobs, [job.kwargs for job in jobs])
+
+    def _run(self, kind: str, jobs: List[GenerationJob], payload: List[dict]) -> List[list]:
+        # Runs on a generation queue worker thread
+        task = _RemoteTask(kind, jobs, payload)
+        self.loop.call_soon_threadsafe(self._submit, task)
+        while True:
+            try:
+                return task.future.result(timeout=0.5)
+            except concurrent.futures.TimeoutError:
+                if not task.cancelled and all(job.cancelled for job in jobs):
+                    task.cancelled = True
+                    self.loop.call_soon_threadsafe(self._cancel, task)
+
+    def _submit(self, task: _RemoteTask):
+        self._pending.append(task)
+        self._task_added.set()
+
+    def _cancel(self, task: _RemoteTask):
+        # A pending task is dropped straight away, a leased one is stopped by its node after the next heartbeat
+        if task in self._pending:
+            self._pending.remove(task)
+            self._fail(task, GenerationCancelled())
+
+    def _fail(self, task: _RemoteTask, error: Exception):
+        self._release(task)
+        if not task.future.done():
+            task.future.set_exception(error)
+
+    def _release(self, task: _RemoteTask):
+        if task.lease_id is not None:
+            self._leases.pop(task.lease_id, None)
+            if task.node is not None:
+                task.node.leases.pop(task.lease_id, None)
+        task.lease_id = None
+        task.node = None
+
+    def _requeue(self, task: _RemoteTask, reason: str):
+        # Put a lost job back at the front of the queue for another node, unless it has failed too often
+        REMOTE_LEASES_EXPIRED_TOTAL.inc()
+        node_name = task.node.name if task.node is not None else "?"
+        self._release(task)
+        task.results = [[] for _ in task.jobs]
+        if task.cancelled:
+            self._fail(task, GenerationCancelled())
+        elif task.attempts >= self.max_attempts:
+            self.logger.error(f"Giving up on a job lost {task.attempts} times ({reason})")
+            self._fail(task, RuntimeError(f"job lost {task.attempts} times ({reason})"))
+        else:
+            self.logger.warning(f"Requeueing a job from node {node_name} ({reason})")
+            self._pending.insert(0, task)
+            self._task_added.set()
+
+    async def _sweep(self):
+        # Forget nodes that have stopped sending heartbeats, and requeue expired leases
+        while True:
+            await asyncio.sleep(1.0)
+            now = time.time()
+            for node in list(self._nodes.values()):
+                if now - node.last_seen > self.lease_seconds:
+                    self.logger.warning(f"Lost generator node {node.name}")
+                    del self._nodes[node.id]
+                    for task in list(node.leases.values()):
+                        self._requeue(task, f"node {node.name} stopped responding")
+            for task in list(self._leases.values()):
+                if task.lease_expiry < now:
+                    self._requeue(task, "lease expired")
+
+    @web.middleware
+    async def _authenticate(self, request: web.Request, handler):
+        if self.token and not secrets.compare_digest(
+            request.headers.get("Authorization", ""), f"Bearer {self.token}"
+        ):
+            raise web.HTTPUnauthorized()
+        return await handler(request)
+
+    def _getNode(self, request: web.Request) -> _Node:
+        node = self._nodes.get(request.match_info["node"])
+        if node is None:
+            # Forgotten (e.g. after a long network outage), the node should register again
+            raise web.HTTPNotFound()
+        node.last_seen = time.time()
+        return node
+
+    def _getLease(self, request: web.Request) -> _RemoteTask:
+        task = self._leases.get(request.match_info["lease"])
+        if task is None:
+            # Expired and given to someone else, the node should drop the job
+            raise web.HTTPGone()
+        return task
+
+    async def _handleRegister(self, request: web.Request):
+        data = await request.json()
+        node = _Node(data.get("name", request.remote), data.get("capabilities", {}))
+        self._nodes[node.id] = node
+        self.logger.info(f"Generator node {node.name} registered ({node.capabilities})")
+        self._task_added.set()
+        return web.json_response({"node": node.id, "heartbeat_interval": self.heartbeat_interval})
+
+    async def _handleHeartbeat(self, request: web.Request):
+        node = self._getNode(request)
+        expiry = time.time() + self.lease_seconds
+        for task in node.leases.values():
+            task.lease_expiry = expiry
+        cancel = [lease_id for lease_id, task in node.leases.items() if task.cancelled]
+        return web.json_response({"cancel": cancel})
+
+    async def _handleLease(self, request: web.Request):
+        node = self._getNode(request)
+        deadline = time.time() + self.poll_timeout
+        while True:
+            task = next((task for task in self._pending if node.fits(task)), None)
+            if task is not None:
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return web.Response(status=204)
+            self._task_added.clear()
+            try:
+                await asyncio.wait_for(self._task_added.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            if node.id not in self._nodes:
+                raise web.HTTPNotFound()
+
+        self._pending.remove(task)
+        task.attempts += 1
+        task.lease_id = secrets.token_hex(8)
+        task.lease_expiry = time.time() + self.lease_seconds
+        task.node = node
+        self._leases[task.lease_id] = task
+        node.leases[task.lease_id] = task
+        lease_id = task.lease_id
+        try:
+            payload = await self._wirePayload(task)
+        except OSError as e:
+            self.logger.error(f"Could not read the init image of a job: {e}")
+            self._fail(task, e)
+            return web.Response(status=204)
+        if task.lease_id != lease_id:
+            # Cancelled or expired while the init images were being read
+            return web.Response(status=204)
+        return web.json_response({"lease": lease_id, "kind": task.kind, "payload": payload})
+
+    async def _wirePayload(self, task: _RemoteTask) -> List[dict]:
+        # The task's arguments with each init image path replaced by the image itself, read once per task
+        if task.wire_payload is None:
+
+            def encode():
+                payload = []
+                for kwargs in task.payload:
+                    kwargs = dict(kwargs)
+                    init_img = kwargs.pop("init_img", None)
+                    if init_img:
+                        with open(init_img, "rb") as f:
+                            kwargs["init_img_data"] = base64.b64encode(f.read()).decode("ascii")
+                    payload.append(kwargs)
+                return payload
+
+            task.wire_payload = await self.loop.run_in_executor(None, encode)
+        return task.wire_payload
+
+    async def _handleImage(self, request: web.Request):
+        task = self._getLease(request)
+        index = int(request.query["index"])
+        seed = int(request.query["seed"])
+        data = await request.read()
+
+        def decode():
+            image = Image.open(BytesIO(data))
+            image.load()
+            return image
+
+        image = await self.loop.run_in_executor(None, decode)
+        task.results[index].append((image, seed))
+        return web.Response()
+
+    async def _handleComplete(self, request: web.Request):
+        task = self._getLease(request)
+        data = await request.json()
+        counts = data.get("counts", [])
+        if counts != [len(results) for results in task.results]:
+            self._fail(task, RuntimeError("Images went missing on the way back from the node"))
+            return web.Response()
+        peak_vram = data.get("peak_vram")
+        if peak_vram is not None:
+            PEAK_VRAM_BYTES.observe(peak_vram)
+            for job in task.jobs:
+                job.peak_vram = peak_vram
+        task.node.jobs_done += len(task.jobs)
+        if data.get("conditioning_cache") is not None:
+            task.node.cache_stats = data["conditioning_cache"]
+        self._release(task)
+        if not task.future.done():
+            task.future.set_result(task.results)
+        return web.Response()
+
+    async def _handleFail(self, request: web.Request):
+        task = self._getLease(request)
+        data = await request.json()
+        if data.get("cancelled"):
+            self._fail(task, GenerationCancelled())
+        else:
+            self.logger.error(f"Generation failed on node {task.node.name}:\n{data.get('error')}")
+            self._fail(task, RuntimeError(f"Generation failed on node {task.node.name}"))
+        return web.Response()
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import logging as lg
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional
+
+# Query arguments that (along with the seed) fully determine the generated image
+_KEY_ARGS = (
+    "model",
+    "width",
+    "height",
+    "steps",
+    "cfg_scale",
+    "strength",
+    "seamless",
+    "with_variations",
+    "variation_amount",
+    "gfpgan_strength",
+    "upscale",
+)
+
+
+def fileHash(file_path: str) -> str:
+    # Hashes are remembered for as long as the file's size and modification time don't change
+    stat = os.stat(file_path)
+    return _fileHash(file_path, stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=256)
+def _fileHash(file_path: str, size: int, mtime_ns: int) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def queryParams(kwargs: dict, sampler_name: str) -> dict:
+    # Normalised query arguments that, along with the seed, determine the generated image
+    params = {arg: kwargs.get(arg) for arg in _KEY_ARGS}
+    params["prompt"] = re.sub(r"\s+", " ", kwargs["prompt"]).strip()
+    params["sampler_name"] = kwargs.get("sampler_name") or sampler_name
+    params["cfg_scale"] = float(params["cfg_scale"])
+    # Only keyed when set, so images generated before there were profiles are still found
+    if kwargs.get("profile"):
+        params["profile"] = kwargs["profile"]
+    init_img = kwargs.get("init_img")
+    if init_img is not None:
+        params["init_img"] = fileHash(init_img)
+    else:
+        # The strength only matters for img2img
+        params["strength"] = None
+    return params
+
+
+class ResultCache:
+    # Content addressed cache of generated images.
+    # Generation with a fixed seed is deterministic, so an index on disk maps the normalised query
+    # (prompt, seed, size, steps, cfg, sampler, init image hash, ...) to the image already saved in the outputs folder.
+    # The index is capped at max_entries, evicting the least recently used (the image files themselves are kept).
+    # Changes are written to disk by a timer thread at most once every save_delay seconds (and by close()),
+    # so putting an image never blocks on rewriting the whole index.
+    def __init__(self, index_path: str, max_entries: int = 5000, save_delay: float = 5.0):
+        self.logger = lg.getLogger(__name__)
+        self.index_path = index_path
+        self.max_entries = max_entries
+        self.save_delay = save_delay
+        self.hits = 0
+        self.misses = 0
+        self._index: OrderedDict = OrderedDict()
+        # _lock guards the index and the timer, _write_lock keeps saves in order
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        self._save_timer: Optional[threading.Timer] = None
+        self._load()
+
+    def key(self, kwargs: dict, seed: Optional[int], sampler_name: str) -> Optional[str]:
+        # Normalised key for one image of a query, or None if it can't be cached (random seed)
+        if seed is None:
+            return None
+        params = queryParams(kwargs, sampler_name)
+        params["seed"] = int(seed)
+        normalised = json.dumps(params, sort_keys=True)
+        return hashlib.sha256(normalised.encode()).hexdigest()
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        # Path to the cached image for this key, if there is one
+        if key is None:
+            return None
+        file_path = self._index.get(key)
+        if file_path is not None and not os.path.isfile(file_path):
+            # Image has been deleted since
+            with self._lock:
+                self._index.pop(key, None)
+                self._scheduleSave()
+            file_path = None
+        if file_path is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self._lock:
+            self._index.move_to_end(key)
+        return file_path
+
+    def put(self, key: Optional[str], file_path: str):
+        if key is None:
+            return
+        with self._lock:
+            self._index[key] = file_path
+            self._index.move_to_end(key)
+            while len(self._index) > self.max_entries:
+                self._index.popitem(last=False)
+            self._scheduleSave()
+
+    def save(self):
+        # Write the index to disk if it has changed since it was last saved. Blocks on the file,
+        # so call it from a thread (the save timer, or an executor)
+        with self._write_lock:
+            with self._lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+                if not self._dirty:
+                    return
+                items = list(self._index.items())
+                self._dirty = False
+            try:
+                self._save(items)
+            except OSError:
+                self.logger.exception(f"Could not save result cache index {self.index_path}")
+
+    def close(self):
+        self.save()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def __len__(self):
+        return len(self._index)
+
+    def _load(self):
+        if not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r") as f:
+                self._index = OrderedDict(json.load(f))
+        except (OSError, ValueError):
+            self.logger.warning(f"Could not read result cache index {self.index_path}, starting empty")
+            self._index = OrderedDict()
+
+    def _scheduleSave(self):
+        # Called with the lock held
+        self._dirty = True
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(self.save_delay, self.save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _save(self, items: list):
+        # Write to a temporary file first so a crash can't leave a half written index
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(items, f)
+        os.replace(tmp_path, self.index_path)
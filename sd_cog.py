@@ -1,26 +1,57 @@
 #!/usr/bin/env python3
 
 import argparse
-from contextlib import redirect_stderr, redirect_stdout
-from datetime import datetime
-from io import BytesIO, StringIO
+import asyncio
+from configparser import ConfigParser
+from contextlib import contextmanager
+from io import BytesIO
 import math
 import shlex
 import os
+import random
 import re
 from statistics import quantiles
 import sys
 import copy
+import functools
+import tempfile
 import warnings
 import time
-import ldm.dream.readline
-from ldm.dream.pngwriter import PngWriter, PromptFormatter
-from ldm.dream.server import DreamServer, ThreadingDreamServer
-from ldm.dream.image_util import make_grid
-from omegaconf import OmegaConf
-from lstein_stable_diffusion.scripts.dream import create_argv_parser, create_cmd_parser
 
-from utils import getImageFromUrl, discordFilename, run_in_executor, saveImageFromUrl
+from utils import getImageFromUrl, discordFilename, run_in_executor
+from generation_queue import (
+    GenerationCancelled,
+    GenerationJob,
+    GenerationQueue,
+    QueueFullError,
+)
+from batch_generate import batchKey
+from rate_limit import RateLimitError, UserRateLimiter
+from result_cache import ResultCache
+from image_store import ImageStore
+from job_journal import JobJournal
+from speculation import Speculator
+from tiling import blendTiles, cropTiles, planTiles
+from generation_request import GenerationRequest, RequestError
+from previews import PreviewReporter
+from image_encoding import encodeGrid, encodeImages
+from image_fetch import ImageFetchError, ImageFetcher
+from uploads import Uploader
+from model_registry import createModelRegistry, readModelSpecs
+from inference_profiles import readProfiles
+from conditioning_cache import installConditioningCache
+from remote_workers import RemoteWorkers
+from worker_pool import WorkerPool
+from vram_model import GB, OutOfVramError, VramModel, detectVram, isOutOfMemory
+from metrics import (
+    PEAK_VRAM_BYTES,
+    PHASE_SECONDS,
+    REGISTRY,
+    UPLOAD_FALLBACKS_TOTAL,
+    Gauge,
+    logEvent,
+    startMetricsServer,
+)
 
 from PIL import Image
 
@@ -30,13 +61,363 @@ import discord
 from discord import option
 import logging as lg
 
+def authorName(user: discord.abc.User) -> str:
+    return f"{user.name}-{user.discriminator}"
+
+
+def _modelNames(ctx: discord.AutocompleteContext) -> list:
+    return ctx.cog.model_names
+
+
+def _profileNames(ctx: discord.AutocompleteContext) -> list:
+    return list(ctx.cog.profiles)
+
+
+def draftSize(width: int, height: int, scale: float) -> tuple:
+    # Size to draft a width x height image at, in multiples of 64
+    return tuple(max(64, round(size * scale / 64) * 64) for size in (width, height))
+
+
+class CancelView(discord.ui.View):
+    # Cancel button for a queued or running generation (one or more jobs),
+    # only usable by whoever asked for it
+    def __init__(self, queue: GenerationQueue, *jobs: GenerationJob):
+        super().__init__(timeout=None)
+        self.queue = queue
+        self.jobs = jobs
+
+    @discord.ui.button(label="Cancel", style=discord.ButtonStyle.danger)
+    async def cancel_button(self, button: discord.ui.Button, interaction: discord.Interaction):
+        if authorName(interaction.user) != self.jobs[0].author:
+            await interaction.response.send_message(
+                "Only the person who asked for this image can cancel it", ephemeral=True
+            )
+            return
+        for job in self.jobs:
+            self.queue.cancel(job)
+        await interaction.response.defer()
+
+
+class MoreView(discord.ui.View):
+    # Button under a result to make the same request again with new seeds,
+    # answered straight away if they were generated ahead of time (see speculation.py)
+    def __init__(self, cog: "StableDiffusionCog", request: GenerationRequest, options: dict):
+        super().__init__(timeout=None)
+        self.cog = cog
+        self.request = request
+        self.options = options
+
+    @discord.ui.button(label="More like this", style=discord.ButtonStyle.secondary)
+    async def more_button(self, button: discord.ui.Button, interaction: discord.Interaction):
+        await interaction.response.defer()
+        await self.cog._txt2img(
+            InteractionContext(interaction), self.request.replace(seed=None), **self.options
+        )
+
+
+class RefineView(MoreView):
+    # A button for each image of a draft, generating it again at full size and steps.
+    # The refined image starts from the draft (upscaled, with the same seed) rather than from noise,
+    # so it keeps the draft's composition
+    def __init__(
+        self,
+        cog: "StableDiffusionCog",
+        request: GenerationRequest,
+        options: dict,
+        refine_request: GenerationRequest,
+        seeds: list,
+        paths: list,
+    ):
+        super().__init__(cog, request, options)
+        self.refine_request = refine_request
+        for k, (seed, path) in enumerate(zip(seeds, paths)):
+            button = discord.ui.Button(label=f"Refine {k + 1}", style=discord.ButtonStyle.primary)
+            button.callback = functools.partial(self._refine, seed, path)
+            self.add_item(button)
+
+    async def _refine(self, seed: int, path: str, interaction: discord.Interaction):
+        await interaction.response.defer()
+        await self.cog._txt2img(
+            InteractionContext(interaction),
+            self.refine_request.replace(seed=seed, strength=self.cog.refine_strength),
+            init_path=path,
+        )
+
+
+class GridView(MoreView):
+    # A button for each image in a grid preview, sending that image at full size from the outputs folder
+    def __init__(self, cog: "StableDiffusionCog", request: GenerationRequest, options: dict, paths: list):
+        super().__init__(cog, request, options)
+        for k, path in enumerate(paths):
+            button = discord.ui.Button(label=f"Full size {k + 1}", style=discord.ButtonStyle.primary)
+            button.callback = functools.partial(self._full_size, path)
+            self.add_item(button)
+
+    async def _full_size(self, path: str, interaction: discord.Interaction):
+        await interaction.response.defer()
+        await self.cog._send_full_size(InteractionContext(interaction), path)
+
+
+class InteractionContext:
+    # Stands in for an ApplicationContext when a button (e.g. a refine button) starts a generation
+    def __init__(self, interaction: discord.Interaction):
+        self.interaction = interaction
+        self.channel_id = interaction.channel_id
+        self.author = interaction.user
+        self.followup = interaction.followup
+
+    async def defer(self, **kwargs):
+        if not self.interaction.response.is_done():
+            await self.interaction.response.defer(**kwargs)
+
+
+class ChannelContext:
+    # Stands in for the ApplicationContext of a request picked up again after a restart, whose
+    # interaction has long expired: everything is sent to its channel instead, mentioning the user
+    # in the first message
+    def __init__(self, channel: discord.abc.Messageable, author: discord.abc.User):
+        self.channel = channel
+        self.channel_id = channel.id
+        self.author = author
+        self.followup = self
+        self._mentioned = False
+
+    async def defer(self, **kwargs):
+        pass
+
+    async def send(self, content: Optional[str] = None, **kwargs) -> discord.Message:
+        kwargs.pop("ephemeral", None)
+        if not self._mentioned:
+            self._mentioned = True
+            content = f"{self.author.mention} {content or ''}"
+        return await self.channel.send(content=content, **kwargs)
+
+
 # Based partly on https://github.com/harubaru/discord-stable-diffusion
 class StableDiffusionCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.logger = lg.getLogger(__name__)
         self.bot = bot
-        self.sd_query_in_progress = False
-        self.t2i = self._init_t2i()
+        # The model is loaded in the background once the bot is running, so the bot can log in straight away.
+        # Requests arriving before then wait in the queue
+        self.t2i = None
+        self.model_state = "loading"
+        self.startup_timings = {}
+        tic = time.perf_counter()
+        self.opt = self._parse_argv()
+        self.startup_timings["parse args"] = time.perf_counter() - tic
+
+        # Optional generation settings from config.ini
+        config = ConfigParser()
+        config.read("config.ini")
+        self.warmup_steps = config.getint("generation", "warmup_steps", fallback=2)
+        # /draft renders at draft_scale times the size with draft_steps steps, and the refine buttons
+        # regenerate from a draft with refine_strength (how much of the draft is noised away)
+        self.draft_scale = config.getfloat("generation", "draft_scale", fallback=0.5)
+        self.draft_steps = config.getint("generation", "draft_steps", fallback=12)
+        self.refine_strength = config.getfloat("generation", "refine_strength", fallback=0.6)
+        # Results of grid_min_images or more images are sent as one grid preview of grid_cell_size cells,
+        # with buttons for the full size images (unless the grid option says otherwise)
+        self.grid_min_images = config.getint("generation", "grid_min_images", fallback=4)
+        self.grid_cell_size = config.getint("generation", "grid_cell_size", fallback=384)
+        # Images over 1280x1280 (up to max_tiled_pixels) are generated at a base size, upscaled, and refined
+        # in tile_size tiles overlapping by tile_overlap, noising away tile_strength of each
+        self.max_tiled_pixels = config.getint("generation", "max_tiled_pixels", fallback=2048 * 2048)
+        self.tile_size = config.getint("generation", "tile_size", fallback=512)
+        self.tile_overlap = config.getint("generation", "tile_overlap", fallback=64)
+        self.tile_strength = config.getfloat("generation", "tile_strength", fallback=0.35)
+        # Checkpoints that can be chosen with the model option, from the [models] section.
+        # The most recently used stay on the GPU, and a few more in CPU RAM for quick switching
+        self.model_specs = readModelSpecs(config)
+        self.model_names = [spec.name for spec in self.model_specs]
+        self.default_model = (
+            config.get("generation", "default_model", fallback="") or self.model_names[0]
+        )
+        self.resident_models = config.getint("generation", "resident_models", fallback=1)
+        self.parked_models = config.getint("generation", "parked_models", fallback=1)
+        # Inference profiles that can be chosen with the profile option (see inference_profiles.py).
+        # Requests without one use default_profile (if set, otherwise the model as started), or busy_profile
+        # once the queue is more than busy_profile_wait seconds long
+        self.profiles = readProfiles(config)
+        self.default_profile = config.get("generation", "default_profile", fallback="") or None
+        self.busy_profile = config.get("generation", "busy_profile", fallback="fast") or None
+        self.busy_profile_wait = config.getfloat("generation", "busy_profile_wait", fallback=60)
+        for name in (self.default_profile, self.busy_profile):
+            if name is not None and name not in self.profiles:
+                raise ValueError(f"Unknown inference profile {name} (profiles: {', '.join(self.profiles)})")
+        # Memory for caching prompt encodings, so repeated prompts skip the text encoder
+        self.conditioning_cache_bytes = (
+            config.getint("generation", "conditioning_cache_mb", fallback=64) * 2**20
+        )
+        self.conditioning_cache = None
+        # With several devices listed, each gets its own model in a worker process
+        self.worker_devices = [
+            device.strip()
+            for device in config.get("generation", "worker_devices", fallback="").split(",")
+            if device.strip()
+        ]
+        self.worker_pool = None
+        # Or with remote_port set, generator nodes on other machines (generator_node.py) do the generating
+        self.remote_port = config.getint("generation", "remote_port", fallback=0)
+        self.remote_host = config.get("generation", "remote_host", fallback="127.0.0.1")
+        self.remote_workers = None
+        if self.remote_port > 0:
+            self.remote_workers = RemoteWorkers(
+                self.bot.loop, token=config.get("generation", "remote_token", fallback="")
+            )
+            concurrency = config.getint("generation", "remote_slots", fallback=4)
+        else:
+            concurrency = max(1, len(self.worker_devices))
+        # Estimates how much GPU memory a batch needs, so batches are only as big as will fit.
+        # The capacity is read from the GPU once the model is loaded, unless set here
+        self.vram_model = VramModel(
+            capacity=config.getint("generation", "vram_budget_mb", fallback=0) * 2**20 or None
+        )
+        # While the GPU is idle, generate this many more seeds of each of the most recent requests,
+        # to answer "More like this" straight away. Speculative work stops as soon as a real request comes in,
+        # which needs the model in this process (not worker_devices or remote generator nodes)
+        speculative_images = config.getint("generation", "speculative_images", fallback=2)
+        self.speculator = None
+        if speculative_images > 0 and not self.worker_devices and self.remote_port <= 0:
+            self.speculator = Speculator(
+                per_request=speculative_images,
+                max_requests=config.getint("generation", "speculative_requests", fallback=8),
+                is_resident=self._model_resident,
+            )
+        # Every request is journaled until its images are delivered, so after a restart
+        # unfinished requests are picked up again (see _replay_journal)
+        self.journal = JobJournal(os.path.join(self.opt.outdir, "jobs.journal"))
+        self.queue = GenerationQueue(
+            self._generate,
+            ready=False,
+            concurrency=concurrency,
+            batch_fits=self._batch_fits,
+            batch_fn=self._generate_batch,
+            # Jobs for the model already loaded can jump ahead of this many standard images
+            affinity_slack=config.getfloat("generation", "model_switch_slack", fallback=8),
+            journal=self.journal,
+            speculator=self.speculator,
+            maxsize=config.getint("generation", "max_queue_size", fallback=20),
+            max_batch_images=config.getint("generation", "max_batch_images", fallback=4),
+            max_batch_pixels=config.getint(
+                "generation", "max_batch_pixels", fallback=4 * 512 * 512
+            ),
+            # Rate limits are in units of standard (512x512, 50 step) images
+            rate_limiter=UserRateLimiter(
+                capacity=config.getfloat("generation", "rate_limit_burst", fallback=20),
+                rate=config.getfloat("generation", "rate_limit_per_minute", fallback=6) / 60,
+            ),
+        )
+        self.uploader = Uploader(
+            max_concurrent=config.getint("generation", "max_concurrent_uploads", fallback=3)
+        )
+        self.preview_every = config.getint("generation", "preview_every", fallback=5)
+        self.preview_interval = config.getfloat("generation", "preview_interval", fallback=2.0)
+        self.image_fetcher = ImageFetcher(
+            "./downloads",
+            max_bytes=config.getint("generation", "max_download_bytes", fallback=20_000_000),
+        )
+        # Generated images are saved in the background, by date, with an index for /find
+        self.image_store = ImageStore(self.opt.outdir)
+        self.result_cache = ResultCache(
+            os.path.join(self.opt.outdir, "result_cache.json"),
+            max_entries=config.getint("generation", "result_cache_size", fallback=5000),
+        )
+
+        self.metrics_port = config.getint("generation", "metrics_port", fallback=9120)
+        self._metrics_runner = None
+        self._registerMetrics()
+
+        self.bot.loop.create_task(self._load_model())
+        if self.journal.unfinished:
+            self.bot.loop.create_task(self._replay_journal(self.journal.unfinished))
+        if self.metrics_port > 0:
+            self.bot.loop.create_task(self._start_metrics())
+
+    @property
+    def sd_query_in_progress(self) -> bool:
+        return self.queue.in_progress
+
+    @property
+    def sampler_name(self) -> str:
+        return self.opt.sampler_name if self.t2i is None else self.t2i.sampler_name
+
+    def _model_resident(self, model: Optional[str]) -> bool:
+        # Whether a model is on the GPU, ready to generate with no swap
+        return self.t2i is not None and self.t2i.is_resident(model)
+
+    def cog_unload(self):
+        self.bot.loop.create_task(self.image_fetcher.close())
+        self.bot.loop.run_in_executor(None, self.image_store.close)
+        self.bot.loop.run_in_executor(None, self.result_cache.close)
+        self.journal.close()
+        if self.t2i is not None:
+            self.t2i.close()
+        if self.worker_pool is not None:
+            self.bot.loop.run_in_executor(None, self.worker_pool.close)
+        if self.remote_workers is not None:
+            self.bot.loop.create_task(self.remote_workers.close())
+        if self._metrics_runner is not None:
+            self.bot.loop.create_task(self._metrics_runner.cleanup())
+
+    def _registerMetrics(self):
+        # Metrics read from the cog's state whenever they are collected
+        gauges = [
+            ("sd_queue_depth", "Jobs waiting in the queue", lambda: len(self.queue)),
+            (
+                "sd_queue_running_jobs",
+                "Jobs currently generating",
+                lambda: len(self.queue.current_jobs),
+            ),
+            (
+                "sd_queue_estimated_wait_seconds",
+                "Estimated time to finish every queued job",
+                lambda: self.queue.estimated_wait(),
+            ),
+            ("sd_result_cache_hits", "Result cache hits", lambda: self.result_cache.hits),
+            ("sd_result_cache_misses", "Result cache misses", lambda: self.result_cache.misses),
+            (
+                "sd_image_store_pending",
+                "Images waiting to be written to disk",
+                lambda: self.image_store.pending,
+            ),
+            (
+                "sd_conditioning_cache_hits",
+                "Prompt encodings served from the cache",
+                lambda: self._conditioning_cache_stats()["hits"],
+            ),
+            (
+                "sd_conditioning_cache_misses",
+                "Prompt encodings run through the text encoder",
+                lambda: self._conditioning_cache_stats()["misses"],
+            ),
+            ("sd_image_fetch_cache_hits", "Init image cache hits", lambda: self.image_fetcher.hits),
+            (
+                "sd_image_fetch_cache_misses",
+                "Init image cache misses",
+                lambda: self.image_fetcher.misses,
+            ),
+            ("sd_model_ready", "1 if the model is loaded", lambda: int(self.model_state == "ready")),
+            (
+                "sd_workers_ready",
+                "Generation worker processes with a loaded model",
+                lambda: 0 if self.worker_pool is None else self.worker_pool.num_ready,
+            ),
+            (
+                "sd_remote_nodes",
+                "Remote generator nodes connected",
+                lambda: 0 if self.remote_workers is None else self.remote_workers.num_nodes,
+            ),
+        ]
+        for name, help, fn in gauges:
+            REGISTRY.register(Gauge(name, help, fn=fn))
+
+    async def _start_metrics(self):
+        try:
+            self._metrics_runner = await startMetricsServer("127.0.0.1", self.metrics_port)
+            self.logger.info(f"Serving metrics on http://127.0.0.1:{self.metrics_port}/metrics")
+        except OSError:
+            self.logger.exception(f"Could not start the metrics server on port {self.metrics_port}")
 
     @commands.slash_command(description="Generate image from text")
     @option("prompt", str, description="A text prompt for the model", required=True)
@@ -80,6 +461,32 @@ class StableDiffusionCog(commands.Cog):
         description="Strength for noising the input image. 0.0 preserves image, 1.0 replaces it [default:0.7]",
         required=False,
     )
+    @option(
+        "preview",
+        bool,
+        description="Show a low resolution preview while the image is generating [default:False]",
+        required=False,
+    )
+    @option(
+        "model",
+        str,
+        description="Model checkpoint to generate with",
+        required=False,
+        autocomplete=discord.utils.basic_autocomplete(_modelNames),
+    )
+    @option(
+        "profile",
+        str,
+        description="Inference profile, e.g. fast or quality [default: quality unless the queue is busy]",
+        required=False,
+        autocomplete=discord.utils.basic_autocomplete(_profileNames),
+    )
+    @option(
+        "grid",
+        bool,
+        description="Send a small grid preview with buttons for the full size images [default: for 4 or more]",
+        required=False,
+    )
     async def txt2img(
         self,
         ctx: discord.ApplicationContext,
@@ -93,150 +500,417 @@ class StableDiffusionCog(commands.Cog):
         steps: Optional[int] = 50,
         url: Optional[str],
         strength: Optional[float] = 0.7,
+        preview: Optional[bool] = False,
+        model: Optional[str] = None,
+        profile: Optional[str] = None,
+        grid: Optional[bool] = None,
+    ):
+        await ctx.defer()
+        request = await self._make_request(
+            ctx,
+            prompt=prompt,
+            iterations=n,
+            width=width,
+            height=height,
+            cfg_scale=cfg_scale,
+            seed=seed,
+            steps=steps,
+            strength=strength,
+            model=model,
+            profile=profile,
+        )
+        if request is not None:
+            await self._txt2img(ctx, request, url=url, preview=preview, grid=grid)
+
+    @commands.slash_command(
+        description="Quick low resolution drafts of several seeds, with buttons to refine the ones you like"
+    )
+    @option("prompt", str, description="A text prompt for the model", required=True)
+    @option("n", int, description="Number of drafts to generate [default:4]", required=False)
+    @option(
+        "width",
+        int,
+        description="Width of the refined image, multiple of 64 [default:512]",
+        required=False,
+    )
+    @option(
+        "height",
+        int,
+        description="Height of the refined image, multiple of 64 [default:512]",
+        required=False,
+    )
+    @option(
+        "cfg_scale",
+        int,
+        description='Classifier free guidance (CFG) scale - higher numbers cause generator to "try" harder [default:7.5]',
+        required=False,
+    )
+    @option("seed", int, description="Seed of the first draft [default:random]", required=False)
+    @option(
+        "steps",
+        int,
+        description="Number of sampling steps for the refined image [default:50]",
+        required=False,
+    )
+    @option(
+        "model",
+        str,
+        description="Model checkpoint to generate with",
+        required=False,
+        autocomplete=discord.utils.basic_autocomplete(_modelNames),
+    )
+    async def draft(
+        self,
+        ctx: discord.ApplicationContext,
+        *,
+        prompt: str,
+        n: Optional[int] = 4,
+        width: Optional[int] = 512,
+        height: Optional[int] = 512,
+        cfg_scale: Optional[float] = 7.5,
+        seed: Optional[int],
+        steps: Optional[int] = 50,
+        model: Optional[str] = None,
     ):
         await ctx.defer()
+        request = await self._make_request(
+            ctx,
+            prompt=prompt,
+            iterations=n,
+            width=width,
+            height=height,
+            cfg_scale=cfg_scale,
+            seed=seed,
+            steps=steps,
+            model=model,
+        )
+        if request is not None:
+            await self._txt2img(ctx, request, draft=True)
+
+    async def _make_request(self, ctx, **fields) -> Optional[GenerationRequest]:
+        # A request from command options, or None if they aren't valid (which has already been reported)
+        try:
+            return GenerationRequest(**fields)
+        except RequestError as e:
+            await self.sendError(f"Error: {e}", ctx)
+            return None
+
+    async def _txt2img(
+        self,
+        ctx: discord.ApplicationContext,
+        request: GenerationRequest,
+        *,
+        url: Optional[str] = None,
+        preview: bool = False,
+        init_path: Optional[str] = None,
+        draft: bool = False,
+        grid: Optional[bool] = None,
+    ):
+        # Generate images for a request and send them to ctx: for /txt2img, /draft (draft=True),
+        # the prefix command, and the buttons (init_path: the draft image a refined image starts from).
+        # grid: whether to send a grid preview rather than every image at full size (None to decide by n)
+        # What's needed to run the request again after a restart
+        options = dict(url=url, init_path=init_path, draft=draft, grid=grid)
+        journal_options = dict(options, request=request.to_kwargs())
 
         error_embed = discord.Embed(colour=discord.Colour.red())
         msg_embed = discord.Embed(colour=discord.Colour.fuchsia())
-        if not (1 <= n <= 10):
+        if request.model is None:
+            request = request.replace(model=self.default_model)
+        prompt, n, width, height = request.prompt, request.iterations, request.width, request.height
+        model = request.model
+        # Anything larger than this is generated in tiles
+        max_pixels = 1280**2
+        if width * height > max(max_pixels, self.max_tiled_pixels):
             await self.sendError(
-                f"Error: n = {n} (n must be between 1 and 10, inclusive)", ctx
+                f"Error: image too large (width*height > {max(max_pixels, self.max_tiled_pixels)})", ctx
             )
             return
-        max_pixels = 1280**2
-        if width * height > max_pixels:
+        if width * height > max_pixels and n > 1 and not draft:
             await self.sendError(
-                f"Error: image too large (width*height > {max_pixels})", ctx
+                f"Error: images larger than {max_pixels} pixels can only be made one at a time", ctx
             )
             return
-        if not (0 < strength < 1):
+        if model not in self.model_names:
             await self.sendError(
-                f"Error: strength = {strength} (strength must be between 0 and 1)", ctx
+                f"Error: unknown model {model} (choose from {', '.join(self.model_names)})", ctx
             )
             return
+        if request.profile is not None and request.profile not in self.profiles:
+            await self.sendError(
+                f"Error: unknown profile {request.profile} (choose from {', '.join(self.profiles)})", ctx
+            )
+            return
+        # Trade quality for speed while the queue is backed up, unless a profile was asked for
+        busy = (
+            request.profile is None
+            and self.busy_profile is not None
+            and self.queue.estimated_wait() > self.busy_profile_wait
+        )
+        profile = self.busy_profile if busy else request.profile or self.default_profile
+        # The buttons keep the full request as it was asked for: refining uses its size and steps, and more
+        # drafts are made from it again (not from the draft, which would shrink each time), each click
+        # picking its profile again rather than keeping the busy profile
+        full_request = request
+        refine_request = full_request.replace(iterations=1)
+        if profile is not None:
+            request = self.profiles[profile].adjust(request)
 
-        output_path = self.opt.outdir
-        download_path = "./downloads"
-        os.makedirs(output_path, exist_ok=True)
-        os.makedirs(download_path, exist_ok=True)
+        # Drafts are smaller and take fewer steps
+        if draft:
+            width, height = draftSize(
+                width, height, min(self.draft_scale, math.sqrt(max_pixels / (width * height)))
+            )
+            request = request.replace(width=width, height=height, steps=min(request.steps, self.draft_steps))
+        seed, steps, cfg_scale = request.seed, request.steps, request.cfg_scale
+
+        tiled = width * height > max_pixels
+        sample_size = {"width": width, "height": height}
+        if tiled:
+            sample_size = {"width": min(width, self.tile_size), "height": min(height, self.tile_size)}
+        if self.vram_model.max_images(**self._vram_args(sample_size)) == 0:
+            await self.sendError(
+                f"Error: a {width}x{height} image needs more GPU memory than there is, try a smaller size",
+                ctx,
+            )
+            return
+
+        timings = {}
 
         # Check if initial image is supplied
-        if url is not None:
+        init_img_path = None
+        if init_path is not None:
+            if not os.path.isfile(init_path):
+                # A draft that's still waiting to be written
+                await asyncio.get_running_loop().run_in_executor(None, self.image_store.flush)
             try:
-                init_img_path = saveImageFromUrl(
-                    url, download_path, resize_num_pixels=width * height
+                init_img_path = await self.image_fetcher.load(init_path, resize_num_pixels=width * height)
+            except ImageFetchError as e:
+                self.logger.warning(f"Image load failed: {e}")
+                await self.sendError("Error: the draft image is no longer available", ctx)
+                return
+        elif url is not None:
+            tic = time.perf_counter()
+            try:
+                init_img_path = await self.image_fetcher.fetch(
+                    url, resize_num_pixels=width * height
                 )
-            except:
+            except ImageFetchError as e:
+                self.logger.warning(f"Image fetch failed: {e}")
                 await self.sendError(
                     f"Error: image could not be downloaded from url", ctx
                 )
                 return
+            timings["download"] = time.perf_counter() - tic
 
-        # Author of the message
-        author = f"{ctx.author.name}-{ctx.author.discriminator}"
-
-        # Create query for the query parser
-        query = [
-            prompt,
-            f"-n{n}",
-            f"-W{width}",
-            f"-H{height}",
-            f"-C{cfg_scale}",
-            None if seed is None else f"-S{seed}",
-            f"-s{steps}",
-            None if url is None else f"-I{init_img_path}",
-            None if url is None else f"-f{strength}",
-        ]
-        query = [_ for _ in query if _ is not None]
-
-        # Since the argparser doesn't do proper logging, we have to capture the stderr to log it properly
-        with redirect_stderr(StringIO()) as stderr:
-            try:
-                query_parser = create_cmd_parser()
-                query_opt = query_parser.parse_args(query)
-            except:
-                self.logger.error(stderr.getvalue())
-                error_embed.set_footer(text="Argument error, check logs")
-                await ctx.followup.send(embed=error_embed)
-                return
+        if self.model_state == "failed":
+            await self.sendError("Error: the model failed to load, check logs", ctx)
+            return
 
-        self.sd_query_in_progress = True
+        # Author of the message
+        author = authorName(ctx.author)
 
-        tic = time.time()
+        if init_img_path is not None:
+            request = request.replace(init_img=init_img_path)
+        query_kwargs = request.to_kwargs()
 
-        results = self.t2i.prompt2image(image_callback=None, **vars(query_opt))
-        duration = time.time() - tic
+        # If this exact image has been generated before, serve it from disk without touching the GPU
+        cached_path = None
+        journal_id = None
+        if n == 1:
+            cache_key = self.result_cache.key(query_kwargs, seed, self.sampler_name)
+            cached_path = self.result_cache.get(cache_key)
+        # Or with a random seed, it may have been generated ahead of time
+        spares = None
+        if cached_path is None and self.speculator is not None and not tiled:
+            self.speculator.note(query_kwargs)
+            if seed is None:
+                spares = self.speculator.take(query_kwargs, n)
+        if cached_path is not None:
+            self.logger.info(f"Serving cached image {cached_path}")
+            # The cached PNG is sent as is, without being decoded
+            results = [[None, seed]]
+            duration = 0.0
+            peak_vram = None
+            msg_embed.set_footer(text="[Served from cache]")
+        elif spares is not None:
+            self.logger.info(f"Serving {n} image(s) generated ahead of time")
+            results = spares
+            duration = 0.0
+            peak_vram = None
+            msg_embed.set_footer(text="[Generated ahead of time]")
+        elif tiled:
+            tiled_result = await self._run_tiled(ctx, prompt, query_kwargs, author, preview, journal_options)
+            if tiled_result is None:
+                return
+            journal_id, results, duration = tiled_result
+            peak_vram = None
+            timings["sampling"] = duration
+        else:
+            job = await self._run_query(ctx, prompt, query_kwargs, author, preview, journal_options)
+            if job is None:
+                return
+            journal_id = job.journal_id
+            results = job.future.result()
+            duration = job.run_time
+            peak_vram = job.peak_vram
+            timings["queue_wait"] = job.wait_time
+            timings["sampling"] = job.run_time
 
         if len(results) == 0:
+            self.journal.record(journal_id, "failed")
             await self.sendError("No images created, likely out of VRAM", ctx)
             return
         images, seeds = tuple(zip(*results))
 
-        # Return txt2img results to discord, and save
-        discord_images = []
-        for img, seed in zip(images, seeds):
-            time_str = datetime.now().strftime("%Y%d%m-%H%M%S")
-            file_name = f"{time_str}_{prompt}_{seed}_{author}.png"
-            file_path = os.path.join(output_path, file_name)
+        # Work out where to save each image (cached images are already saved)
+        if cached_path is not None:
+            sources = [cached_path]
+            save_paths = [None]
+        else:
+            sources = list(images)
+            created = time.time()
+            save_paths = [self.image_store.path_for(prompt, seed, author, created) for seed in seeds]
+        file_names = [os.path.basename(cached_path or save_path) for save_path in save_paths]
 
-            # Save to file
-            img.save(file_path, format="PNG")
+        # Encode each image once, in parallel and off the event loop,
+        # reusing the same PNG bytes for discord and for the archive
+        tic = time.perf_counter()
+        encoded_images = await encodeImages(sources)
+        timings["encode"] = time.perf_counter() - tic
 
-            # Save to bytes buffer
-            buffer = BytesIO()
-            img.save(buffer, format="PNG")
+        # Hand the PNGs to the image store to be written and indexed in the background,
+        # and remember them for anyone asking for the same image again once they're on disk
+        # (the result cache forgets images whose file is missing)
+        loop = asyncio.get_running_loop()
+        for seed, save_path, encoded in zip(seeds, save_paths, encoded_images):
+            if save_path is None:
+                continue
+            self.image_store.save(
+                save_path,
+                encoded.png,
+                {
+                    "created": created,
+                    "author": author,
+                    "prompt": prompt,
+                    "seed": seed,
+                    "width": width,
+                    "height": height,
+                    "steps": steps,
+                    "cfg_scale": cfg_scale,
+                    "sampler": self.sampler_name,
+                    "params": dict(query_kwargs),
+                    "timings": dict(timings),
+                },
+                on_saved=functools.partial(
+                    loop.call_soon_threadsafe,
+                    self.result_cache.put,
+                    self.result_cache.key(query_kwargs, seed, self.sampler_name),
+                    save_path,
+                ),
+            )
+        self.journal.record(journal_id, "saved", paths=save_paths, seeds=seeds)
 
-            # Check if the file is larger than 8 million bytes (discord upload limit is 8MB I think != 8 million bytes)
-            size_limit = 8_000_000
-            if buffer.__sizeof__() > size_limit:
-                file_name = file_name.replace(".png", ".jpeg")
-                buffer = BytesIO()
-                img.save(buffer, format="JPEG")
+        # Return txt2img results to discord: several images as one small grid preview (drafts have their
+        # own buttons for each image), or every image at full size
+        if grid is None:
+            grid = self.grid_min_images > 0 and len(seeds) >= self.grid_min_images
+        grid = grid and len(seeds) > 1 and not draft
+        upload_files = []
+        if grid:
+            tic = time.perf_counter()
+            grid_image = await encodeGrid(
+                [encoded.png for encoded in encoded_images], cell_size=self.grid_cell_size
+            )
+            timings["grid"] = time.perf_counter() - tic
+            upload_files.append(
+                (f"grid_{os.path.splitext(file_names[0])[0]}.{grid_image.extension}", grid_image.data)
+            )
+            footer = msg_embed.footer.text
+            msg_embed.set_footer(
+                text=f"{footer + ' ' if footer else ''}[Preview grid, full size images with the buttons]"
+            )
+        for encoded, file_name in zip(encoded_images, [] if grid else file_names):
+            if not encoded.sendable:
+                self.logger.warning("Image too large to be sent to discord")
+                error_embed.set_footer(text="Image too large to be sent to discord. Saved to disk.")
+                await ctx.followup.send(embed=error_embed)
+                self.journal.record(journal_id, "delivered")
+                return
+            if encoded.reduced:
+                UPLOAD_FALLBACKS_TOTAL.inc(kind="reduced_quality")
+                file_name = f"{os.path.splitext(file_name)[0]}.{encoded.extension}"
                 msg_embed.set_footer(
                     text="[File quality reduced to fit under the discord 8MB limit]"
                 )
-
-            jpeg_quality = 100
-            while buffer.__sizeof__() > size_limit and jpeg_quality > 1:
-                buffer = BytesIO()
-                img.save(buffer, format="JPEG", optimize=True, quality=jpeg_quality)
-                jpeg_quality -= 5
-            if buffer.__sizeof__() > size_limit:
-                self.logger.warning(
-                    f"Image too large to be sent to discord ({buffer.__sizeof__()} bytes)"
-                )
-                error_embed.set_footer(
-                    text=f"Image too large to be sent to discord ({buffer.__sizeof__()} bytes). Saved to disk."
-                )
-                await ctx.followup.send(embed=error_embed)
-                return
-
-            # Reset stream position to the start (so it can be read by discord.File)
-            buffer.seek(0)
-
-            # Convert to a discord file object that can be sent to the guild
-            discord_img = discord.File(buffer, filename=file_name)
-            discord_images.append(discord_img)
+            upload_files.append((file_name, encoded.data))
 
         seeds_str = "|".join([str(_) for _ in seeds])
         s = "" if n == 1 else "s"
+        model_str = "" if model == self.default_model else f", model: {model}"
+        if profile is not None and profile != self.default_profile:
+            model_str += f", profile: {profile}{' (queue busy)' if busy else ''}"
         msg_embed.add_field(
-            name=prompt, value=f"seed{s}: {seeds_str}, duration: {duration:1f}"
+            name=prompt, value=f"seed{s}: {seeds_str}, duration: {duration:1f}{model_str}"
         )
+        if draft:
+            view = RefineView(
+                self,
+                full_request,
+                options,
+                refine_request,
+                seeds,
+                [cached_path or save_path for save_path in save_paths],
+            )
+            msg_embed.set_footer(
+                text=f"[Drafts, refine at {refine_request.width}x{refine_request.height}, "
+                f"{refine_request.steps} steps with the buttons]"
+            )
+        elif grid:
+            view = GridView(
+                self,
+                full_request,
+                options,
+                [cached_path or save_path for save_path in save_paths],
+            )
+        else:
+            view = MoreView(self, full_request, options)
 
-        # Try to send as a batch of files
-        # If that doesn't work because the files altogether go over the discord upload limit, then send one by one
-        try:
-            await ctx.followup.send(embed=msg_embed, files=discord_images)
-        except:
-            await ctx.followup.send(
-                content="Files too large to be sent in batch, sending one by one:"
+        # Send the images in as few messages as fit under the discord upload limits,
+        # retrying any that fail. The GPU is already working on the next job by now
+        tic = time.perf_counter()
+        failed = await self.uploader.send(ctx, upload_files, embed=msg_embed, view=view)
+        timings["upload"] = time.perf_counter() - tic
+        self.journal.record(journal_id, "delivered")
+        if failed:
+            await self.sendError(
+                f"Error: {len(failed)} image(s) couldn't be sent to discord, but were saved to disk", ctx
             )
-            # Reset file buffers for each image
-            [_.reset() for _ in discord_images]
-            for j in range(n - 1):
-                await ctx.send(file=discord_images[j])
-            await ctx.send(embed=msg_embed, file=discord_images[n - 1])
+
+        for phase, t in timings.items():
+            PHASE_SECONDS.observe(t, phase=phase)
+        logEvent(
+            "txt2img",
+            author=author,
+            prompt=request.prompt,
+            n=len(seeds),
+            width=width,
+            height=height,
+            steps=steps,
+            model=model,
+            img2img=init_img_path is not None,
+            draft=draft,
+            tiled=tiled,
+            grid=grid,
+            cached=cached_path is not None,
+            speculative=spares is not None,
+            # The seed asked for (None for random) and the seeds generated
+            seed=request.seed,
+            seeds=seeds,
+            upload_bytes=sum(len(data) for _, data in upload_files),
+            peak_vram=peak_vram,
+            timings=timings,
+        )
 
     @commands.slash_command(
         description="[DEBUG] Send multiple square images to discord"
@@ -296,6 +970,195 @@ class StableDiffusionCog(commands.Cog):
             self.logger("Embed URL no longer works")
         await ctx.followup.send(embed=embed, content="test")
 
+    @commands.slash_command(description="Cancel your queued or in progress txt2img")
+    @option(
+        "all",
+        bool,
+        description="Cancel all of your txt2img requests, rather than just the latest [default:False]",
+        required=False,
+    )
+    async def cancel(self, ctx: discord.ApplicationContext, all: Optional[bool] = False):
+        await ctx.defer(ephemeral=True)
+        jobs = self.queue.jobs_for(authorName(ctx.author))
+        if not all:
+            jobs = jobs[-1:]
+        cancelled = sum(self.queue.cancel(job) for job in jobs)
+        if cancelled == 0:
+            await ctx.followup.send("Nothing to cancel", ephemeral=True)
+        else:
+            s = "" if cancelled == 1 else "s"
+            await ctx.followup.send(f"Cancelled {cancelled} request{s}", ephemeral=True)
+
+    @commands.slash_command(description="Find previously generated images")
+    @option("prompt", str, description="Words in the prompt", required=False)
+    @option("seed", int, description="Image seed", required=False)
+    @option("user", discord.User, description="Only images made by this user", required=False)
+    @option("n", int, description="Number of images to send [default:4]", required=False)
+    async def find(
+        self,
+        ctx: discord.ApplicationContext,
+        prompt: Optional[str] = None,
+        seed: Optional[int] = None,
+        user: Optional[discord.User] = None,
+        n: Optional[int] = 4,
+    ):
+        await ctx.defer()
+        if not (1 <= n <= 10):
+            await self.sendError(f"Error: n = {n} (n must be between 1 and 10, inclusive)", ctx)
+            return
+        author = None if user is None else authorName(user)
+        loop = asyncio.get_running_loop()
+        matches = await loop.run_in_executor(
+            None, functools.partial(self.image_store.find, prompt, seed, author, limit=n)
+        )
+        # Images deleted from disk since are left out
+        matches = [match for match in matches if os.path.isfile(match["path"])]
+        if not matches:
+            await ctx.followup.send("No matching images found")
+            return
+
+        embed = discord.Embed(colour=discord.Colour.fuchsia())
+        for match in matches:
+            embed.add_field(
+                name=match["prompt"][:256],
+                value=f"seed: {match['seed']}, {match['width']}x{match['height']}, "
+                f"{match['steps']} steps, by {match['author']} "
+                f"on {time.strftime('%Y-%m-%d %H:%M', time.localtime(match['created']))}",
+                inline=False,
+            )
+        encoded_images = await encodeImages([match["path"] for match in matches])
+        upload_files = [
+            (f"{os.path.splitext(os.path.basename(match['path']))[0]}.{encoded.extension}", encoded.data)
+            for match, encoded in zip(matches, encoded_images)
+            if encoded.sendable
+        ]
+        failed = await self.uploader.send(ctx, upload_files, embed=embed)
+        if failed:
+            await self.sendError(f"Error: {len(failed)} image(s) couldn't be sent to discord", ctx)
+
+    @commands.slash_command(description="Show generation queue and cache statistics")
+    async def stats(self, ctx: discord.ApplicationContext):
+        await ctx.defer()
+        embed = discord.Embed(colour=discord.Colour.fuchsia())
+        embed.add_field(
+            name="Queue",
+            value=f"{len(self.queue)} waiting, "
+            f"{'busy' if self.queue.in_progress else 'idle'}, "
+            f"~{self.queue.seconds_per_cost:.1f}s per 512x512 image",
+            inline=False,
+        )
+        timings = ", ".join(f"{phase} {t:.1f}s" for phase, t in self.startup_timings.items())
+        embed.add_field(name="Model", value=f"{self.model_state} ({timings})", inline=False)
+        if self.worker_pool is not None:
+            embed.add_field(
+                name="Workers",
+                value="\n".join(
+                    f"{worker['device']}: {worker['state']}, {worker['jobs']} jobs, "
+                    f"{worker['restarts']} restarts"
+                    for worker in self.worker_pool.status()
+                ),
+                inline=False,
+            )
+        if self.remote_workers is not None:
+            nodes = self.remote_workers.status()
+            embed.add_field(
+                name="Generator nodes",
+                value="\n".join(
+                    f"{node['name']}: {node['state']}, {node['jobs']} jobs" for node in nodes
+                )
+                or "none connected",
+                inline=False,
+            )
+        if len(self.model_names) > 1:
+            if self.t2i is not None:
+                models = "\n".join(
+                    f"{model['name']}: {model['state']}, loaded {model['loads']} times"
+                    for model in self.t2i.status()
+                )
+            else:
+                models = ", ".join(self.model_names)
+            embed.add_field(name="Models", value=models, inline=False)
+        if self.vram_model.capacity is not None:
+            embed.add_field(
+                name="VRAM",
+                value=f"{self.vram_model.capacity / GB:.1f}GB, room for "
+                f"{self.vram_model.max_images(**self._vram_args({'width': 512, 'height': 512}))} "
+                "512x512 images at once",
+                inline=False,
+            )
+        num_saved = await asyncio.get_running_loop().run_in_executor(None, len, self.image_store)
+        embed.add_field(
+            name="Archive",
+            value=f"{num_saved} images indexed, {self.image_store.pending} waiting to be saved",
+            inline=False,
+        )
+        prompt_cache = self._conditioning_cache_stats()
+        lookups = prompt_cache["hits"] + prompt_cache["misses"]
+        embed.add_field(
+            name="Prompt encoding cache",
+            value=f"{prompt_cache['entries']} prompts ({prompt_cache['bytes'] / 2**20:.1f}MB), "
+            f"{prompt_cache['hits']} hits, {prompt_cache['misses']} misses "
+            f"({100 * prompt_cache['hits'] / max(1, lookups):.0f}% hit rate)",
+            inline=False,
+        )
+        if self.speculator is not None:
+            speculator = self.speculator
+            embed.add_field(
+                name="Generated ahead of time",
+                value=f"{speculator.num_spares} images ready, {speculator.served} served, "
+                f"{speculator.generated} generated, {speculator.preempted} preempted",
+                inline=False,
+            )
+        cache = self.result_cache
+        embed.add_field(
+            name="Result cache",
+            value=f"{len(cache)} images, {cache.hits} hits, {cache.misses} misses "
+            f"({100 * cache.hit_rate:.0f}% hit rate)",
+            inline=False,
+        )
+        await ctx.followup.send(embed=embed)
+
+    @commands.slash_command(description="Measure the speed and GPU memory of each inference profile")
+    @option("steps", int, description="Sampling steps before each profile's limit [default:50]", required=False)
+    async def benchmark(self, ctx: discord.ApplicationContext, steps: Optional[int] = 50):
+        await ctx.defer()
+        if self.model_state == "failed":
+            await self.sendError("Error: the model failed to load, check logs", ctx)
+            return
+        author = authorName(ctx.author)
+        request = await self._make_request(
+            ctx, prompt="a photograph of an astronaut riding a horse", steps=steps, seed=0, model=self.default_model
+        )
+        if request is None:
+            return
+        status_msg = await ctx.followup.send(f"> Benchmarking {len(self.profiles)} profiles...")
+        embed = discord.Embed(title="Inference profiles", colour=discord.Colour.fuchsia())
+        # One 512x512 image per profile, each on its own (not batched with anything else)
+        for name, profile in self.profiles.items():
+            query_kwargs = profile.adjust(request).to_kwargs()
+            job = GenerationJob(query_kwargs, author, affinity=query_kwargs["model"])
+            try:
+                self.queue.submit(job)
+                await job.future
+            except (QueueFullError, RateLimitError) as e:
+                await status_msg.edit(content="> Benchmark stopped")
+                await self.sendError(f"Error: {e}, try again later", ctx)
+                return
+            except Exception:
+                self.logger.exception(f"Benchmark of profile {name} failed")
+                embed.add_field(name=name, value=f"{profile.summary()}\nfailed, check logs", inline=False)
+                continue
+            run_steps = query_kwargs["steps"]
+            vram = "n/a" if job.peak_vram is None else f"{job.peak_vram / GB:.2f}GB"
+            result = (
+                f"{job.run_time:.1f}s for {run_steps} steps ({run_steps / max(job.run_time, 1e-6):.1f} it/s), "
+                f"peak VRAM {vram}"
+            )
+            self.logger.info(f"Benchmark of profile {name}: {result}")
+            embed.add_field(name=name, value=f"{profile.summary()}\n{result}", inline=False)
+        await status_msg.edit(content="> Benchmark done")
+        await ctx.followup.send(embed=embed)
+
     @commands.slash_command(description="Echo back a message")
     @option("echo", str, description="Text to echo back", required=False)
     async def echo(
@@ -305,52 +1168,492 @@ class StableDiffusionCog(commands.Cog):
 
         await ctx.followup.send(f"ECHO: {txt}")
 
-    def _init_t2i(self):
+    def _parse_argv(self):
+        from lstein_stable_diffusion.scripts.dream import create_argv_parser
+
         # Use the argument parser defaults
         parser = create_argv_parser()
-        self.opt = parser.parse_args()
-        default_width = 512
-        default_height = 512
-        config = "lstein_stable_diffusion/configs/stable-diffusion/v1-inference.yaml"
-        weights = "./model.ckpt"
+        return parser.parse_args()
+
+    async def _load_model(self):
+        # Load the model and run a warmup generation on the worker thread, then let the queue start
+        try:
+            tic = time.perf_counter()
+            if self.remote_workers is not None:
+                # Nothing to load here, jobs wait in the queue until a node takes them
+                await self.remote_workers.start(self.remote_host, self.remote_port)
+                self.logger.info(
+                    f"Waiting for generator nodes on http://{self.remote_host}:{self.remote_port}"
+                )
+            elif self.worker_devices:
+                # Each worker process loads and warms up its own model
+                self.worker_pool = WorkerPool(
+                    self.worker_devices,
+                    self._backend_factory(),
+                    warmup_steps=self.warmup_steps,
+                    conditioning_cache_bytes=self.conditioning_cache_bytes,
+                )
+                await self.queue.run_on_worker(self.worker_pool.start)
+                self.startup_timings["start workers"] = time.perf_counter() - tic
+                if self.vram_model.capacity is None:
+                    self.vram_model.capacity = self.worker_pool.min_vram
+            else:
+                self.t2i = await self.queue.run_on_worker(self._init_t2i)
+                self.startup_timings["load model"] = time.perf_counter() - tic
+                self.conditioning_cache = installConditioningCache(
+                    self.t2i, self.conditioning_cache_bytes
+                )
+                if self.vram_model.capacity is None:
+                    self.vram_model.capacity = detectVram(self.opt.device)
+
+            if self.warmup_steps > 0 and self.t2i is not None:
+                self.model_state = "warming up"
+                tic = time.perf_counter()
+                await self.queue.run_on_worker(self._warmup)
+                self.startup_timings["warmup"] = time.perf_counter() - tic
+            self.model_state = "ready"
+        except Exception:
+            self.logger.exception("Failed to load the model")
+            print("Failed to load the model")
+            self.model_state = "failed"
+        timings = ", ".join(f"{phase} {t:.1f}s" for phase, t in self.startup_timings.items())
+        self.logger.info(f"Model {self.model_state} ({timings})")
+        print(f"Model {self.model_state} ({timings})")
+        # Queued requests fail straight away if the model didn't load
+        self.queue.set_ready()
 
+    def _warmup(self):
+        # A tiny generation to get the CUDA kernels compiled and cached before the first real request
+        self.t2i.prompt2image(
+            prompt="warmup", iterations=1, steps=self.warmup_steps, seed=0, width=512, height=512
+        )
+
+    def _conditioning_cache_stats(self) -> dict:
+        # Conditioning cache counters added up over every process with a model
+        reports = []
+        if self.conditioning_cache is not None:
+            reports.append(self.conditioning_cache.stats())
+        if self.worker_pool is not None:
+            reports += [worker["conditioning_cache"] for worker in self.worker_pool.status()]
+        if self.remote_workers is not None:
+            reports += [node["conditioning_cache"] for node in self.remote_workers.status()]
+        totals = {"hits": 0, "misses": 0, "entries": 0, "bytes": 0}
+        for report in reports:
+            for name in totals:
+                totals[name] += (report or {}).get(name, 0)
+        return totals
+
+    def _backend_factory(self):
+        # Builds the models (a ModelRegistry) for a worker process, given its device
+        return functools.partial(
+            createModelRegistry,
+            vars(self.opt),
+            self.model_specs,
+            default=self.default_model,
+            max_resident=self.resident_models,
+            max_parked=self.parked_models,
+            profiles=self.profiles,
+        )
+
+    def _init_t2i(self):
         self.logger.info("Initialising txt2img...")
         print("Initialising txt2img...")
-        from pytorch_lightning import logging
-        from ldm.generate import Generate
-
-        # these two lines prevent a horrible warning message from appearing
-        # when the frozen CLIP tokenizer is imported
-        import transformers
-
-        transformers.logging.set_verbosity_error()
-
-        # gets rid of annoying messages about random seed
-        logging.getLogger("pytorch_lightning").setLevel(logging.ERROR)
-
-        # creating a simple text2image object with a handful of
-        # defaults passed on the command line.
-        # additional parameters will be added (or overriden) during
-        # the user input loop
-        t2i = Generate(
-            width=default_width,
-            height=default_height,
-            sampler_name=self.opt.sampler_name,
-            weights=weights,
-            full_precision=self.opt.full_precision,
-            config=config,
-            grid=self.opt.grid,
-            # this is solely for recreating the prompt
-            seamless=self.opt.seamless,
-            embedding_path=self.opt.embedding_path,
-            device_type=self.opt.device,
-            ignore_ctrl_c=self.opt.infile is None,
-        )
+        tic = time.perf_counter()
+        t2i = self._backend_factory()(None)
+        self.startup_timings["imports"] = time.perf_counter() - tic
+
+        # Load the default checkpoint now, rather than on the first request
+        t2i.load_model()
 
         self.logger.info("Initialised txt2img")
         print("Initialised txt2img")
         return t2i
 
+    def _generate(self, job: GenerationJob):
+        # Runs on the generation queue's worker thread.
+        # prompt2image stops and returns the images it has made so far if it runs out of VRAM,
+        # so any missing images get one more try (with the memory freed) before giving up
+        results = self._sample(job, job.kwargs)
+        missing = job.num_images - len(results)
+        if missing > 0 and not job.cancelled:
+            self.logger.warning(f"Only got {len(results)} of {job.num_images} images, retrying the rest")
+            if self.t2i is not None:
+                self._free_vram()
+            seed = None if results else job.kwargs.get("seed")
+            results += self._sample(job, dict(job.kwargs, iterations=missing, seed=seed))
+            if len(results) < job.num_images:
+                self.vram_model.observe_oom(num_images=1, **self._vram_args(job.kwargs))
+                raise OutOfVramError(f"ran out of VRAM after {len(results)} images")
+        self._observe_vram([job])
+        return results
+
+    def _generate_batch(self, jobs):
+        # Runs on the generation queue's worker thread.
+        # After running out of VRAM the queue splits the batch and tries again
+        try:
+            results = self._sample_batch(jobs)
+        except Exception as e:
+            if isOutOfMemory(e):
+                num_images = sum(job.num_images for job in jobs)
+                self.vram_model.observe_oom(num_images=num_images, **self._vram_args(jobs[0].kwargs))
+                if self.t2i is not None:
+                    self._free_vram()
+            raise
+        self._observe_vram(jobs)
+        return results
+
+    def _vram_args(self, kwargs: dict) -> dict:
+        # What the VRAM needed for an image depends on, besides how many are sampled at once
+        profile = self.profiles.get(kwargs.get("profile"))
+        return dict(
+            width=kwargs["width"],
+            height=kwargs["height"],
+            full_precision=(
+                self.opt.full_precision if profile is None else profile.full_precision(self.opt.full_precision)
+            ),
+            sampler=kwargs.get("sampler_name") or self.sampler_name,
+            attention_slicing=profile is not None and profile.attention_slicing,
+        )
+
+    def _batch_fits(self, jobs) -> bool:
+        num_images = sum(job.num_images for job in jobs)
+        return self.vram_model.fits(num_images=num_images, **self._vram_args(jobs[0].kwargs))
+
+    def _observe_vram(self, jobs):
+        # Calibrate the VRAM estimates from the measured peak. prompt2image samples its images
+        # one at a time, while a batch samples all of them at once
+        peak_vram = jobs[0].peak_vram
+        if peak_vram is None:
+            return
+        num_images = 1 if len(jobs) == 1 else sum(job.num_images for job in jobs)
+        self.vram_model.observe(
+            num_images=num_images, peak=peak_vram, **self._vram_args(jobs[0].kwargs)
+        )
+
+    def _sample(self, job: GenerationJob, kwargs: dict) -> list:
+        if self.remote_workers is not None:
+            return self.remote_workers.generate(job, kwargs)
+        if self.worker_pool is not None:
+            return self.worker_pool.generate(job, kwargs)
+        if self.t2i is None:
+            raise RuntimeError("Model is not loaded")
+        try:
+            with self._track_vram([job]):
+                return self.t2i.prompt2image(
+                    image_callback=None, step_callback=job.on_step, **kwargs
+                )
+        except GenerationCancelled:
+            self._free_vram()
+            raise
+
+    def _sample_batch(self, jobs) -> list:
+        if self.remote_workers is not None:
+            return self.remote_workers.generate_batch(jobs)
+        if self.worker_pool is not None:
+            return self.worker_pool.generate_batch(jobs)
+        if self.t2i is None:
+            raise RuntimeError("Model is not loaded")
+        try:
+            with self._track_vram(jobs):
+                return self.t2i.generate_batch(
+                    [job.kwargs for job in jobs],
+                    step_callbacks=[job.on_step for job in jobs],
+                )
+        except GenerationCancelled:
+            self._free_vram()
+            raise
+
+    @contextmanager
+    def _track_vram(self, jobs):
+        # Record the peak GPU memory used while generating these jobs
+        import torch
+
+        if not torch.cuda.is_available():
+            yield
+            return
+        torch.cuda.reset_peak_memory_stats()
+        try:
+            yield
+        finally:
+            peak_vram = torch.cuda.max_memory_allocated()
+            PEAK_VRAM_BYTES.observe(peak_vram)
+            for job in jobs:
+                job.peak_vram = peak_vram
+
+    def _free_vram(self):
+        # Release the memory held by a stopped generation so the next job has all of it
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    async def _run_query(self, ctx, prompt, query_kwargs, author, preview=False, options=None):
+        # Put the query on the generation queue, tell the user where it is, and wait for the results.
+        # Returns the finished job, or None if there was an error (which has already been reported).
+        # With options (the txt2img command options), the job is journaled so it survives a restart
+        header = f"“{prompt}”"
+        reporter = None
+        # Latents stay inside the worker processes, so there are no previews with a worker pool or remote nodes
+        if preview and not self.worker_devices and self.remote_workers is None:
+            reporter = PreviewReporter(
+                asyncio.get_running_loop(),
+                None,
+                header,
+                query_kwargs["steps"],
+                preview_every=self.preview_every,
+                min_interval=self.preview_interval,
+            )
+        job = GenerationJob(
+            query_kwargs,
+            author,
+            batch_key=batchKey(query_kwargs, self.sampler_name),
+            step_callback=None if reporter is None else reporter.step_callback,
+            affinity=query_kwargs["model"],
+            journal_id=None if options is None else self.journal.new_id(),
+        )
+        self.journal.record(
+            job.journal_id,
+            "submitted",
+            channel_id=ctx.channel_id,
+            user_id=ctx.author.id,
+            author=author,
+            options=options,
+        )
+        try:
+            jobs_ahead = self.queue.submit(job)
+        except QueueFullError as e:
+            self.journal.record(job.journal_id, "rejected")
+            await self.sendError(f"Error: {e}, try again later", ctx)
+            return None
+        except RateLimitError as e:
+            self.journal.record(job.journal_id, "rejected")
+            await self.sendError(f"Error: {e}", ctx)
+            return None
+        if self.t2i is not None:
+            # Start reading the model from disk while the job waits its turn (skipped if a model is
+            # being moved right now, which the event loop mustn't wait on)
+            self.t2i.prefetch(query_kwargs["model"], blocking=False)
+        view = CancelView(self.queue, job)
+        if self.model_state != "ready":
+            status_msg = await ctx.followup.send(
+                f"{header}\n> Waiting for the model to finish {self.model_state} "
+                f"({jobs_ahead} ahead in the queue)...",
+                view=view,
+            )
+        elif jobs_ahead == 0:
+            status_msg = await ctx.followup.send(f"{header}\n> Generating...", view=view)
+        else:
+            status_msg = await ctx.followup.send(
+                f"{header}\n> Queued at position {jobs_ahead} "
+                f"(estimated wait {self.queue.estimated_wait(job):.0f}s)...",
+                view=view,
+            )
+        if reporter is not None:
+            reporter.message = status_msg
+
+        error = None
+        try:
+            await job.future
+        except Exception as e:
+            error = e
+        # Stop previews before the final edit so they can't overwrite it
+        view.stop()
+        if reporter is not None:
+            await reporter.close()
+
+        if isinstance(error, GenerationCancelled):
+            await status_msg.edit(content=f"{header}\n> Cancelled", attachments=[], view=None)
+            return None
+        elif isinstance(error, OutOfVramError):
+            await status_msg.edit(attachments=[], view=None)
+            await self.sendError("Error: ran out of GPU memory, try a smaller size", ctx)
+            return None
+        elif error is not None:
+            await status_msg.edit(attachments=[], view=None)
+            await self.sendError("Error: generation failed, check logs", ctx)
+            return None
+        await status_msg.edit(
+            content=f"{header}\n> Done (waited {job.wait_time:.1f}s in queue)",
+            attachments=[],
+            view=None,
+        )
+        return job
+
+    async def _send_full_size(self, ctx, path: str):
+        # Send one saved image at full size, for the buttons under a grid preview
+        if not os.path.isfile(path):
+            # Still waiting to be written
+            await asyncio.get_running_loop().run_in_executor(None, self.image_store.flush)
+        if not os.path.isfile(path):
+            await self.sendError("Error: the image is no longer available", ctx)
+            return
+        (encoded,) = await encodeImages([path])
+        if not encoded.sendable:
+            await self.sendError("Error: image too large to be sent to discord", ctx)
+            return
+        file_name = f"{os.path.splitext(os.path.basename(path))[0]}.{encoded.extension}"
+        failed = await self.uploader.send(ctx, [(file_name, encoded.data)])
+        if failed:
+            await self.sendError("Error: the image couldn't be sent to discord", ctx)
+
+    async def _replay_journal(self, jobs: list):
+        # Pick up the requests that hadn't finished when the bot last stopped: images that were already
+        # generated and saved are sent to the channel the request came from, anything else is run again
+        await self.bot.wait_until_ready()
+        self.logger.info(f"Picking up {len(jobs)} unfinished request(s)")
+        print(f"Picking up {len(jobs)} unfinished request(s)")
+        for job in jobs:
+            try:
+                channel = self.bot.get_channel(job["channel_id"]) or await self.bot.fetch_channel(
+                    job["channel_id"]
+                )
+                user = self.bot.get_user(job["user_id"]) or await self.bot.fetch_user(job["user_id"])
+            except discord.HTTPException as e:
+                self.logger.warning(f"Can't pick up request {job['id']}: {e}")
+                self.journal.record(job["id"], "failed")
+                continue
+            ctx = ChannelContext(channel, user)
+            paths = job.get("paths")
+            if paths and all(os.path.isfile(path) for path in paths):
+                self.bot.loop.create_task(self._redeliver(ctx, job))
+            else:
+                # The new request is journaled in its own right
+                self.journal.record(job["id"], "replayed")
+                options = dict(job["options"])
+                request = GenerationRequest(**options.pop("request"))
+                self.bot.loop.create_task(self._txt2img(ctx, request, **options))
+
+    async def _redeliver(self, ctx: ChannelContext, job: dict):
+        request = job["options"]["request"]
+        encoded_images = await encodeImages(job["paths"])
+        upload_files = []
+        for path, encoded in zip(job["paths"], encoded_images):
+            file_name = os.path.basename(path)
+            if not encoded.sendable:
+                continue
+            if encoded.reduced:
+                file_name = f"{os.path.splitext(file_name)[0]}.{encoded.extension}"
+            upload_files.append((file_name, encoded.data))
+        msg_embed = discord.Embed(colour=discord.Colour.fuchsia())
+        seeds_str = "|".join(str(seed) for seed in job["seeds"])
+        s = "" if len(job["seeds"]) == 1 else "s"
+        msg_embed.add_field(name=request["prompt"], value=f"seed{s}: {seeds_str}")
+        msg_embed.set_footer(text="[Finished before the bot restarted]")
+        await self.uploader.send(ctx, upload_files, embed=msg_embed)
+        self.journal.record(job["id"], "delivered")
+
+    async def _run_tiled(self, ctx, prompt, query_kwargs, author, preview=False, options=None):
+        # Make an image too large to sample in one go: generate it at a base size (or start from the init image),
+        # upscale it, and refine it through img2img in overlapping tiles, blending them back together.
+        # GPU memory only ever holds a batch of tiles, however large the image.
+        # Returns (journal id, results, seconds taken), or None if there was an error (already reported)
+        tic = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        width, height = query_kwargs["width"], query_kwargs["height"]
+        journal_id = None
+        if query_kwargs.get("init_img"):
+            seed = query_kwargs["seed"]
+            base_results = [[query_kwargs["init_img"], random.randrange(2**32) if seed is None else seed]]
+        else:
+            base_width, base_height = draftSize(
+                width, height, math.sqrt(self.tile_size**2 / (width * height))
+            )
+            job = await self._run_query(
+                ctx,
+                prompt,
+                dict(query_kwargs, width=base_width, height=base_height),
+                author,
+                preview,
+                options,
+            )
+            if job is None:
+                return None
+            journal_id = job.journal_id
+            base_results = job.future.result()
+        if not base_results:
+            return journal_id, [], time.perf_counter() - tic
+
+        source, seed = base_results[0]
+        tiles = planTiles(width, height, self.tile_size, self.tile_overlap)
+        os.makedirs("./downloads", exist_ok=True)
+        with tempfile.TemporaryDirectory(dir="./downloads") as tile_dir:
+            tile_paths = await loop.run_in_executor(None, cropTiles, source, (width, height), tiles, tile_dir)
+            tile_images = await self._run_tiles(ctx, prompt, query_kwargs, author, seed, tile_paths)
+        if tile_images is None:
+            return None
+        image = await loop.run_in_executor(
+            None, blendTiles, (width, height), tiles, tile_images, self.tile_overlap
+        )
+        return journal_id, [[image, seed]], time.perf_counter() - tic
+
+    async def _run_tiles(self, ctx, prompt, query_kwargs, author, seed, tile_paths):
+        # Refine each tile through img2img, returning the refined tiles, or None if there was an error.
+        # The tiles are queued a batch's worth at a time, so they can be batched without filling the queue,
+        # and other users' requests get their turn in between
+        header = f"“{prompt}”"
+        jobs = []
+        for k, tile_path in enumerate(tile_paths):
+            with Image.open(tile_path) as tile:
+                tile_width, tile_height = tile.size
+            kwargs = dict(
+                query_kwargs,
+                width=tile_width,
+                height=tile_height,
+                iterations=1,
+                seed=(seed + k) % 2**32,
+                init_img=tile_path,
+                strength=self.tile_strength,
+            )
+            jobs.append(
+                GenerationJob(
+                    kwargs,
+                    author,
+                    batch_key=batchKey(kwargs, self.sampler_name),
+                    affinity=kwargs["model"],
+                )
+            )
+        view = CancelView(self.queue, *jobs)
+        status_msg = await ctx.followup.send(f"{header}\n> Refining {len(jobs)} tiles...", view=view)
+        wave_size = max(1, self.queue.max_batch_images)
+        error = None
+        for start in range(0, len(jobs), wave_size):
+            wave = jobs[start : start + wave_size]
+            try:
+                for job in wave:
+                    self.queue.submit(job)
+            except (QueueFullError, RateLimitError) as e:
+                for job in wave:
+                    self.queue.cancel(job)
+                error = e
+                break
+            for job in wave:
+                try:
+                    await job.future
+                except Exception as e:
+                    error = e
+            if error is not None:
+                break
+            await status_msg.edit(content=f"{header}\n> Refined {start + len(wave)}/{len(jobs)} tiles...")
+        view.stop()
+        if error is not None:
+            for job in jobs:
+                self.queue.cancel(job)
+
+        if isinstance(error, GenerationCancelled):
+            await status_msg.edit(content=f"{header}\n> Cancelled", view=None)
+            return None
+        elif error is not None:
+            await status_msg.edit(view=None)
+            if isinstance(error, (QueueFullError, RateLimitError)):
+                await self.sendError(f"Error: {error}", ctx)
+            elif isinstance(error, OutOfVramError):
+                await self.sendError("Error: ran out of GPU memory, try a smaller tile_size", ctx)
+            else:
+                await self.sendError("Error: generation failed, check logs", ctx)
+            return None
+        await status_msg.edit(content=f"{header}\n> Done", view=None)
+        return [job.future.result()[0][0] for job in jobs]
+
     async def sendError(self, err_msg, ctx):
         self.logger.warning(err_msg)
         error_embed = discord.Embed(colour=discord.Colour.red())
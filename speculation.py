@@ -0,0 +1,88 @@
+import logging as lg
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from generation_queue import GenerationJob
+from generation_request import GenerationRequest
+from metrics import SPECULATIVE_IMAGES_TOTAL
+
+
+class Speculator:
+    # Generates more seeds of recent requests while the GPU would otherwise be idle, so asking for more
+    # of the same (the "More like this" button, or the same request again without a seed) is answered
+    # straight away. The generation queue runs next_job() when it has nothing else to do, one image at
+    # a time, and stops it at the next sampling step as soon as a real job comes in.
+    # Up to per_request spare images (or as many as the request asked for) are kept for each of the
+    # max_requests most recent requests, the least recently made request being forgotten first.
+    # With is_resident (whether a model is on the GPU), only requests for a model already on the GPU are
+    # speculated on, so idle time never goes into swapping models for images nobody asked for yet.
+    def __init__(
+        self,
+        per_request: int = 2,
+        max_requests: int = 8,
+        is_resident: Optional[Callable[[Optional[str]], bool]] = None,
+    ):
+        self.logger = lg.getLogger(__name__)
+        self.per_request = per_request
+        self.max_requests = max_requests
+        self.is_resident = is_resident
+        self.generated = 0
+        self.served = 0
+        self.preempted = 0
+        # key -> query arguments, most recent last
+        self._requests: OrderedDict = OrderedDict()
+        # key -> [(image, seed)]
+        self._spares: Dict[tuple, List[tuple]] = {}
+
+    def key(self, kwargs: dict) -> tuple:
+        return GenerationRequest.from_kwargs(kwargs).key()
+
+    @property
+    def num_spares(self) -> int:
+        return sum(len(spares) for spares in self._spares.values())
+
+    def note(self, kwargs: dict):
+        # A request was made, which makes it the first to speculate on
+        key = self.key(kwargs)
+        self._requests[key] = kwargs
+        self._requests.move_to_end(key)
+        while len(self._requests) > self.max_requests:
+            forgotten, _ = self._requests.popitem(last=False)
+            self._spares.pop(forgotten, None)
+
+    def take(self, kwargs: dict, n: int) -> Optional[list]:
+        # n spare (image, seed) results for a request with a random seed, or None if there aren't that many
+        spares = self._spares.get(self.key(kwargs), [])
+        if len(spares) < n:
+            return None
+        taken = spares[:n]
+        del spares[:n]
+        self.served += n
+        SPECULATIVE_IMAGES_TOTAL.inc(n, outcome="served")
+        return taken
+
+    def next_job(self) -> Optional[GenerationJob]:
+        # A job for one more image of the most recent request that's short of spares, if there is one
+        for key, kwargs in reversed(self._requests.items()):
+            if self.is_resident is not None and not self.is_resident(kwargs.get("model")):
+                continue
+            # Enough for the whole request to be answered again
+            if len(self._spares.get(key, [])) < max(self.per_request, kwargs.get("iterations") or 1):
+                kwargs = dict(kwargs, seed=None, iterations=1)
+                return GenerationJob(kwargs, "speculation", affinity=kwargs.get("model"))
+        return None
+
+    def done(self, job: GenerationJob, results: Optional[list]):
+        key = self.key(job.kwargs)
+        if results is None:
+            if job.cancelled:
+                self.preempted += 1
+                SPECULATIVE_IMAGES_TOTAL.inc(outcome="preempted")
+            else:
+                # Failed, so don't keep trying
+                self._requests.pop(key, None)
+            return
+        self.generated += len(results)
+        SPECULATIVE_IMAGES_TOTAL.inc(len(results), outcome="generated")
+        if key in self._requests:
+            self._spares.setdefault(key, []).extend(results)
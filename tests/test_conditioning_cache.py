@@ -0,0 +1,74 @@
+import numpy as np
+
+from benchmarks.stub_generate import StubGenerate
+from conditioning_cache import ConditioningCache, installConditioningCache, normalizePrompt
+
+
+class Encoder:
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, c):
+        self.texts.append(c)
+        return np.zeros((1, 77, 768), dtype=np.float16)
+
+
+ENTRY_BYTES = 77 * 768 * 2
+
+
+def test_normalize_prompt():
+    assert normalizePrompt("  A  Red\tFox ") == "a red fox"
+
+
+def test_repeated_texts_encoded_once_per_model():
+    cache = ConditioningCache(10 * ENTRY_BYTES)
+    encoder = Encoder()
+    first = cache.get("m1", "a red fox", encoder)
+    assert cache.get("m1", "A red  fox", encoder) is first
+    cache.get("m2", "a red fox", encoder)
+    assert encoder.texts == ["a red fox", "a red fox"]
+    assert cache.stats() == {"hits": 1, "misses": 2, "entries": 2, "bytes": 2 * ENTRY_BYTES}
+
+
+def test_least_recently_used_evicted_over_max_bytes():
+    cache = ConditioningCache(2 * ENTRY_BYTES)
+    encoder = Encoder()
+    for text in ("a", "b", "a", "c"):
+        cache.get("m", text, encoder)
+    cache.get("m", "b", encoder)
+    assert encoder.texts == ["a", "b", "c", "b"]
+    assert cache.bytes <= 2 * ENTRY_BYTES
+
+
+def test_too_large_values_not_cached():
+    cache = ConditioningCache(ENTRY_BYTES - 1)
+    encoder = Encoder()
+    cache.get("m", "a", encoder)
+    cache.get("m", "a", encoder)
+    assert len(cache) == 0 and encoder.texts == ["a", "a"]
+
+
+def test_wrap_caches_single_texts_only():
+    cache = ConditioningCache(10 * ENTRY_BYTES)
+    encoder = Encoder()
+    cached = cache.wrap(encoder, "m")
+    cached("a")
+    cached(["a"])
+    cached(["a", "b"])
+    assert encoder.texts == ["a", ["a", "b"]]
+    assert cached.__wrapped__ is encoder
+
+
+def test_installed_in_front_of_every_model_once():
+    t2i = StubGenerate()
+    t2i.load_model()
+    cache = installConditioningCache(t2i, 10 * ENTRY_BYTES)
+    encoder = t2i.model.get_learned_conditioning
+    assert cache.install(t2i)
+    # Installing again replaces the wrapper instead of stacking another
+    assert t2i.model.get_learned_conditioning.__wrapped__ is encoder.__wrapped__
+    t2i.prompt2image("a fox", steps=1, width=64, height=64)
+    t2i.prompt2image("a fox", steps=1, width=64, height=64)
+    # The empty unconditional prompt and the prompt, encoded once each
+    assert (cache.misses, cache.hits) == (2, 2)
+    assert installConditioningCache(t2i, 0) is None
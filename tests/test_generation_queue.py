@@ -0,0 +1,199 @@
+import asyncio
+import time
+
+import pytest
+
+from generation_queue import GenerationCancelled, GenerationJob, GenerationQueue, QueueFullError
+from rate_limit import RateLimitError, UserRateLimiter
+
+
+def job(author, prompt="x", n=1, width=512, height=512, steps=50, batch_key=None, affinity=None):
+    kwargs = dict(prompt=prompt, iterations=n, width=width, height=height, steps=steps)
+    return GenerationJob(kwargs, author, batch_key=batch_key, affinity=affinity)
+
+
+def run(jobs, batch_error=None, **queue_options):
+    # Queue every job before the worker starts, then run them all, returning the calls made in order:
+    # ("single", prompt) for generate_fn and ("batch", [prompts]) for batch_fn (which raises batch_error if given)
+    calls = []
+
+    def generate(job):
+        calls.append(("single", job.kwargs["prompt"]))
+        return [(None, 0)] * job.num_images
+
+    def generate_batch(batch):
+        calls.append(("batch", [job.kwargs["prompt"] for job in batch]))
+        if batch_error is not None:
+            raise batch_error
+        return [[(None, 0)] * job.num_images for job in batch]
+
+    async def main():
+        queue = GenerationQueue(generate, batch_fn=generate_batch, ready=False, **queue_options)
+        for j in jobs:
+            queue.submit(j)
+        queue.set_ready()
+        return await asyncio.gather(*(j.future for j in jobs))
+
+    results = asyncio.run(main())
+    assert [len(result) for result in results] == [j.num_images for j in jobs]
+    return calls
+
+
+def test_compatible_jobs_batched_together():
+    jobs = [
+        job("alice", "a", batch_key=1),
+        job("bob", "b", batch_key=2),
+        job("carol", "c", batch_key=1),
+        job("dave", "d", batch_key=1),
+    ]
+    assert run(jobs) == [("batch", ["a", "c", "d"]), ("single", "b")]
+
+
+def test_unbatchable_jobs_run_one_at_a_time():
+    jobs = [job("alice", "a"), job("bob", "b")]
+    assert run(jobs) == [("single", "a"), ("single", "b")]
+
+
+def test_batch_limited_by_images_and_pixels():
+    jobs = [job(f"u{k}", f"p{k}", n=2, batch_key=1) for k in range(3)]
+    assert run(jobs, max_batch_images=4) == [("batch", ["p0", "p1"]), ("batch", ["p2"])]
+    jobs = [job(f"u{k}", f"p{k}", width=768, height=768, batch_key=1) for k in range(3)]
+    calls = run(jobs, max_batch_pixels=2 * 768 * 768)
+    assert calls == [("batch", ["p0", "p1"]), ("single", "p2")]
+
+
+def test_failed_batch_falls_back_to_single_jobs():
+    jobs = [job("alice", "a", batch_key=1), job("bob", "b", batch_key=1)]
+    calls = run(jobs, batch_error=RuntimeError("batch failed"))
+    assert calls == [("batch", ["a", "b"]), ("single", "a"), ("single", "b")]
+
+
+def test_lone_job_of_several_images_sampled_as_one_batch():
+    assert run([job("alice", "draft", n=4, width=256, height=256, batch_key=1)]) == [("batch", ["draft"])]
+
+
+def test_lone_job_over_batch_limits_runs_on_its_own():
+    assert run([job("alice", "big", n=4, width=768, height=768, batch_key=1)]) == [("single", "big")]
+    assert run([job("alice", "many", n=6, batch_key=1)], max_batch_images=4) == [("single", "many")]
+    assert run([job("alice", "one", batch_key=1)]) == [("single", "one")]
+
+
+def test_lone_job_batch_failure_falls_back_to_generate():
+    calls = run([job("alice", "draft", n=4, batch_key=1)], batch_error=RuntimeError("batch failed"))
+    assert calls == [("batch", ["draft"]), ("single", "draft")]
+
+
+def test_fair_queueing_interleaves_users():
+    jobs = [job("alice", "a1"), job("alice", "a2"), job("alice", "a3"), job("bob", "b1")]
+    assert run(jobs) == [("single", "a1"), ("single", "b1"), ("single", "a2"), ("single", "a3")]
+
+
+def test_user_weights():
+    jobs = [job("alice", "a1"), job("alice", "a2"), job("bob", "b1"), job("bob", "b2")]
+    calls = run(jobs, user_weights={"bob": 2.0})
+    assert calls == [("single", "b1"), ("single", "a1"), ("single", "b2"), ("single", "a2")]
+
+
+def test_expensive_job_goes_after_cheap_ones():
+    jobs = [job("alice", "big", steps=200), job("bob", "small", steps=20), job("carol", "medium", steps=50)]
+    assert [prompt for _, prompt in run(jobs)] == ["small", "medium", "big"]
+
+
+def test_full_queue_and_rate_limit_reject_jobs():
+    async def main():
+        queue = GenerationQueue(lambda job: [], ready=False, maxsize=2, rate_limiter=UserRateLimiter(2, 0.01))
+        queue.submit(job("alice"))
+        # Four standard images' worth, more than the bucket holds, is still let through on a full bucket
+        queue.submit(job("bob", n=4))
+        with pytest.raises(QueueFullError):
+            queue.submit(job("carol"))
+        queue = GenerationQueue(lambda job: [], ready=False, rate_limiter=UserRateLimiter(2, 0.01))
+        queue.submit(job("alice", n=2))
+        with pytest.raises(RateLimitError):
+            queue.submit(job("alice"))
+        assert len(queue) == 1
+
+    asyncio.run(main())
+
+
+def test_cancel_queued_and_running_jobs():
+    started = []
+
+    def generate(job):
+        started.append(job.kwargs["prompt"])
+        # Sample until cancelled
+        for step in range(1000):
+            job.on_step(None, step)
+            time.sleep(0.01)
+        return [(None, 0)]
+
+    async def main():
+        queue = GenerationQueue(generate)
+        running, queued = job("alice", "running"), job("bob", "queued")
+        queue.submit(running)
+        queue.submit(queued)
+        await asyncio.sleep(0.05)
+        assert queue.cancel(queued)
+        assert len(queue) == 0
+        assert queue.cancel(running)
+        assert not queue.cancel(running)
+        for j in (running, queued):
+            with pytest.raises(GenerationCancelled):
+                await j.future
+        # The worker is free again once the running job stops at its next step
+        done = job("carol", "done")
+        done.kwargs["steps"] = 0
+        queue.generate_fn = lambda job: [(None, 0)]
+        queue.submit(done)
+        await asyncio.wait_for(done.future, 5)
+        return [j.outcome for j in (running, queued, done)]
+
+    assert asyncio.run(main()) == ["cancelled", "cancelled", "done"]
+    assert started == ["running"]
+
+
+def test_batch_kept_to_what_fits_and_split_on_out_of_memory():
+    jobs = [job(f"u{k}", f"p{k}", batch_key=1) for k in range(4)]
+    calls = run(jobs, batch_fits=lambda batch: len(batch) <= 3)
+    assert calls == [("batch", ["p0", "p1", "p2"]), ("single", "p3")]
+
+    calls = []
+
+    def generate(job):
+        calls.append(("single", job.kwargs["prompt"]))
+        return [(None, 0)]
+
+    def generate_batch(batch):
+        calls.append(("batch", [job.kwargs["prompt"] for job in batch]))
+        # Anything more than one image runs out of memory
+        if len(batch) > 1:
+            raise RuntimeError("CUDA out of memory")
+        return [[(None, 0)] for job in batch]
+
+    async def main():
+        queue = GenerationQueue(generate, batch_fn=generate_batch, ready=False)
+        jobs = [job(f"u{k}", f"p{k}", batch_key=1) for k in range(3)]
+        for j in jobs:
+            queue.submit(j)
+        queue.set_ready()
+        await asyncio.gather(*(j.future for j in jobs))
+
+    asyncio.run(main())
+    # Halved down to lone jobs, which run on their own
+    assert calls == [("batch", ["p0", "p1", "p2"]), ("single", "p0"), ("batch", ["p1", "p2"]), ("single", "p1"),
+                     ("single", "p2")]
+
+
+def test_affinity_jumps_ahead_within_slack():
+    jobs = [
+        job("alice", "a-m1", affinity="m1"),
+        job("bob", "b-m2", affinity="m2"),
+        job("carol", "c-m1", affinity="m1"),
+    ]
+    assert [prompt for _, prompt in run(jobs, affinity_slack=2)] == ["a-m1", "c-m1", "b-m2"]
+    jobs = [
+        job("alice", "a-m1", affinity="m1"),
+        job("bob", "b-m2", affinity="m2"),
+        job("carol", "c-m1", affinity="m1"),
+    ]
+    assert [prompt for _, prompt in run(jobs)] == ["a-m1", "b-m2", "c-m1"]
@@ -0,0 +1,66 @@
+import pickle
+
+import pytest
+
+from generation_request import GenerationRequest, RequestError, parseRequest
+
+
+def test_parse_options():
+    request = parseRequest('a castle   on a hill -n2 -W 768 --seed=42 -s30 --sampler k_euler --profile fast')
+    assert request.prompt == "a castle on a hill"
+    assert (request.iterations, request.width, request.seed, request.steps) == (2, 768, 42, 30)
+    assert request.sampler_name == "k_euler"
+    assert request.profile == "fast"
+
+
+def test_parse_defaults_and_negative_numbers_in_prompt():
+    request = parseRequest("temperature -5 degrees", steps=20, model="m")
+    assert request.prompt == "temperature -5 degrees"
+    assert request.steps == 20
+    assert request.model == "m"
+
+
+def test_parse_apostrophe():
+    assert parseRequest("a cat's hat -S 1").prompt == "a cat's hat"
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["-n 2", "a dog -x 1", "a dog -W", "a dog -n 0", "a dog -n 11", "a dog -W 32", "a dog -s 0", "a dog -S -1",
+     "a dog -C 0", "a dog -W big"],
+)
+def test_parse_invalid(text):
+    with pytest.raises(RequestError):
+        parseRequest(text)
+
+
+def test_sizes_rounded_to_multiples_of_64():
+    request = GenerationRequest("x", width=700, height=513)
+    assert (request.width, request.height) == (640, 512)
+
+
+def test_invalid_strength():
+    with pytest.raises(RequestError):
+        GenerationRequest("x", init_img="in.png", strength=1.0)
+
+
+def test_immutable_and_replace():
+    request = GenerationRequest("x", seed=1)
+    with pytest.raises(AttributeError):
+        request.seed = 2
+    changed = request.replace(seed=2)
+    assert (request.seed, changed.seed) == (1, 2)
+    with pytest.raises(RequestError):
+        request.replace(steps=-1)
+
+
+def test_key_ignores_seed_and_count():
+    request = GenerationRequest("x", seed=1, iterations=3)
+    assert request.key() == request.replace(seed=None, iterations=1).key()
+    assert request.key() != request.replace(steps=10).key()
+
+
+def test_kwargs_and_pickle_round_trip():
+    request = GenerationRequest("x", seed=5, model="m", profile="fast")
+    assert GenerationRequest.from_kwargs(dict(request.to_kwargs(), extra=1)) == request
+    assert pickle.loads(pickle.dumps(request)) == request
@@ -0,0 +1,71 @@
+import asyncio
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from image_encoding import encodeGridImage, encodeImage, encodeImages
+
+
+def noise(width=256, height=256, seed=0) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+def jpegSize(img: Image.Image, quality: int) -> int:
+    buffer = BytesIO()
+    img.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return len(buffer.getvalue())
+
+
+def test_small_image_sent_as_the_png():
+    encoded = encodeImage(Image.new("RGB", (64, 64), (10, 20, 30)))
+    assert encoded.format == "PNG" and not encoded.reduced
+    assert encoded.data is encoded.png
+    assert Image.open(BytesIO(encoded.data)).getpixel((0, 0)) == (10, 20, 30)
+
+
+def test_large_image_gets_highest_jpeg_quality_under_limit():
+    img = noise()
+    limit = jpegSize(img, 50) + 1
+    encoded = encodeImage(img, size_limit=limit)
+    assert encoded.format == "JPEG" and encoded.extension == "jpeg"
+    assert len(encoded) <= limit
+    assert jpegSize(img, encoded.quality + 1) > limit
+    # The lossless PNG is still kept for the archive
+    assert Image.open(BytesIO(encoded.png)).format == "PNG"
+
+
+def test_nothing_to_send_when_it_cant_fit():
+    encoded = encodeImage(noise(), size_limit=100)
+    assert not encoded.sendable
+    assert len(encoded) == 0
+    assert encoded.png is not None
+
+
+def test_png_file_reused_without_decoding(tmp_path):
+    path = tmp_path / "image.png"
+    noise(32, 32).save(path)
+    encoded = encodeImage(str(path))
+    assert encoded.data == path.read_bytes()
+
+
+def test_encode_images_in_pool_keeps_order():
+    images = [noise(64, 64, seed) for seed in range(3)]
+    encoded = asyncio.run(encodeImages(images))
+    assert [Image.open(BytesIO(e.data)).tobytes() for e in encoded] == [img.tobytes() for img in images]
+
+
+def test_grid_of_numbered_thumbnails():
+    pngs = []
+    for k in range(5):
+        buffer = BytesIO()
+        noise(512, 256, seed=k).save(buffer, format="PNG")
+        pngs.append(buffer.getvalue())
+    encoded = encodeGridImage(pngs, cell_size=128)
+    assert encoded.format in ("WEBP", "JPEG")
+    grid = Image.open(BytesIO(encoded.data))
+    assert grid.format == encoded.format
+    # 3 columns and 2 rows of 128x64 thumbnails
+    assert grid.size == (3 * 128, 2 * 64)
+    assert len(encoded.data) < sum(len(png) for png in pngs) / 10
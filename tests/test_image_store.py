@@ -0,0 +1,67 @@
+import os
+import threading
+from datetime import datetime
+
+import pytest
+
+from image_store import ImageStore, safeFilename
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ImageStore(str(tmp_path / "outputs"), flush_interval=0.05)
+    yield store
+    store.close()
+
+
+def save(store, prompt, seed, author="alice", created=1700000000.0, **kwargs):
+    path = store.path_for(prompt, seed, author, created)
+    store.save(path, b"png " + prompt.encode(), dict(prompt=prompt, seed=seed, author=author, created=created), **kwargs)
+    return path
+
+
+def test_safe_filename():
+    assert safeFilename("a castle, on a hill! / \\ ..") == "a_castle_on_a_hill"
+    assert safeFilename("???") == "image"
+    assert len(safeFilename("x" * 100, max_length=10)) == 10
+
+
+def test_saved_into_dated_folders_and_indexed(store):
+    path = save(store, "a red fox", 42)
+    assert store.flush(5)
+    assert os.path.dirname(path).endswith(datetime.fromtimestamp(1700000000.0).strftime(os.path.join("%Y", "%m", "%d")))
+    with open(path, "rb") as f:
+        assert f.read() == b"png a red fox"
+    assert len(store) == 1
+    assert store.saved == 1 and store.pending == 0
+
+
+def test_find_by_prompt_words_seed_and_author(store):
+    save(store, "a red fox in the snow", 1, created=1700000000.0)
+    save(store, "a blue fox", 2, author="bob", created=1700000001.0)
+    save(store, "a red car", 3, created=1700000002.0)
+    store.flush(5)
+    assert [row["seed"] for row in store.find("fox")] == [2, 1]
+    assert [row["seed"] for row in store.find("red fox")] == [1]
+    assert [row["seed"] for row in store.find(seed=3)] == [3]
+    assert [row["seed"] for row in store.find("fox", author="bob")] == [2]
+    assert [row["seed"] for row in store.find(limit=1)] == [3]
+    # Search text is never read as query syntax
+    assert store.find('fox" OR "car') == []
+    assert store.find("!!!") == []
+
+
+def test_on_saved_called_once_written(store):
+    written = threading.Event()
+    path = save(store, "a fox", 1, on_saved=lambda: written.set() if os.path.isfile(path) else None)
+    assert written.wait(5)
+
+
+def test_unwritable_image_counted_as_failed(store, tmp_path):
+    blocker = tmp_path / "outputs" / "blocked"
+    blocker.write_bytes(b"")
+    called = []
+    store.save(str(blocker / "image.png"), b"png", dict(prompt="x", author="a"), on_saved=lambda: called.append(1))
+    store.flush(5)
+    assert store.failed == 1 and called == []
+    assert len(store) == 0
@@ -0,0 +1,77 @@
+from configparser import ConfigParser
+from types import SimpleNamespace
+
+from generation_request import GenerationRequest
+from inference_profiles import (
+    ATTENTION_SLICE_SIZE,
+    BUILTIN_PROFILES,
+    InferenceProfile,
+    profileApplied,
+    readProfiles,
+)
+
+
+class CrossAttention:
+    def forward(self, x, context=None, mask=None):
+        return x
+
+
+class Model:
+    def __init__(self):
+        self.attention = CrossAttention()
+
+    def modules(self):
+        return [self, self.attention]
+
+
+def settings(profile):
+    return profile.max_steps, profile.sampler_name, profile.half_precision, profile.attention_slicing
+
+
+def test_adjust_caps_steps_and_keeps_the_users_sampler():
+    fast = BUILTIN_PROFILES["fast"]
+    request = fast.adjust(GenerationRequest("x", steps=50))
+    assert (request.steps, request.sampler_name, request.profile) == (25, "k_euler", "fast")
+    request = fast.adjust(GenerationRequest("x", steps=10, sampler_name="ddim"))
+    assert (request.steps, request.sampler_name) == (10, "ddim")
+    request = BUILTIN_PROFILES["quality"].adjust(GenerationRequest("x", steps=80))
+    assert (request.steps, request.sampler_name, request.profile) == (80, None, "quality")
+
+
+def test_precision_never_above_how_the_weights_were_loaded():
+    assert BUILTIN_PROFILES["quality"].full_precision(True)
+    assert not BUILTIN_PROFILES["quality"].full_precision(False)
+    assert not BUILTIN_PROFILES["fast"].full_precision(True)
+    assert InferenceProfile("default").full_precision(True)
+
+
+def test_profiles_read_from_config():
+    config = ConfigParser()
+    config.read_string(
+        "[profile.fast]\nmax_steps = 20\n"
+        "[profile.tiny]\nmax_steps = 10\nsampler = k_lms\nhalf_precision = yes\ndescription = Tiny\n"
+    )
+    profiles = readProfiles(config)
+    assert profiles["quality"] is BUILTIN_PROFILES["quality"]
+    # Changed, keeping what isn't set
+    assert settings(profiles["fast"]) == (20, "k_euler", True, True)
+    assert settings(profiles["tiny"]) == (10, "k_lms", True, False)
+    assert profiles["tiny"].summary() == "up to 10 steps, k_lms, half precision"
+
+
+def test_profile_applied_then_undone():
+    sampler_changes = []
+    t2i = SimpleNamespace(sampler_name="k_lms", full_precision=True, model=Model())
+    t2i._set_sampler = lambda: sampler_changes.append(t2i.sampler_name)
+    attention = t2i.model.attention
+    with profileApplied(t2i, BUILTIN_PROFILES["fast"]):
+        assert not t2i.full_precision
+        assert attention.attention_slice_size == ATTENTION_SLICE_SIZE
+        # As a job's sampler_name would
+        t2i.sampler_name = "k_euler"
+    assert t2i.full_precision
+    assert attention.attention_slice_size is None
+    assert t2i.sampler_name == "k_lms" and sampler_changes == ["k_lms"]
+    with profileApplied(t2i, None):
+        assert t2i.full_precision
+    assert sampler_changes == ["k_lms"]
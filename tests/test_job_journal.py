@@ -0,0 +1,46 @@
+import json
+
+from job_journal import JobJournal
+
+
+def test_unfinished_jobs_recovered_after_restart(tmp_path):
+    path = str(tmp_path / "jobs.journal")
+    journal = JobJournal(path)
+    assert journal.unfinished == []
+    for job_id in ("done", "saved", "queued", "failed"):
+        journal.record(job_id, "submitted", prompt=job_id, channel=1)
+    journal.record("done", "saved", paths=["a.png"])
+    journal.record("done", "delivered")
+    journal.record("saved", "saved", paths=["b.png"], seeds=[7])
+    journal.record("failed", "failed")
+    journal.record(None, "submitted")
+    journal.close()
+    journal.record("queued", "delivered")
+
+    journal = JobJournal(path)
+    unfinished = {job["id"]: job for job in journal.unfinished}
+    assert sorted(unfinished) == ["queued", "saved"]
+    # Fields from every record of a job are merged, the latest state winning
+    assert unfinished["saved"]["state"] == "saved"
+    assert unfinished["saved"]["prompt"] == "saved" and unfinished["saved"]["paths"] == ["b.png"]
+    assert unfinished["queued"]["state"] == "submitted" and unfinished["queued"]["channel"] == 1
+    journal.close()
+
+
+def test_journal_compacted_and_replayed_jobs_finished(tmp_path):
+    path = str(tmp_path / "jobs.journal")
+    journal = JobJournal(path)
+    journal.record("old", "delivered")
+    journal.record("lost", "started", prompt="x")
+    journal.close()
+    with open(path, "a", encoding="utf-8") as f:
+        # A line cut short by a crash
+        f.write('{"id": "half", "sta')
+
+    journal = JobJournal(path)
+    assert [job["id"] for job in journal.unfinished] == ["lost"]
+    with open(path, encoding="utf-8") as f:
+        assert [json.loads(line)["id"] for line in f] == ["lost"]
+    journal.record("lost", "replayed")
+    journal.close()
+    assert JobJournal(path).unfinished == []
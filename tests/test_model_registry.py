@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+
+from benchmarks.stub_generate import createStubRegistry
+from model_registry import ModelSpec, parseModelSpec
+
+
+def registry(**kwargs):
+    specs = [ModelSpec(name, f"{name}.ckpt") for name in ("a", "b", "c")]
+    return createStubRegistry({"seconds_per_step": 0.0}, specs, **kwargs)
+
+
+def states(models):
+    return {status["name"]: status["state"] for status in models.status()}
+
+
+def test_parse_model_spec():
+    spec = parseModelSpec("anime", " anime.ckpt , anime.yaml ")
+    assert (spec.name, spec.weights, spec.config) == ("anime", "anime.ckpt", "anime.yaml")
+
+
+def test_unknown_model():
+    with pytest.raises(ValueError):
+        registry().resolve("d")
+    assert registry().resolve(None) == "a"
+
+
+def test_least_recently_used_parked_then_dropped():
+    models = registry(max_resident=1, max_parked=1)
+    for name in ("a", "b", "c"):
+        models.get(name)
+    assert states(models) == {"a": "unloaded", "b": "parked", "c": "resident"}
+    # Back from CPU RAM, without reading it from disk again
+    models.get("b")
+    assert states(models) == {"a": "unloaded", "b": "resident", "c": "parked"}
+    assert models.swaps == 4
+    assert [status["loads"] for status in models.status()] == [1, 2, 1]
+
+
+def test_no_parking_drops_straight_away():
+    models = registry(max_resident=1, max_parked=0)
+    models.get("a")
+    models.get("b")
+    assert states(models) == {"a": "unloaded", "b": "resident", "c": "unloaded"}
+
+
+def test_several_resident():
+    models = registry(max_resident=2, max_parked=0)
+    models.get("a")
+    models.get("b")
+    assert models.is_resident("a") and models.is_resident("b")
+    models.get("a")
+    models.get("c")
+    assert states(models) == {"a": "resident", "b": "unloaded", "c": "resident"}
+
+
+def test_prefetch_reads_into_cpu_ram_in_background():
+    models = registry(max_resident=1, max_parked=1)
+    models.get("a")
+    models.prefetch("b")
+    models._entries["b"].building.result(5)
+    assert states(models) == {"a": "resident", "b": "parked", "c": "unloaded"}
+    models.prefetch("c")
+    models._entries["c"].building.result(5)
+    # Only room for one parked model
+    assert states(models) == {"a": "resident", "b": "unloaded", "c": "parked"}
+
+
+def test_prefetch_without_blocking_skipped_while_busy():
+    models = registry()
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with models._lock:
+            held.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait(5)
+    tic = time.monotonic()
+    models.prefetch("b", blocking=False)
+    assert time.monotonic() - tic < 1
+    release.set()
+    thread.join()
+    assert states(models)["b"] == "unloaded"
+
+
+def test_jobs_generated_with_their_model():
+    models = registry()
+    [(image, seed)] = models.prompt2image(model="c", prompt="x", width=64, height=64, steps=1, seed=3)
+    assert seed == 3 and models.is_resident("c")
+    results = models.generate_batch([dict(model="b", prompt="x", width=64, height=64, steps=1, seed=4)])
+    assert results[0][0][1] == 4 and models.is_resident("b") and not models.is_resident("c")
@@ -0,0 +1,53 @@
+import asyncio
+
+from PIL import Image
+
+from previews import PreviewReporter
+
+
+class Message:
+    def __init__(self):
+        self.edits = []
+
+    async def edit(self, content, file, attachments):
+        self.edits.append(content)
+
+
+def test_step_callback_only_every_few_steps():
+    reporter = PreviewReporter(None, Message(), "header", steps=20, preview_every=5)
+    # Anything else would need torch to project the latents
+    for step in (0, 1, 2, 3, 5):
+        reporter.step_callback(None, step)
+
+
+def test_edits_throttled_to_latest_preview():
+    async def main():
+        message = Message()
+        reporter = PreviewReporter(asyncio.get_running_loop(), message, "header", steps=20, min_interval=0.2)
+        image = Image.new("RGB", (64, 32))
+        reporter._update(image, 4)
+        await asyncio.sleep(0.05)
+        # Steps arriving during the wait are squashed into one edit, for the latest
+        reporter._update(image, 9)
+        reporter._update(image, 14)
+        await asyncio.sleep(0.3)
+        await reporter.close()
+        return message.edits
+
+    edits = asyncio.run(main())
+    assert edits == ["header\n> Generating... step 5/20", "header\n> Generating... step 15/20"]
+
+
+def test_no_previews_without_message_or_after_close():
+    async def main():
+        reporter = PreviewReporter(asyncio.get_running_loop(), None, "header", steps=20, min_interval=0)
+        image = Image.new("RGB", (64, 64))
+        reporter._update(image, 4)
+        message = Message()
+        reporter.message = message
+        await reporter.close()
+        reporter._update(image, 9)
+        await asyncio.sleep(0.01)
+        return message.edits
+
+    assert asyncio.run(main()) == []
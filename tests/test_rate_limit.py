@@ -0,0 +1,60 @@
+import pytest
+
+import rate_limit
+from rate_limit import RateLimitError, TokenBucket, UserRateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_allows_burst_then_waits_for_refill(clock):
+    bucket = TokenBucket(capacity=3, rate=0.5)
+    assert [bucket.take(1) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(1) == pytest.approx(2.0)
+    clock.now += 2.0
+    assert bucket.take(1) == 0.0
+
+
+def test_bucket_lets_big_request_through_when_full_and_goes_into_debt(clock):
+    bucket = TokenBucket(capacity=2, rate=1.0)
+    assert bucket.take(5) == 0.0
+    assert bucket.tokens == -3
+    # Back to needing one token: three to pay off the debt, then one more
+    assert bucket.take(1) == pytest.approx(4.0)
+
+
+def test_bucket_never_fills_past_capacity(clock):
+    bucket = TokenBucket(capacity=2, rate=1.0)
+    clock.now += 100
+    assert bucket.full
+    bucket.take(2)
+    assert bucket.take(1) == pytest.approx(1.0)
+
+
+def test_user_limits_are_separate(clock):
+    limiter = UserRateLimiter(capacity=1, rate=0.1)
+    limiter.take("alice", 1)
+    limiter.take("bob", 1)
+    with pytest.raises(RateLimitError) as error:
+        limiter.take("alice", 1)
+    assert error.value.retry_after == pytest.approx(10.0)
+
+
+def test_idle_users_forgotten(clock):
+    limiter = UserRateLimiter(capacity=1, rate=1.0)
+    limiter.take("alice", 1)
+    clock.now += 5
+    limiter.take("bob", 1)
+    assert set(limiter._buckets) == {"bob"}
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+from io import BytesIO
+
+import aiohttp
+import pytest
+from PIL import Image
+
+from generation_queue import GenerationJob
+from model_registry import DEFAULT_MODEL
+from remote_workers import RemoteWorkers
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def freePort() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def startNode(port: int, cwd: str) -> subprocess.Popen:
+    # A stub generator node, as if on another machine: it shares no files with the bot
+    return subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(REPO_DIR, "generator_node.py"),
+            "--server",
+            f"http://127.0.0.1:{port}",
+            "--token",
+            "secret",
+            "--stub",
+            json.dumps({"seconds_per_step": 0.0, "seconds_per_megapixel_step": 0.0}),
+        ],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def test_img2img_lease_runs_on_node_in_another_directory(tmp_path, monkeypatch):
+    bot_dir = tmp_path / "bot"
+    node_dir = tmp_path / "node"
+    (bot_dir / "downloads").mkdir(parents=True)
+    node_dir.mkdir()
+    monkeypatch.chdir(bot_dir)
+    # Relative to the bot's directory, like the image fetcher's downloads
+    Image.new("RGB", (64, 64), (255, 0, 0)).save("downloads/init.png")
+    kwargs = dict(
+        prompt="x", width=64, height=64, steps=4, seed=3, init_img="downloads/init.png", strength=0.5,
+        model=DEFAULT_MODEL,
+    )
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        port = freePort()
+        workers = RemoteWorkers(loop, token="secret")
+        await workers.start("127.0.0.1", port)
+        node = startNode(port, str(node_dir))
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(None, workers.generate, GenerationJob(kwargs, "alice")), 60
+            )
+        finally:
+            node.terminate()
+            node.wait()
+            await workers.close()
+
+    [(image, seed)] = asyncio.run(main())
+    assert seed == 3
+    # The stub mixes a little noise into the init image
+    red, green, _ = image.convert("RGB").getpixel((32, 32))
+    assert red > 200 and green < 60
+
+
+async def post(session, url, **kwargs):
+    async with session.post(url, **kwargs) as response:
+        return response.status, (await response.json() if response.status == 200 and response.content_length else None)
+
+
+def test_expired_lease_requeued_for_another_node():
+    # Nodes played by hand: the first takes the job and goes silent, the second finishes it
+    async def main():
+        loop = asyncio.get_running_loop()
+        port = freePort()
+        server = f"http://127.0.0.1:{port}"
+        workers = RemoteWorkers(loop, lease_seconds=0.5, poll_timeout=5)
+        await workers.start("127.0.0.1", port)
+        kwargs = dict(prompt="x", width=64, height=64, steps=2, seed=None)
+        result = loop.run_in_executor(None, workers.generate, GenerationJob(kwargs, "alice"))
+        try:
+            async with aiohttp.ClientSession() as session:
+                _, first = await post(session, f"{server}/nodes", json={"name": "first"})
+                _, lost = await post(session, f"{server}/nodes/{first['node']}/lease")
+                assert lost["payload"] == [kwargs]
+                # No heartbeats, so the node is forgotten and the job goes back in the queue
+                for _ in range(50):
+                    if workers.num_nodes == 0 and workers._pending:
+                        break
+                    await asyncio.sleep(0.1)
+                _, second = await post(session, f"{server}/nodes", json={"name": "second"})
+                _, lease = await post(session, f"{server}/nodes/{second['node']}/lease")
+                assert lease["lease"] != lost["lease"] and lease["payload"] == [kwargs]
+                # The first node finding out too late
+                status, _ = await post(session, f"{server}/leases/{lost['lease']}/complete", json={"counts": [0]})
+                assert status == 410
+                buffer = BytesIO()
+                Image.new("RGB", (64, 64)).save(buffer, "PNG")
+                await post(
+                    session,
+                    f"{server}/leases/{lease['lease']}/images",
+                    params={"index": 0, "seed": 5},
+                    data=buffer.getvalue(),
+                )
+                await post(session, f"{server}/leases/{lease['lease']}/complete", json={"counts": [1]})
+            return await asyncio.wait_for(result, 10)
+        finally:
+            await workers.close()
+
+    [(image, seed)] = asyncio.run(main())
+    assert seed == 5 and image.size == (64, 64)
+
+
+def test_job_lost_too_often_fails():
+    async def main():
+        loop = asyncio.get_running_loop()
+        port = freePort()
+        server = f"http://127.0.0.1:{port}"
+        workers = RemoteWorkers(loop, lease_seconds=0.5, max_attempts=1)
+        await workers.start("127.0.0.1", port)
+        kwargs = dict(prompt="x", width=64, height=64, steps=2)
+        result = loop.run_in_executor(None, workers.generate, GenerationJob(kwargs, "alice"))
+        try:
+            async with aiohttp.ClientSession() as session:
+                _, node = await post(session, f"{server}/nodes", json={"name": "node"})
+                await post(session, f"{server}/nodes/{node['node']}/lease")
+            with pytest.raises(RuntimeError, match="lost 1 times"):
+                await asyncio.wait_for(result, 10)
+        finally:
+            await workers.close()
+
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+import os
+
+from result_cache import ResultCache
+
+KWARGS = dict(prompt="a  red\tfox", width=512, height=512, steps=50, cfg_scale=7.5, strength=0.75, model="m")
+
+
+def image(tmp_path, name="a.png"):
+    path = tmp_path / name
+    path.write_bytes(b"png")
+    return str(path)
+
+
+def test_key_normalises_query(tmp_path):
+    cache = ResultCache(str(tmp_path / "index.json"))
+    key = cache.key(KWARGS, 1, "k_lms")
+    assert key == cache.key(dict(KWARGS, prompt=" a red fox ", cfg_scale=7.5), 1, "k_lms")
+    # The default sampler is the same as asking for it, and the strength only matters for img2img
+    assert key == cache.key(dict(KWARGS, sampler_name="k_lms", strength=0.5), 1, "k_lms")
+    assert key != cache.key(KWARGS, 2, "k_lms")
+    assert key != cache.key(KWARGS, 1, "ddim")
+    assert key != cache.key(dict(KWARGS, steps=49), 1, "k_lms")
+    assert key != cache.key(dict(KWARGS, profile="fast"), 1, "k_lms")
+    assert cache.key(KWARGS, None, "k_lms") is None
+
+
+def test_key_hashes_init_image_contents(tmp_path):
+    cache = ResultCache(str(tmp_path / "index.json"))
+    first, second = tmp_path / "1.png", tmp_path / "2.png"
+    first.write_bytes(b"one")
+    second.write_bytes(b"one")
+    key = cache.key(dict(KWARGS, init_img=str(first)), 1, "k_lms")
+    assert key == cache.key(dict(KWARGS, init_img=str(second)), 1, "k_lms")
+    second.write_bytes(b"two")
+    assert key != cache.key(dict(KWARGS, init_img=str(second)), 1, "k_lms")
+
+
+def test_get_and_put(tmp_path):
+    cache = ResultCache(str(tmp_path / "index.json"))
+    path = image(tmp_path)
+    cache.put("k", path)
+    assert cache.get("k") == path
+    assert cache.get("other") is None
+    assert cache.get(None) is None
+    # A query that can't be cached (key None) isn't counted
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_deleted_image_is_forgotten(tmp_path):
+    cache = ResultCache(str(tmp_path / "index.json"))
+    path = image(tmp_path)
+    cache.put("k", path)
+    os.remove(path)
+    assert cache.get("k") is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path / "index.json"), max_entries=2)
+    path = image(tmp_path)
+    cache.put("a", path)
+    cache.put("b", path)
+    cache.get("a")
+    cache.put("c", path)
+    assert cache.get("b") is None
+    assert cache.get("a") == path and cache.get("c") == path
+
+
+def test_index_saved_later_and_on_close(tmp_path):
+    index_path = str(tmp_path / "index.json")
+    cache = ResultCache(index_path, save_delay=60)
+    path = image(tmp_path)
+    cache.put("k", path)
+    # Not written on every put
+    assert not os.path.exists(index_path)
+    cache.close()
+    reloaded = ResultCache(index_path)
+    assert reloaded.get("k") == path
+
+
+def test_index_saved_by_timer(tmp_path):
+    index_path = str(tmp_path / "index.json")
+    cache = ResultCache(index_path, save_delay=0.01)
+    cache.put("k", image(tmp_path))
+    cache._save_timer.join(5)
+    assert len(ResultCache(index_path)) == 1
+
+
+def test_unreadable_index_starts_empty(tmp_path):
+    index_path = tmp_path / "index.json"
+    index_path.write_text("not json")
+    assert len(ResultCache(str(index_path))) == 0
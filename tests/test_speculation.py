@@ -0,0 +1,75 @@
+from speculation import Speculator
+
+
+def request(prompt="x", n=1, model=None, seed=None):
+    return dict(prompt=prompt, iterations=n, width=512, height=512, steps=50, model=model, seed=seed)
+
+
+def speculate(speculator):
+    # Run the job speculated on, as the generation queue would when idle
+    job = speculator.next_job()
+    if job is not None:
+        speculator.done(job, [(f"image{speculator.generated}", speculator.generated)])
+    return job
+
+
+def test_spare_images_served_for_the_same_request():
+    speculator = Speculator(per_request=2)
+    assert speculator.next_job() is None
+    speculator.note(request(seed=1))
+    job = speculate(speculator)
+    assert job.author == "speculation"
+    assert job.kwargs["seed"] is None and job.kwargs["iterations"] == 1
+    speculate(speculator)
+    # Enough spares, so nothing more to do
+    assert speculator.next_job() is None
+    assert speculator.num_spares == 2
+    assert speculator.take(request(prompt="y"), 1) is None
+    assert speculator.take(request(), 3) is None
+    # The seed doesn't matter, everything else does
+    assert speculator.take(request(seed=5), 2) == [("image0", 0), ("image1", 1)]
+    assert speculator.served == 2 and speculator.num_spares == 0
+
+
+def test_spares_for_the_whole_request():
+    speculator = Speculator(per_request=1)
+    speculator.note(request(n=3))
+    while speculate(speculator):
+        pass
+    assert speculator.num_spares == 3
+
+
+def test_most_recent_request_first_and_oldest_forgotten():
+    speculator = Speculator(per_request=1, max_requests=2)
+    for prompt in ("a", "b", "c"):
+        speculator.note(request(prompt))
+    assert speculate(speculator).kwargs["prompt"] == "c"
+    assert speculate(speculator).kwargs["prompt"] == "b"
+    assert speculator.next_job() is None
+    speculator.note(request("a"))
+    # b is forgotten along with its spare
+    assert speculator.take(request("b"), 1) is None
+    assert speculator.take(request("c"), 1) is not None
+
+
+def test_only_models_on_the_gpu():
+    resident = {"m1"}
+    speculator = Speculator(is_resident=lambda model: model in resident)
+    speculator.note(request("a", model="m1"))
+    speculator.note(request("b", model="m2"))
+    assert speculator.next_job().kwargs["prompt"] == "a"
+    resident = {"m2"}
+    assert speculator.next_job().kwargs["prompt"] == "b"
+
+
+def test_preempted_job_tried_again_and_failed_request_dropped():
+    speculator = Speculator()
+    speculator.note(request())
+    job = speculator.next_job()
+    job.cancelled = True
+    speculator.done(job, None)
+    assert speculator.preempted == 1
+    job = speculator.next_job()
+    assert job is not None
+    speculator.done(job, None)
+    assert speculator.next_job() is None
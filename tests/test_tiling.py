@@ -0,0 +1,29 @@
+from tiling import planTiles
+
+
+def covered(width, height, tiles):
+    return all(
+        any(x <= px < x + w and y <= py < y + h for x, y, w, h in tiles)
+        for px in range(0, width, 8)
+        for py in range(0, height, 8)
+    )
+
+
+def test_small_image_is_one_tile():
+    assert planTiles(512, 384) == [(0, 0, 512, 384)]
+
+
+def test_tiles_cover_image_and_overlap():
+    tiles = planTiles(1536, 1024, tile_size=512, overlap=64)
+    assert len({(w, h) for _, _, w, h in tiles}) == 1
+    assert covered(1536, 1024, tiles)
+    xs = sorted({x for x, _, _, _ in tiles})
+    assert xs[0] == 0 and xs[-1] + 512 == 1536
+    assert all(b - a <= 512 - 64 for a, b in zip(xs, xs[1:]))
+
+
+def test_tiles_in_rows_from_top_left():
+    tiles = planTiles(1024, 1024, tile_size=512, overlap=64)
+    assert tiles[0][:2] == (0, 0)
+    assert [y for _, y, _, _ in tiles] == sorted(y for _, y, _, _ in tiles)
+    assert tiles[-1][0] + tiles[-1][2] == 1024 and tiles[-1][1] + tiles[-1][3] == 1024
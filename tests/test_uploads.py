@@ -0,0 +1,106 @@
+import asyncio
+
+import discord
+
+from uploads import Uploader, packMessages
+
+
+def test_pack_small_files_into_one_message():
+    assert packMessages([100, 200, 300], max_bytes=1000, max_files=10) == [[0, 1, 2]]
+
+
+def test_pack_respects_size_limit():
+    messages = packMessages([600, 500, 400, 300], max_bytes=1000, max_files=10)
+    sizes = [600, 500, 400, 300]
+    assert sorted(j for message in messages for j in message) == [0, 1, 2, 3]
+    assert all(sum(sizes[j] for j in message) <= 1000 for message in messages)
+    # First fit decreasing: 600+400 and 500+300
+    assert messages == [[0, 2], [1, 3]]
+
+
+def test_pack_respects_attachment_limit():
+    messages = packMessages([1] * 12, max_bytes=1000, max_files=5)
+    assert [len(message) for message in messages] == [5, 5, 2]
+    assert messages[0] == [0, 1, 2, 3, 4]
+
+
+def test_pack_oversized_file_gets_its_own_message():
+    assert packMessages([2000, 10], max_bytes=1000, max_files=10) == [[0], [1]]
+
+
+def test_pack_no_files():
+    assert packMessages([]) == []
+
+
+class Response:
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.reason = "error"
+        self.headers = headers or {}
+
+
+class Followup:
+    # Records each message sent, failing the first ones with the given HTTP statuses.
+    # Messages with an embed take embed_delay seconds, as if they were the largest
+    def __init__(self, failures=(), fail_multiple_with=None, embed_delay=0.0):
+        self.failures = list(failures)
+        self.fail_multiple_with = fail_multiple_with
+        self.embed_delay = embed_delay
+        self.sent = []
+
+    async def send(self, content=None, embed=None, view=None, files=()):
+        if embed is not None:
+            await asyncio.sleep(self.embed_delay)
+        if self.failures:
+            raise discord.HTTPException(Response(self.failures.pop(0), {"Retry-After": "0"}), "error")
+        if self.fail_multiple_with is not None and len(files) > 1:
+            raise discord.HTTPException(Response(self.fail_multiple_with), "too large")
+        self.sent.append((content, embed, [file.filename for file in files]))
+
+
+class Context:
+    def __init__(self, followup):
+        self.followup = followup
+
+
+def send(followup, files, **kwargs):
+    uploader = Uploader(base_delay=0.0, max_bytes=1000, max_files=2)
+    return asyncio.run(uploader.send(Context(followup), files, **kwargs))
+
+
+def test_files_packed_into_messages_with_embed_first():
+    followup = Followup(embed_delay=0.05)
+    embed = discord.Embed(title="t")
+    files = [("a.png", b"x" * 600), ("b.png", b"x" * 300), ("c.png", b"x" * 600), ("d.png", b"x" * 600)]
+    assert send(followup, files, embed=embed) == []
+    assert followup.sent[0] == (None, embed, ["a.png", "b.png"])
+    assert sorted(followup.sent[1:]) == [("(2/3)", None, ["c.png"]), ("(3/3)", None, ["d.png"])]
+
+
+def test_embed_sent_without_files():
+    followup = Followup()
+    embed = discord.Embed(title="t")
+    assert send(followup, [], embed=embed) == []
+    assert followup.sent == [(None, embed, [])]
+    followup = Followup()
+    assert send(followup, []) == []
+    assert followup.sent == []
+
+
+def test_transient_errors_retried():
+    followup = Followup(failures=[429, 503])
+    assert send(followup, [("a.png", b"x")]) == []
+    assert followup.sent == [(None, None, ["a.png"])]
+
+
+def test_other_errors_give_up_with_failed_names():
+    followup = Followup(failures=[403])
+    assert send(followup, [("a.png", b"x")]) == ["a.png"]
+    assert followup.sent == []
+
+
+def test_too_large_message_split_into_one_file_each():
+    followup = Followup(fail_multiple_with=413, embed_delay=0.05)
+    embed = discord.Embed(title="t")
+    assert send(followup, [("a.png", b"x"), ("b.png", b"x")], embed=embed) == []
+    assert followup.sent == [(None, embed, ["a.png"]), (None, None, ["b.png"])]
@@ -0,0 +1,60 @@
+import pytest
+
+from vram_model import GB, VramModel, isOutOfMemory
+
+
+def test_everything_fits_without_known_capacity():
+    model = VramModel()
+    assert model.fits(2048, 2048, 16, True, "k_lms")
+    assert model.max_images(2048, 2048, True, "k_lms") is None
+
+
+def test_estimates_grow_with_images_size_and_precision():
+    model = VramModel(capacity=8 * GB)
+    one = model.estimate(512, 512, 1, False, "k_lms")
+    assert model.estimate(512, 512, 2, False, "k_lms") > one
+    assert model.estimate(768, 768, 1, False, "k_lms") > one
+    assert model.estimate(512, 512, 1, True, "k_lms") > one
+    assert model.estimate(512, 512, 1, False, "plms") > one
+    assert model.estimate(1024, 1024, 1, False, "k_lms", attention_slicing=True) < model.estimate(
+        1024, 1024, 1, False, "k_lms"
+    )
+
+
+def test_max_images_matches_fits():
+    model = VramModel(capacity=8 * GB)
+    n = model.max_images(512, 512, False, "k_lms")
+    assert n > 0
+    assert model.fits(512, 512, n, False, "k_lms")
+    assert not model.fits(512, 512, n + 1, False, "k_lms")
+    assert VramModel(capacity=2 * GB).max_images(512, 512, False, "k_lms") == 0
+
+
+def test_observed_peaks_raise_estimates_quickly_and_lower_them_slowly():
+    model = VramModel(capacity=8 * GB)
+    before = model.estimate(512, 512, 4, False, "k_lms")
+    model.observe(512, 512, 4, False, "k_lms", peak=int(before * 1.5))
+    higher = model.estimate(512, 512, 4, False, "k_lms")
+    assert higher > before * 1.4
+    model.observe(512, 512, 4, False, "k_lms", peak=int(before))
+    assert before < model.estimate(512, 512, 4, False, "k_lms") < higher
+    # Calibration is kept apart for each precision and sampler
+    assert model.estimate(512, 512, 4, True, "k_lms") == VramModel(capacity=8 * GB).estimate(
+        512, 512, 4, True, "k_lms"
+    )
+
+
+def test_out_of_memory_makes_that_batch_not_fit():
+    model = VramModel(capacity=8 * GB)
+    n = model.max_images(512, 512, False, "k_lms")
+    model.observe_oom(512, 512, n, False, "k_lms")
+    assert not model.fits(512, 512, n, False, "k_lms")
+    assert model.max_images(512, 512, False, "k_lms") < n
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [(RuntimeError("CUDA out of memory. Tried to allocate"), True), (RuntimeError("device-side assert"), False)],
+)
+def test_is_out_of_memory(error, expected):
+    assert isOutOfMemory(error) == expected
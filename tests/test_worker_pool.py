@@ -0,0 +1,65 @@
+import functools
+import os
+import time
+
+import pytest
+
+from benchmarks.stub_generate import StubGenerate
+from generation_queue import GenerationJob
+from worker_pool import WorkerCrashed, WorkerPool
+
+
+class CrashingStub(StubGenerate):
+    # Exits the worker process on "crash" the first time (marked by a file, as each process is new),
+    # and every time on "always crash"
+    def __init__(self, marker: str):
+        super().__init__(seconds_per_step=0.0, seconds_per_megapixel_step=0.0)
+        self.marker = marker
+
+    def prompt2image(self, prompt, **kwargs):
+        if prompt == "always crash" or (prompt == "crash" and not os.path.exists(self.marker)):
+            open(self.marker, "w").close()
+            os._exit(3)
+        return super().prompt2image(prompt, **kwargs)
+
+
+def crashingStub(marker: str, device: str) -> CrashingStub:
+    return CrashingStub(marker)
+
+
+def job(prompt: str) -> GenerationJob:
+    return GenerationJob(dict(prompt=prompt, width=64, height=64, steps=2, seed=7), "alice")
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = WorkerPool(["cpu", "cpu"], functools.partial(crashingStub, str(tmp_path / "crashed")), start_timeout=60)
+    pool.start()
+    yield pool
+    pool.close()
+
+
+def waitReady(pool, timeout=60):
+    deadline = time.monotonic() + timeout
+    while pool.num_ready < len(pool) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    return pool.num_ready
+
+
+def test_images_come_back_from_worker(pool):
+    [(image, seed)] = pool.generate(job("a fox"))
+    assert seed == 7 and image.size == (64, 64)
+
+
+def test_crashed_worker_restarted_and_job_retried(pool):
+    [(image, seed)] = pool.generate(job("crash"))
+    assert seed == 7
+    assert sum(status["restarts"] for status in pool.status()) == 1
+    assert waitReady(pool) == 2
+    assert pool.generate(job("a fox"))[0][1] == 7
+
+
+def test_job_crashing_twice_fails(pool):
+    with pytest.raises(WorkerCrashed):
+        pool.generate(job("always crash"))
+    assert waitReady(pool) == 2
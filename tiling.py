@@ -0,0 +1,65 @@
+import math
+import os
+from typing import List, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+# (x, y, width, height) of a tile in the full image
+Tile = Tuple[int, int, int, int]
+
+
+def _starts(size: int, tile_size: int, overlap: int) -> List[int]:
+    # Evenly spaced tile offsets along one side, overlapping by at least overlap
+    if size <= tile_size:
+        return [0]
+    num_tiles = math.ceil((size - overlap) / (tile_size - overlap))
+    return [round(k * (size - tile_size) / (num_tiles - 1)) for k in range(num_tiles)]
+
+
+def planTiles(width: int, height: int, tile_size: int = 512, overlap: int = 64) -> List[Tile]:
+    # Overlapping tiles covering a width x height image, all the same size (so they can be batched),
+    # in rows from the top left
+    tile_width, tile_height = min(tile_size, width), min(tile_size, height)
+    return [
+        (x, y, tile_width, tile_height)
+        for y in _starts(height, tile_height, overlap)
+        for x in _starts(width, tile_width, overlap)
+    ]
+
+
+def cropTiles(
+    source: Union[Image.Image, str], size: Tuple[int, int], tiles: List[Tile], directory: str
+) -> List[str]:
+    # Upscale an image (or the image at a path) to size and save each tile of it as a PNG in directory,
+    # returning their paths
+    if isinstance(source, str):
+        source = Image.open(source)
+    image = source.convert("RGB").resize(size, Image.LANCZOS)
+    paths = []
+    for k, (x, y, width, height) in enumerate(tiles):
+        path = os.path.join(directory, f"tile_{k}.png")
+        image.crop((x, y, x + width, y + height)).save(path, "PNG")
+        paths.append(path)
+    return paths
+
+
+def _featherMask(width: int, height: int, left: int, top: int) -> Image.Image:
+    # Opaque, except for ramps from transparent over the first left columns and top rows
+    ramp_x = np.ones(width, dtype=np.float32)
+    ramp_y = np.ones(height, dtype=np.float32)
+    if left > 0:
+        ramp_x[:left] = np.linspace(0.0, 1.0, left, endpoint=False)
+    if top > 0:
+        ramp_y[:top] = np.linspace(0.0, 1.0, top, endpoint=False)
+    return Image.fromarray((255 * np.outer(ramp_y, ramp_x)).astype(np.uint8), "L")
+
+
+def blendTiles(size: Tuple[int, int], tiles: List[Tile], images: List[Image.Image], overlap: int = 64) -> Image.Image:
+    # Put the tiles back together. In the order planTiles gives them, every tile overlaps the ones already
+    # placed on its left and top edges, so it's faded in across overlap pixels there to hide the seams
+    canvas = Image.new("RGB", size)
+    for (x, y, width, height), image in zip(tiles, images):
+        mask = _featherMask(width, height, overlap if x > 0 else 0, overlap if y > 0 else 0)
+        canvas.paste(image.convert("RGB"), (x, y), mask)
+    return canvas
@@ -0,0 +1,145 @@
+import asyncio
+import logging as lg
+import random
+from io import BytesIO
+from typing import List, Optional, Sequence, Tuple
+
+import aiohttp
+import discord
+
+from image_encoding import DISCORD_SIZE_LIMIT
+from metrics import UPLOAD_FALLBACKS_TOTAL, UPLOAD_RETRIES_TOTAL
+
+# Most attachments discord allows on one message
+MAX_ATTACHMENTS = 10
+
+
+def packMessages(
+    sizes: Sequence[int], max_bytes: int = DISCORD_SIZE_LIMIT, max_files: int = MAX_ATTACHMENTS
+) -> List[List[int]]:
+    # Group files (by index) into as few messages as possible, each under both discord limits,
+    # by first fit decreasing. Files keep their order within and across messages where they can
+    messages = []
+    for j in sorted(range(len(sizes)), key=lambda j: -sizes[j]):
+        for message in messages:
+            if message[0] + sizes[j] <= max_bytes and len(message[1]) < max_files:
+                message[0] += sizes[j]
+                message[1].append(j)
+                break
+        else:
+            messages.append([sizes[j], [j]])
+    return sorted((sorted(indices) for _, indices in messages), key=lambda indices: indices[0])
+
+
+def _isTransient(error: Exception) -> bool:
+    if isinstance(error, discord.HTTPException):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+
+def _retryDelay(error: Exception, attempt: int, base_delay: float) -> float:
+    # Use discord's Retry-After for rate limits, otherwise back off exponentially with some jitter
+    if isinstance(error, discord.HTTPException) and error.status == 429:
+        headers = getattr(error.response, "headers", None) or {}
+        try:
+            return float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            pass
+    return base_delay * 2**attempt * random.uniform(0.5, 1.5)
+
+
+class Uploader:
+    # Sends already encoded images back to discord: packed into as few messages as the size and
+    # attachment limits allow: the first message (with the embed and buttons), then the rest concurrently
+    # (but no more than max_concurrent at once across every request, to stay clear of discord's rate limits).
+    # A message that hits a rate limit or a transient error is retried with backoff, from the same bytes,
+    # without resending the messages that already went through
+    def __init__(
+        self,
+        max_concurrent: int = 3,
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_bytes: int = DISCORD_SIZE_LIMIT,
+        max_files: int = MAX_ATTACHMENTS,
+    ):
+        self.logger = lg.getLogger(__name__)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._slots = asyncio.Semaphore(max_concurrent)
+
+    async def send(
+        self,
+        ctx: discord.ApplicationContext,
+        files: Sequence[Tuple[str, bytes]],
+        embed: Optional[discord.Embed] = None,
+        view: Optional[discord.ui.View] = None,
+        content: Optional[str] = None,
+    ) -> List[str]:
+        # Send (file name, data) pairs as followups to ctx, with the content, embed (and view) on the first
+        # message, which is still sent when there are no files (e.g. none could be encoded small enough).
+        # Returns the names of any files that couldn't be sent
+        messages = packMessages([len(data) for _, data in files], self.max_bytes, self.max_files)
+        if not messages:
+            if content is None and embed is None:
+                return []
+            messages = [[]]
+        if len(messages) > 1:
+            UPLOAD_FALLBACKS_TOTAL.inc(kind="multiple_messages")
+        # The first message, with the embed and view, goes first so it's above the rest in the channel,
+        # then the others are sent concurrently
+        first = [files[j] for j in messages[0]]
+        failed = [await self._sendMessage(ctx, first, content=content, embed=embed, view=view)]
+        failed += await asyncio.gather(
+            *[
+                self._sendMessage(ctx, [files[j] for j in indices], content=f"({k + 1}/{len(messages)})")
+                for k, indices in enumerate(messages[1:], start=1)
+            ]
+        )
+        return [name for names in failed for name in names]
+
+    async def _sendMessage(
+        self,
+        ctx: discord.ApplicationContext,
+        files: List[Tuple[str, bytes]],
+        content: Optional[str] = None,
+        embed: Optional[discord.Embed] = None,
+        view: Optional[discord.ui.View] = None,
+    ) -> List[str]:
+        kwargs = {}
+        if content is not None:
+            kwargs["content"] = content
+        if embed is not None:
+            kwargs["embed"] = embed
+        if view is not None:
+            kwargs["view"] = view
+        for attempt in range(self.max_attempts):
+            try:
+                async with self._slots:
+                    # Fresh file objects each attempt, as sending consumes them
+                    if files:
+                        kwargs["files"] = [discord.File(BytesIO(data), filename=name) for name, data in files]
+                    await ctx.followup.send(**kwargs)
+                return []
+            except discord.HTTPException as e:
+                if e.status == 413 and len(files) > 1:
+                    # Bigger than discord would take after all, so send the files one per message
+                    UPLOAD_FALLBACKS_TOTAL.inc(kind="one_by_one")
+                    # Again with the embed and view first
+                    failed = [await self._sendMessage(ctx, files[:1], content, embed, view)]
+                    failed += await asyncio.gather(
+                        *[self._sendMessage(ctx, [file], content) for file in files[1:]]
+                    )
+                    return [name for names in failed for name in names]
+                error = e
+            except Exception as e:
+                error = e
+            if not _isTransient(error) or attempt + 1 == self.max_attempts:
+                break
+            delay = _retryDelay(error, attempt, self.base_delay)
+            self.logger.warning(f"Upload failed ({error}), retrying in {delay:.1f}s")
+            UPLOAD_RETRIES_TOTAL.inc()
+            await asyncio.sleep(delay)
+        self.logger.error(f"Could not upload {', '.join(name for name, _ in files)}: {error}")
+        return [name for name, _ in files]
@@ -35,15 +35,20 @@ def discordFilename(attachment: discord.message.Attachment):
     return filename
 
 
+def resizeImage(img: Image.Image, resize_num_pixels: int) -> Image.Image:
+    # Resize the image to have (roughly) resize_num_pixels pixels, keeping the aspect ratio
+    img_pixels = math.prod(img.size)
+    scale_factor = img_pixels / resize_num_pixels
+    new_size = tuple(round(sz / math.sqrt(scale_factor)) for sz in img.size)
+    return img.resize(new_size)
+
+
 def saveImageFromUrl(url: str, download_path: str, resize_num_pixels: int) -> str:
     img = getImageFromUrl(url)
 
-    img_pixels = math.prod(img.size)
     # Resize the image
     if resize_num_pixels is not None:
-        scale_factor = img_pixels / resize_num_pixels
-        new_size = tuple(round(sz / math.sqrt(scale_factor)) for sz in img.size)
-        img = img.resize(new_size)
+        img = resizeImage(img, resize_num_pixels)
 
     os.makedirs(download_path, exist_ok=True)
 
@@ -0,0 +1,158 @@
+import logging as lg
+import threading
+from typing import Dict, Optional, Tuple
+
+GB = 2**30
+
+# Rough figures for stable diffusion 1.x at half precision, which calibration then corrects for the actual
+# GPU, attention implementation and driver: the weights, the activations per image pixel
+# (with the unconditional copy for classifier free guidance), and the (sliced) attention matrices per pair
+# of latent tokens (one token per 8x8 pixels, so attention grows with the square of the image size)
+MODEL_BYTES = 2.2 * GB
+BYTES_PER_PIXEL = 1400
+BYTES_PER_TOKEN_PAIR = 4
+# Attention slicing computes a few rows of the attention matrices at a time
+SLICED_ATTENTION_FACTOR = 0.25
+# Samplers that keep extra copies of the latents around
+SAMPLER_FACTORS = {"plms": 1.1, "k_dpm_2": 1.1, "k_dpm_2_a": 1.1, "k_heun": 1.1}
+
+
+class OutOfVramError(Exception):
+    pass
+
+
+def isOutOfMemory(error: BaseException) -> bool:
+    # torch.cuda.OutOfMemoryError, or an error passed on from a worker process or generator node
+    return "out of memory" in str(error).lower()
+
+
+def detectVram(device: Optional[str] = None) -> Optional[int]:
+    # Total memory of a CUDA device, or None without CUDA
+    try:
+        import torch
+    except ImportError:
+        return None
+    if not torch.cuda.is_available() or (device is not None and not device.startswith("cuda")):
+        return None
+    return torch.cuda.get_device_properties(torch.device(device or "cuda")).total_memory
+
+
+class VramModel:
+    # Estimates the peak GPU memory of sampling num_images images of a given size at once,
+    # so the queue only builds batches that fit and requests that can never fit are turned away up front.
+    # The estimates are calibrated from the peaks measured after each generation
+    # (separately for each precision, sampler and attention slicing), and after running out of memory.
+    # With no known capacity (e.g. no CUDA) everything fits.
+    def __init__(self, capacity: Optional[int] = None, headroom: float = 0.9):
+        self.logger = lg.getLogger(__name__)
+        self.capacity = capacity
+        # Fraction of the capacity to plan to use, leaving some for fragmentation
+        self.headroom = headroom
+        # (full_precision, sampler, attention_slicing) -> correction to the activation estimate
+        self._scales: Dict[Tuple[bool, str, bool], float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def budget(self) -> Optional[float]:
+        return None if self.capacity is None else self.capacity * self.headroom
+
+    def scale(self, full_precision: bool, sampler: str, attention_slicing: bool = False) -> float:
+        return self._scales.get((full_precision, sampler, attention_slicing), 1.0)
+
+    def _modelBytes(self, full_precision: bool) -> float:
+        return MODEL_BYTES * (2.0 if full_precision else 1.0)
+
+    def _imageBytes(
+        self, width: int, height: int, full_precision: bool, sampler: str, attention_slicing: bool = False
+    ) -> float:
+        # Uncalibrated activation memory of one image
+        tokens = width * height / 64
+        attention = BYTES_PER_TOKEN_PAIR * tokens**2
+        if attention_slicing:
+            attention *= SLICED_ATTENTION_FACTOR
+        per_image = BYTES_PER_PIXEL * width * height + attention
+        return per_image * (2.0 if full_precision else 1.0) * SAMPLER_FACTORS.get(sampler, 1.0)
+
+    def estimate(
+        self,
+        width: int,
+        height: int,
+        num_images: int,
+        full_precision: bool,
+        sampler: str,
+        attention_slicing: bool = False,
+    ) -> float:
+        image_bytes = self._imageBytes(width, height, full_precision, sampler, attention_slicing)
+        scale = self.scale(full_precision, sampler, attention_slicing)
+        return self._modelBytes(full_precision) + num_images * image_bytes * scale
+
+    def fits(
+        self,
+        width: int,
+        height: int,
+        num_images: int,
+        full_precision: bool,
+        sampler: str,
+        attention_slicing: bool = False,
+    ) -> bool:
+        if self.budget is None:
+            return True
+        estimate = self.estimate(width, height, num_images, full_precision, sampler, attention_slicing)
+        return estimate <= self.budget
+
+    def max_images(
+        self, width: int, height: int, full_precision: bool, sampler: str, attention_slicing: bool = False
+    ) -> Optional[int]:
+        # Most images of this size that can be sampled at once (0 if not even one), None if unlimited
+        if self.budget is None:
+            return None
+        image_bytes = self._imageBytes(width, height, full_precision, sampler, attention_slicing)
+        image_bytes *= self.scale(full_precision, sampler, attention_slicing)
+        return max(0, int((self.budget - self._modelBytes(full_precision)) // image_bytes))
+
+    def observe(
+        self,
+        width: int,
+        height: int,
+        num_images: int,
+        full_precision: bool,
+        sampler: str,
+        peak: int,
+        attention_slicing: bool = False,
+    ):
+        # Calibrate from a measured peak: estimates go up straight away but only come down slowly,
+        # since underestimating costs a failed generation and overestimating only a smaller batch
+        predicted = num_images * self._imageBytes(width, height, full_precision, sampler, attention_slicing)
+        observed = peak - self._modelBytes(full_precision)
+        if predicted <= 0 or observed <= 0:
+            return
+        ratio = observed / predicted
+        key = (full_precision, sampler, attention_slicing)
+        with self._lock:
+            scale = self._scales.get(key, 1.0)
+            self._scales[key] = max(ratio, 0.9 * scale + 0.1 * ratio)
+
+    def observe_oom(
+        self,
+        width: int,
+        height: int,
+        num_images: int,
+        full_precision: bool,
+        sampler: str,
+        attention_slicing: bool = False,
+    ):
+        # This many images didn't fit, so make sure they won't be estimated to fit again
+        if self.budget is None:
+            return
+        predicted = num_images * self._imageBytes(width, height, full_precision, sampler, attention_slicing)
+        available = self.budget - self._modelBytes(full_precision)
+        if predicted <= 0:
+            return
+        key = (full_precision, sampler, attention_slicing)
+        with self._lock:
+            scale = self._scales.get(key, 1.0)
+            self._scales[key] = max(scale * 1.1, 1.1 * available / predicted)
+        self.logger.warning(
+            f"Ran out of VRAM with {num_images} {width}x{height} image(s), "
+            f"memory estimates now scaled by {self._scales[key]:.2f}"
+        )
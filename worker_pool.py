@@ -0,0 +1,334 @@
+import logging as lg
+import multiprocessing
+import threading
+import time
+import traceback
+from typing import Callable, List, Optional
+
+from PIL import Image
+
+from conditioning_cache import installConditioningCache
+from generation_queue import GenerationCancelled, GenerationJob
+from metrics import PEAK_VRAM_BYTES, WORKER_RESTARTS_TOTAL
+from model_loader import peakVram, resetPeakVram
+from vram_model import detectVram
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+def _packImage(image: Image.Image) -> tuple:
+    # Raw pixels, so images cross the process boundary without being encoded and decoded
+    return image.mode, image.size, image.tobytes()
+
+
+def _unpackImage(packed: tuple) -> Image.Image:
+    mode, size, data = packed
+    return Image.frombytes(mode, size, data)
+
+
+def _workerMain(
+    factory: Callable, device: str, warmup_steps: int, conditioning_cache_bytes: int, conn, cancel_event
+):
+    # Entry point of a worker process: build a model on device with factory(device), then run the jobs
+    # sent over conn until told to stop (None). Replies are
+    # (status, results or traceback, peak VRAM, conditioning cache stats),
+    # after first replying ("ready", total VRAM, None, None) once the model has loaded
+    try:
+        t2i = factory(device)
+        t2i.load_model()
+        cache = installConditioningCache(t2i, conditioning_cache_bytes)
+        if warmup_steps > 0:
+            t2i.prompt2image(
+                prompt="warmup", iterations=1, steps=warmup_steps, seed=0, width=512, height=512
+            )
+    except Exception:
+        conn.send(("error", traceback.format_exc(), None, None))
+        return
+    conn.send(("ready", detectVram(device), None, None))
+
+    def on_step(samples, step):
+        if cancel_event.is_set():
+            raise GenerationCancelled()
+
+    def cache_stats():
+        return None if cache is None else cache.stats()
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        kind, payload = message
+        resetPeakVram()
+        try:
+            if kind == "single":
+                results = [t2i.prompt2image(image_callback=None, step_callback=on_step, **payload[0])]
+            else:
+                # Models can bring their own batched generation (e.g. the benchmark stub)
+                generate_batch = getattr(t2i, "generate_batch", None)
+                if generate_batch is None:
+                    from batch_generate import generateBatch
+
+                    results = generateBatch(t2i, payload, [on_step] * len(payload))
+                else:
+                    results = generate_batch(payload, [on_step] * len(payload))
+        except GenerationCancelled:
+            conn.send(("cancelled", None, peakVram(stopped=True), cache_stats()))
+        except Exception:
+            conn.send(("error", traceback.format_exc(), peakVram(stopped=True), cache_stats()))
+        else:
+            packed = [[(_packImage(image), seed) for image, seed in result] for result in results]
+            # prompt2image returns fewer images than asked for when it runs out of memory
+            short = kind == "single" and len(results[0]) < (payload[0].get("iterations") or 1)
+            conn.send(("done", packed, peakVram(stopped=short), cache_stats()))
+
+
+class _Worker:
+    def __init__(self, index: int, device: str):
+        self.index = index
+        self.device = device
+        # starting, ready or failed
+        self.state = "starting"
+        self.busy = False
+        self.process = None
+        self.conn = None
+        self.cancel_event = None
+        self.jobs_done = 0
+        self.restarts = 0
+        self.vram: Optional[int] = None
+        # Running average of seconds per unit of job cost on this device
+        self.seconds_per_cost: Optional[float] = None
+        # Latest conditioning cache counters reported by the process
+        self.cache_stats: Optional[dict] = None
+
+    @property
+    def name(self) -> str:
+        return f"worker {self.index} ({self.device})"
+
+
+class WorkerPool:
+    # A pool of generation processes, one per device, each with its own copy of the model.
+    # generate(job) and generate_batch(jobs) block until a worker is free, so the generation queue
+    # drives the pool from as many threads as there are workers (GenerationQueue concurrency).
+    # Jobs go to the least loaded worker: an idle one, the fastest first.
+    # Images come back as raw pixels, and a worker that crashes is restarted in the background,
+    # with the job it was running retried once on another worker.
+    #
+    # factory(device) builds the (unloaded) model in the worker process, so it must be picklable,
+    # e.g. a module level function or a functools.partial of one.
+    def __init__(
+        self,
+        devices: List[str],
+        factory: Callable,
+        warmup_steps: int = 0,
+        start_timeout: float = 600.0,
+        conditioning_cache_bytes: int = 0,
+    ):
+        self.logger = lg.getLogger(__name__)
+        self.factory = factory
+        self.warmup_steps = warmup_steps
+        self.conditioning_cache_bytes = conditioning_cache_bytes
+        self.start_timeout = start_timeout
+        # CUDA can't be used in forked processes
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(j, device) for j, device in enumerate(devices)]
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def __len__(self):
+        return len(self._workers)
+
+    @property
+    def num_ready(self) -> int:
+        return sum(1 for worker in self._workers if worker.state == "ready")
+
+    @property
+    def min_vram(self) -> Optional[int]:
+        # Memory of the smallest GPU in the pool, if known
+        sizes = [worker.vram for worker in self._workers if worker.vram is not None]
+        return min(sizes) if sizes else None
+
+    def status(self) -> List[dict]:
+        return [
+            {
+                "device": worker.device,
+                "state": "busy" if worker.busy else worker.state,
+                "jobs": worker.jobs_done,
+                "restarts": worker.restarts,
+                "conditioning_cache": worker.cache_stats,
+            }
+            for worker in self._workers
+        ]
+
+    def start(self):
+        # Start every worker and wait for their models to load (blocking).
+        # Raises RuntimeError if none of them could start
+        for worker in self._workers:
+            self._spawn(worker)
+        for worker in self._workers:
+            self._waitReady(worker)
+        if self.num_ready == 0:
+            raise RuntimeError("No generation workers could be started")
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            if worker.process is None:
+                continue
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.kill()
+
+    def generate(self, job: GenerationJob, kwargs: Optional[dict] = None) -> list:
+        # Same interface as prompt2image: returns a list of (image, seed).
+        # kwargs overrides the job's own arguments (e.g. to generate just some of its images)
+        return self._run("single", [kwargs or job.kwargs], [job])[0]
+
+    def generate_batch(self, jobs: List[GenerationJob]) -> List[list]:
+        # Same interface as batch_generate.generateBatch: returns a list of (image, seed) per job
+        return self._run("batch", [job.kwargs for job in jobs], jobs)
+
+    def _run(self, kind: str, payload: List[dict], jobs: List[GenerationJob]) -> List[list]:
+        for attempt in range(2):
+            worker = self._acquire()
+            try:
+                return self._runOn(worker, kind, payload, jobs)
+            except WorkerCrashed:
+                if attempt > 0:
+                    raise
+                self.logger.warning(f"{worker.name} crashed, retrying its job on another worker")
+            finally:
+                self._release(worker)
+
+    def _acquire(self) -> _Worker:
+        # Wait for an idle worker and claim it
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("The worker pool is closed")
+                idle = [w for w in self._workers if w.state == "ready" and not w.busy]
+                if idle:
+                    worker = min(
+                        idle,
+                        key=lambda w: 0.0 if w.seconds_per_cost is None else w.seconds_per_cost,
+                    )
+                    worker.busy = True
+                    return worker
+                if all(w.state == "failed" for w in self._workers):
+                    raise RuntimeError("No generation workers are running")
+                self._condition.wait()
+
+    def _release(self, worker: _Worker):
+        with self._condition:
+            worker.busy = False
+            self._condition.notify_all()
+
+    def _runOn(
+        self, worker: _Worker, kind: str, payload: List[dict], jobs: List[GenerationJob]
+    ) -> List[list]:
+        worker.cancel_event.clear()
+        tic = time.perf_counter()
+        try:
+            worker.conn.send((kind, payload))
+            # Wait for the reply, passing on cancellation once every job has been cancelled
+            while not worker.conn.poll(0.1):
+                if all(job.cancelled for job in jobs):
+                    worker.cancel_event.set()
+                if not worker.process.is_alive():
+                    raise EOFError()
+            status, detail, peak_vram, cache_stats = worker.conn.recv()
+        except (EOFError, OSError):
+            worker.process.join(timeout=5)
+            exitcode = worker.process.exitcode
+            self._restart(worker)
+            raise WorkerCrashed(f"{worker.name} exited with code {exitcode}")
+        elapsed = time.perf_counter() - tic
+
+        if cache_stats is not None:
+            worker.cache_stats = cache_stats
+        if peak_vram is not None:
+            PEAK_VRAM_BYTES.observe(peak_vram)
+            for job in jobs:
+                job.peak_vram = peak_vram
+        if status == "cancelled":
+            raise GenerationCancelled()
+        if status == "error":
+            raise RuntimeError(f"Generation failed on {worker.name}:\n{detail}")
+
+        worker.jobs_done += len(jobs)
+        cost = sum(job.cost for job in jobs)
+        if cost > 0:
+            observed = elapsed / cost
+            previous = worker.seconds_per_cost
+            worker.seconds_per_cost = (
+                observed if previous is None else 0.8 * previous + 0.2 * observed
+            )
+        return [[(_unpackImage(image), seed) for image, seed in result] for result in detail]
+
+    def _spawn(self, worker: _Worker):
+        parent_conn, child_conn = self._context.Pipe()
+        worker.cancel_event = self._context.Event()
+        worker.process = self._context.Process(
+            target=_workerMain,
+            args=(
+                self.factory,
+                worker.device,
+                self.warmup_steps,
+                self.conditioning_cache_bytes,
+                child_conn,
+                worker.cancel_event,
+            ),
+            name=f"sd-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+        # Only the child holds its end, so the pipe reports EOF if the child dies
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.state = "starting"
+        self.logger.info(f"Starting {worker.name} (pid {worker.process.pid})")
+
+    def _waitReady(self, worker: _Worker) -> bool:
+        status, detail = "error", f"timed out after {self.start_timeout:.0f}s"
+        if worker.conn.poll(self.start_timeout):
+            try:
+                status, detail, _, _ = worker.conn.recv()
+                worker.vram = detail if status == "ready" else None
+            except EOFError:
+                worker.process.join(timeout=5)
+                detail = f"exited with code {worker.process.exitcode}"
+        with self._condition:
+            worker.state = "ready" if status == "ready" else "failed"
+            self._condition.notify_all()
+        if status == "ready":
+            self.logger.info(f"{worker.name} ready")
+            return True
+        self.logger.error(f"{worker.name} failed to start: {detail}")
+        if worker.process.is_alive():
+            worker.process.kill()
+        return False
+
+    def _restart(self, worker: _Worker):
+        # Replace a crashed worker process, loading the model again in the background
+        with self._condition:
+            worker.state = "starting"
+            worker.restarts += 1
+        WORKER_RESTARTS_TOTAL.inc()
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join()
+        worker.conn.close()
+        if self._closed:
+            return
+        self.logger.warning(f"Restarting {worker.name} (restart {worker.restarts})")
+        self._spawn(worker)
+        threading.Thread(
+            target=self._waitReady, args=(worker,), name=f"sd-worker-{worker.index}-start", daemon=True
+        ).start()